@@ -0,0 +1,189 @@
+from datetime import date, timedelta
+from random import uniform
+from time import sleep
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, transaction
+from django.db.models import Count, Exists, OuterRef, Q
+
+from . import inventory, models
+from .occupancy import occupancy_matrix
+
+
+
+class BookingError(Exception):
+    pass
+
+class RoomOverlap(BookingError):
+    """ The room is already booked for some of the dates """
+
+class UserOverlap(BookingError):
+    """ The user is already booked elsewhere for some of the dates """
+
+class BookingBusy(BookingError):
+    """ The database stayed locked through every retry """
+
+
+
+def _book(reservation):
+    with transaction.atomic():
+        # SQLite takes the write lock as the transaction begins (transaction_mode
+        # IMMEDIATE in the settings), other backends lock the room and user rows.
+        # Either way, competing bookings wait here until this one is committed.
+        if connection.features.has_select_for_update:
+            list(models.Room.objects.select_for_update().filter(pk=reservation.room_id).values_list('pk'))
+            list(User.objects.select_for_update().filter(pk=reservation.user_id).values_list('pk'))
+
+        # One query for both checks, the room's and the user's overlaps are each a range of their partial index
+        overlaps = (
+            active_overlaps(reservation.date_bookfrom, reservation.date_bookuntil)
+            .filter(Q(room_id=reservation.room_id) | Q(user_id=reservation.user_id))
+            .exclude(pk=reservation.pk)
+        )
+        rooms = set(overlaps.values_list('room_id', flat=True))
+        if reservation.room_id in rooms:
+            raise RoomOverlap
+        if rooms:
+            raise UserOverlap
+
+        reservation.save()
+
+
+def book(reservation):
+    """ Saves a reservation unless it overlaps another one of its room or user
+
+    The check and the insert run in one serialized transaction so two
+    simultaneous bookings can't both pass the check. Lock timeouts are
+    retried BOOKING_RETRIES times with exponential backoff and jitter.
+    """
+
+    retries = getattr(settings, "BOOKING_RETRIES", 5)
+    backoff = getattr(settings, "BOOKING_RETRY_BACKOFF", 0.05)
+
+    for attempt in range(retries + 1):
+        try:
+            return _book(reservation)
+        except OperationalError as error:
+            # Only lock contention is worth retrying
+            if "lock" not in str(error).lower():
+                raise
+            if attempt == retries:
+                raise BookingBusy from error
+            sleep(uniform(0, backoff * 2 ** attempt))
+
+
+
+def active_overlaps(date_bookfrom:date, date_bookuntil:date):
+    """ The active reservations overlapping [date_bookfrom, date_bookuntil) """
+    return models.Reservation.objects.filter(
+        date_bookfrom__lt=date_bookuntil,  # Existing booking starts BEFORE the check-out
+        date_bookuntil__gt=date_bookfrom,  # Existing booking ends AFTER the check-in
+        date_checkout__isnull=True,
+    )
+
+
+
+def available_rooms(date_bookfrom:date, date_bookuntil:date, type:str=None, capacity:int=None, amenities=()):
+    """ The rooms that are free for the whole stay
+
+    Occupied rooms are excluded with a single NOT EXISTS anti-join instead of
+    checking each room's reservations one by one, or straight from the shared
+    occupancy matrix when it's on and covers the stay.
+    """
+
+    taken = occupancy_matrix.taken_rooms(date_bookfrom, date_bookuntil)
+    if taken is not None:
+        rooms = models.Room.objects.exclude(pk__in=taken)
+    else:
+        rooms = models.Room.objects.exclude(
+            Exists(active_overlaps(date_bookfrom, date_bookuntil).filter(room=OuterRef('pk')))
+        )
+
+    if type:
+        rooms = rooms.filter(type=type)
+    if capacity:
+        rooms = rooms.filter(capacity__gte=capacity)
+    if amenities:
+        # Only keep the rooms that have every one of the requested amenities
+        amenities = list(amenities)
+        rooms = rooms.annotate(
+            n_amenities=Count('amenities', filter=Q(amenities__in=amenities), distinct=True),
+        ).filter(n_amenities=len(amenities))
+
+    return rooms
+
+
+
+def stay_nights(date_bookfrom:date, date_bookuntil:date) -> list:
+    """ The nights of the stay [date_bookfrom, date_bookuntil) """
+    return [date_bookfrom + timedelta(days=i) for i in range((date_bookuntil - date_bookfrom).days)]
+
+
+def sync_room_nights(reservation):
+    """ Mirrors a saved reservation into the RoomNight table. Checked out reservations take no nights
+
+    Saves that leave the nights as they were (e.g. a check-in) write nothing.
+    """
+
+    nights = models.RoomNight.objects.filter(reservation_id=reservation.pk)
+    wanted = set()
+    if reservation.date_checkout is None:
+        wanted = {(reservation.room_id, night) for night in stay_nights(reservation.date_bookfrom, reservation.date_bookuntil)}
+    taken = set(nights.values_list('room_id', 'date'))
+    if taken == wanted:
+        return
+
+    if taken:
+        nights.delete()
+    models.RoomNight.objects.bulk_create(
+        models.RoomNight(room_id=room_id, reservation_id=reservation.pk, date=night) for room_id, night in sorted(wanted)
+    )
+    inventory.bump()
+
+
+def rebuild_room_nights(batch_size:int=5000) -> int:
+    """ Refills the whole RoomNight table from the active reservations, returns the number of nights """
+
+    rows = (
+        models.Reservation.objects
+        .filter(date_checkout__isnull=True)
+        .values_list('pk', 'room_id', 'date_bookfrom', 'date_bookuntil')
+    )
+    created = 0
+    with transaction.atomic():
+        models.RoomNight.objects.all().delete()
+        batch = []
+        for pk, room_id, date_bookfrom, date_bookuntil in rows.iterator(chunk_size=batch_size):
+            batch.extend(
+                models.RoomNight(room_id=room_id, reservation_id=pk, date=night)
+                for night in stay_nights(date_bookfrom, date_bookuntil)
+            )
+            if len(batch) >= batch_size:
+                created += len(models.RoomNight.objects.bulk_create(batch))
+                batch = []
+        created += len(models.RoomNight.objects.bulk_create(batch))
+        inventory.bump()
+    return created
+
+
+def occupied_nights(start:date, end:date, rooms=None) -> dict:
+    """ {room pk: {date: reservation pk}} of the taken nights in [start, end)
+
+    A single range scan of the RoomNight indexes, whatever the length of the
+    range or the number of reservations. `rooms` narrows it down to some rooms.
+    """
+
+    nights = models.RoomNight.objects.filter(date__gte=start, date__lt=end)
+    if rooms is not None:
+        nights = nights.filter(room__in=rooms)
+
+    occupied = {}
+    for room_id, night, reservation_id in nights.values_list('room_id', 'date', 'reservation_id').iterator():
+        occupied.setdefault(room_id, {})[night] = reservation_id
+    return occupied
+
+
+def room_is_free(room_id, start:date, end:date) -> bool:
+    """ Whether the room has no taken night in [start, end) """
+    return not models.RoomNight.objects.filter(room_id=room_id, date__gte=start, date__lt=end).exists()
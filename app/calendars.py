@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.utils import timezone
+
+from calendar import Calendar
+from datetime import date, datetime
+
+from . import availability, fragments, metrics
+
+
+MAX_MONTHS = 12
+# Months since year 0 of the first and last months the calendar can reach:
+# the grids pad their weeks with the days of the months around them
+FIRST_MONTH = (date.min.year + 1) * 12
+LAST_MONTH = date.max.year * 12 + 11
+
+
+
+def month_start(day:date, offset:int=0) -> date:
+    """ The first day of the month `offset` months after the one of `day` """
+    return _month(_month_number(day) + offset)
+
+
+def _month_number(day:date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def _month(number:int) -> date:
+    return date(number // 12, number % 12 + 1, 1)
+
+
+def busy_days(room_pk, months:list) -> dict:
+    """ {first day of the month: [days of the month the room is taken]} for the given months, in order
+
+    Every month is cached on its own under the room's version, which the
+    signals renew whenever one of its reservations changes. The months that
+    missed are read from the room nights in a single range query.
+    """
+
+    cache = fragments.get_cache()
+    version = fragments.room_versions([room_pk])[room_pk]
+    keys = {month: f"room-calendar:{room_pk}:{version}:{month:%Y-%m}" for month in months}
+    found = cache.get_many(list(keys.values()))
+    busy = {month: found[key] for month, key in keys.items() if key in found}
+
+    missing = [month for month in months if month not in busy]
+    metrics.fragment_cache.inc(len(months) - len(missing), fragment="calendar", result="hit")
+    metrics.fragment_cache.inc(len(missing), fragment="calendar", result="miss")
+
+    if missing:
+        nights = availability.occupied_nights(missing[0], month_start(missing[-1], 1), rooms=[room_pk]).get(room_pk, {})
+        loaded = {month: [] for month in missing}
+        for night in sorted(nights):
+            if month_start(night) in loaded:
+                loaded[month_start(night)].append(night.day)
+        cache.set_many({keys[month]: days for month, days in loaded.items()}, timeout=getattr(settings, "FRAGMENT_CACHE_TIMEOUT", 300))
+        busy.update(loaded)
+
+    return {month: busy[month] for month in months}
+
+
+def room_calendar(request, room) -> dict:
+    """ The month grids of the room's calendar, from ?month=YYYY-MM (this month by default)
+        for ?months=N months (ROOM_CALENDAR_MONTHS by default, at most 12)
+    """
+
+    today = timezone.localdate()
+    try:
+        first = datetime.strptime(request.GET.get("month", ""), "%Y-%m").date()
+    except ValueError:
+        first = month_start(today)
+    try:
+        n_months = min(max(int(request.GET.get("months", "")), 1), MAX_MONTHS)
+    except ValueError:
+        n_months = getattr(settings, "ROOM_CALENDAR_MONTHS", 3)
+
+    # The months shown and the one after them have to exist, the links stop at the edges
+    number = min(max(_month_number(first), FIRST_MONTH), LAST_MONTH - n_months)
+    first = _month(number)
+    previous = max(number - n_months, FIRST_MONTH)
+    following = min(number + n_months, LAST_MONTH - n_months)
+
+    months = [month_start(first, i) for i in range(n_months)]
+    busy = busy_days(room.pk, months)
+    weeks = Calendar(firstweekday=6) # Weeks start on Sunday
+
+    grids = []
+    for month, days in busy.items():
+        taken = set(days)
+        grids.append({
+            'month': month,
+            'weeks': [
+                [
+                    {'date': day, 'busy': day.day in taken, 'past': day < today} if day.month == month.month else None
+                    for day in week
+                ]
+                for week in weeks.monthdatescalendar(month.year, month.month)
+            ],
+        })
+
+    return {
+        'months': grids,
+        'weekdays': weeks.monthdatescalendar(first.year, first.month)[0],
+        'previous': f"?month={_month(previous):%Y-%m}&months={n_months}" if previous != number else None,
+        'next': f"?month={_month(following):%Y-%m}&months={n_months}" if following != number else None,
+    }
@@ -225,3 +225,73 @@ class ReservationForm(forms.ModelForm):
                 },
             ),
         }
+
+
+
+class RoomSearchForm(forms.Form):
+    SORT_CHOICES = [
+        ("price", "Price (lowest first)"),
+        ("-price", "Price (highest first)"),
+    ]
+
+    date_bookfrom = forms.DateField(
+        label = "Check-in",
+        widget = forms.DateInput(
+            format=('%Y-%m-%d'),
+            attrs={
+                'class' : 'form-control',
+                'type': 'date',
+            },
+        ),
+    )
+    date_bookuntil = forms.DateField(
+        label = "Check-out",
+        widget = forms.DateInput(
+            format=('%Y-%m-%d'),
+            attrs={
+                'class' : 'form-control',
+                'type': 'date',
+            },
+        ),
+    )
+    type = forms.ChoiceField(
+        choices = [("", "Any type")] + models.Room.RoomTypes.choices,
+        required = False,
+        widget = forms.Select(attrs={
+            'class' : 'form-select',
+        }),
+    )
+    capacity = forms.IntegerField(
+        label = "Minimum capacity",
+        min_value = 1,
+        required = False,
+        widget = forms.NumberInput(attrs={
+            'class' : 'form-control',
+            'min': 1,
+            'step': 1,
+        }),
+    )
+    amenities = forms.ModelMultipleChoiceField(
+        queryset = models.Amenity.objects.all(),
+        required = False,
+        widget = forms.CheckboxSelectMultiple(attrs={
+            'class' : 'form-check-input',
+        }),
+    )
+    sort = forms.ChoiceField(
+        choices = SORT_CHOICES,
+        required = False,
+        widget = forms.Select(attrs={
+            'class' : 'form-select',
+        }),
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_bookfrom = cleaned_data.get('date_bookfrom')
+        date_bookuntil = cleaned_data.get('date_bookuntil')
+
+        if date_bookfrom and date_bookuntil and date_bookfrom >= date_bookuntil:
+            self.add_error('date_bookuntil', "Check-out has to be after check-in.")
+
+        return cleaned_data
@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+from hashlib import md5
+from uuid import uuid4
+
+from . import metrics, models
+
+
+def get_cache():
+    """ The FRAGMENT_CACHE, where the room fragments, calendars and versions are kept """
+    return caches[getattr(settings, "FRAGMENT_CACHE", "default")]
+
+
+def _version_key(pk) -> str:
+    return f"room-version:{pk}"
+
+
+def forget_rooms(pks):
+    """ Gives the rooms a new version, so their cached fragments and calendars are built again """
+    pks = list(pks)
+    if pks:
+        get_cache().set_many({_version_key(pk): uuid4().hex for pk in pks}, timeout=None)
+
+
+def room_versions(pks:list) -> dict:
+    """ The version of every room, rooms without one (new or evicted) get a fresh one """
+    cache = get_cache()
+    found = cache.get_many([_version_key(pk) for pk in pks])
+    versions = {pk: found.get(_version_key(pk)) for pk in pks}
+
+    missing = {_version_key(pk): uuid4().hex for pk, version in versions.items() if version is None}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update({pk: missing[_version_key(pk)] for pk, version in versions.items() if version is None})
+    return versions
+
+
+def room_fragments(rooms:list, template_name:str, context:dict, variant:str="", cached:bool=True) -> list:
+    """ The rendered `template_name` of every room, in order
+
+    Each fragment is keyed on the room's date_update and its version, which
+    the signals renew whenever its reservations or amenities change (see
+    signals.py), so a cached fragment is never out of date. `variant` sets
+    apart renderings that depend on more than the room, e.g. the user.
+    Only the rooms that missed are loaded with their amenities and active
+    reservations. With `cached` off every room is rendered, and the rooms
+    must already come with_listing().
+    """
+
+    if not cached:
+        return [render_to_string(template_name, {**context, 'room': room, 'reservations': room.active_reservations}) for room in rooms]
+
+    cache = get_cache()
+    variant = md5(variant.encode()).hexdigest()[:12]
+    versions = room_versions([room.pk for room in rooms])
+    keys = {
+        room.pk: f"room-fragment:{template_name}:{room.pk}:{room.date_update.timestamp()}:{versions[room.pk]}:{variant}"
+        for room in rooms
+    }
+    fragments = cache.get_many(list(keys.values()))
+
+    missing = [room for room in rooms if keys[room.pk] not in fragments]
+    metrics.fragment_cache.inc(len(rooms) - len(missing), fragment=template_name, result="hit")
+    metrics.fragment_cache.inc(len(missing), fragment=template_name, result="miss")
+
+    if missing:
+        loaded = models.Room.objects.with_listing().in_bulk([room.pk for room in missing])
+        rendered = {}
+        for room in missing:
+            listed = loaded.get(room.pk)
+            if listed is None: # Deleted in between
+                continue
+            listed.search_snippet = getattr(room, "search_snippet", None)
+            rendered[keys[room.pk]] = render_to_string(template_name, {**context, 'room': listed, 'reservations': listed.active_reservations})
+        cache.set_many(rendered, timeout=getattr(settings, "FRAGMENT_CACHE_TIMEOUT", 300))
+        fragments.update(rendered)
+
+    return [fragments[keys[room.pk]] for room in rooms if keys[room.pk] in fragments]
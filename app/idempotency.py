@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+
+from datetime import timedelta
+from functools import wraps
+from random import random
+from uuid import uuid4
+
+from . import models
+
+
+HEADER = "Idempotency-Key"
+FIELD = "idempotency_key" # The hidden form field, for browsers
+
+
+
+def _replay(record) -> HttpResponse:
+    response = HttpResponse(bytes(record.content), status=record.status_code, content_type=record.content_type or None)
+    if record.location:
+        response["Location"] = record.location
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _claim(request, key, now):
+    """ Creates the record of the key, or returns None when it's already taken """
+    try:
+        with transaction.atomic():
+            return models.IdempotencyKey.objects.create(
+                user=request.user,
+                key=key,
+                path=request.path[:255],
+                date_expire=now + timedelta(seconds=getattr(settings, "IDEMPOTENCY_KEY_TTL", 24 * 60 * 60)),
+            )
+    except IntegrityError:
+        return None
+
+
+def purge_expired() -> int:
+    """ Deletes the expired keys, returns how many there were """
+    count, _ = models.IdempotencyKey.objects.filter(date_expire__lte=timezone.now()).delete()
+    return count
+
+
+def idempotent(view):
+    """ Answers retried POSTs that carry the same idempotency key with the first response
+
+    The key comes from the Idempotency-Key header or the idempotency_key
+    form field and is scoped to the signed-in user. The first request claims
+    the key before running the view, so a retry that arrives while it is
+    still running gets a 409 instead of doing the work twice. Responses are
+    kept for IDEMPOTENCY_KEY_TTL seconds; server errors, including the 503
+    of a booking that found the database too busy, aren't kept so they can
+    be retried. An expired key counts as a new one; the expired rows are
+    purged now and then (see purge_expired()) rather than on every request.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER) or request.POST.get(FIELD)
+
+        if request.method != "POST" or not key or not request.user.is_authenticated:
+            return view(request, *args, **kwargs)
+
+        now = timezone.now()
+        key = key[:255]
+        record = _claim(request, key, now)
+        if record is None:
+            taken = models.IdempotencyKey.objects.filter(user=request.user, key=key).first()
+            if taken is None: # Purged in between, just run it
+                return view(request, *args, **kwargs)
+            if taken.date_expire <= now: # Expired but not purged yet, counts as a new key
+                models.IdempotencyKey.objects.filter(pk=taken.pk, date_expire__lte=now).delete()
+                record = _claim(request, key, now)
+                if record is None: # Claimed again by a retry in between
+                    return HttpResponse("A request with this idempotency key is still being processed.", status=409)
+            elif taken.path != request.path[:255]:
+                return HttpResponse("This idempotency key was used for another request.", status=422)
+            elif taken.status_code is None:
+                return HttpResponse("A request with this idempotency key is still being processed.", status=409)
+            else:
+                return _replay(taken)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+
+        if response.status_code >= 500 or response.streaming:
+            record.delete()
+        else:
+            record.status_code = response.status_code
+            record.content_type = response.get("Content-Type", "")
+            record.location = response.get("Location", "")
+            record.content = response.content
+            record.save(update_fields=['status_code', 'content_type', 'location', 'content'])
+
+        every = getattr(settings, "IDEMPOTENCY_PURGE_EVERY", 100)
+        if every and random() * every < 1:
+            purge_expired()
+
+        return response
+
+    return wrapper
+
+
+def idempotency_key(request):
+    """ Context processor giving every rendered form a fresh key to send along """
+    return {'idempotency_key': lambda: uuid4().hex}
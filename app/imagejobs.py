@@ -0,0 +1,244 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import PurePosixPath
+from threading import Lock, Timer
+import logging
+import traceback
+
+from . import fragments, metrics, models, renditions
+
+
+logger = logging.getLogger(__name__)
+
+Statuses = models.ImageJob.Statuses
+
+_executor = None
+_executor_lock = Lock()
+
+
+
+def store_upload(instance, field:str="image"):
+    """ Stores a newly uploaded image as it was sent, before the instance is saved
+
+    django_resized would resize it in the request otherwise. The manifest is
+    marked pending, which the templates show as a placeholder, until a worker
+    has resized and rendered it. An upload identical to one that was already
+    processed for the same model reuses its copy and renditions instead, in
+    the content-addressed storage. Called by the pre_save signal (see signals.py).
+    """
+
+    image = getattr(instance, field)
+    if not image or image._committed:
+        return
+
+    instance._replaced_renditions = getattr(instance, f"{field}_renditions")
+    storage, model_field = image.storage, image.field
+    upload_name = model_field.generate_filename(instance, image.name)
+
+    if hasattr(storage, "blob_name"):
+        processed = _processed_copy(instance, storage.blob_name(upload_name, image.file), field)
+        if processed:
+            setattr(instance, field, processed[0])
+            setattr(instance, f"{field}_renditions", processed[1])
+            return
+
+    name = storage.save(upload_name, image.file, max_length=model_field.max_length)
+    setattr(instance, field, name)
+    setattr(instance, f"{field}_renditions", {'source': name, 'pending': True})
+
+
+def _processed_copy(instance, source:str, field:str):
+    """ (image name, manifest) of a row of the same model whose upload of `source` was processed, with a reference taken to each file """
+
+    model = type(instance)
+    done = models.ImageJob.objects.filter(
+        content_type=ContentType.objects.get_for_model(model), source=source, status=Statuses.DONE,
+    ).values_list('object_id', flat=True)
+    for name, manifest in model.objects.filter(pk__in=done[:5]).values_list(field, f"{field}_renditions"):
+        if manifest.get('source') != name or not manifest.get('sizes'): # Replaced, or not rendered since
+            continue
+        storage = getattr(instance, field).storage
+        if storage.reference(name):
+            if renditions.share(manifest, storage):
+                return name, manifest
+            renditions.delete_renditions(manifest, storage)
+            storage.delete(name)
+    return None
+
+
+def enqueue(instance, field:str="image"):
+    """ Queues the upload stored by store_upload(), once the instance is saved, and drops the renditions it replaces """
+
+    replaced = instance.__dict__.pop("_replaced_renditions", None)
+    if replaced is None:
+        return
+    if not renditions.pending(getattr(instance, field), getattr(instance, f"{field}_renditions")): # A processed copy was reused
+        transaction.on_commit(lambda: renditions.delete_renditions(replaced))
+        return
+
+    job, _ = models.ImageJob.objects.update_or_create(
+        content_type=ContentType.objects.get_for_model(instance),
+        object_id=instance.pk,
+        defaults={
+            'source': getattr(instance, field).name,
+            'status': Statuses.PENDING,
+            'attempts': 0,
+            'error': "",
+            'run_after': timezone.now(),
+            'date_claimed': None,
+        },
+    )
+
+    def committed():
+        renditions.delete_renditions(replaced)
+        submit(job.pk)
+    transaction.on_commit(committed)
+
+
+
+def _due(now) -> Q:
+    """ The jobs a worker may take: the pending ones whose time has come, and the running ones whose worker died """
+    stale = now - timedelta(seconds=getattr(settings, "IMAGE_JOB_TIMEOUT", 600))
+    return Q(status=Statuses.PENDING, run_after__lte=now) | Q(status=Statuses.RUNNING, date_claimed__lt=stale)
+
+
+def due_jobs(limit:int=100) -> list:
+    """ The pks of the jobs a worker may take, oldest first """
+    return list(models.ImageJob.objects.filter(_due(timezone.now())).order_by('run_after').values_list('pk', flat=True)[:limit])
+
+
+def resize(image) -> str:
+    """ Resizes, rotates and re-encodes a stored upload as its django_resized field is set up, next to it
+
+    Returns the name of the copy.
+    """
+    resized = image.field.attr_class(image.instance, image.field, None)
+    with image.storage.open(image.name, "rb") as file:
+        resized.save(PurePosixPath(image.name).name, file, save=False)
+    return resized.name
+
+
+def run_job(pk, field:str="image") -> str:
+    """ Takes the job, unless another worker has, and processes its image
+
+    The upload is resized, rendered and swapped in for the stored original,
+    unless another image was uploaded in the meantime. Returns "done",
+    "skipped" (taken, deleted or replaced), "retry" or "failed".
+    """
+
+    now = timezone.now()
+    taken = models.ImageJob.objects.filter(_due(now), pk=pk).update(
+        status=Statuses.RUNNING, attempts=F('attempts') + 1, date_claimed=now,
+    )
+    if not taken:
+        return "skipped"
+
+    job = models.ImageJob.objects.select_related('content_type').get(pk=pk)
+    if job.attempts > getattr(settings, "IMAGE_JOB_ATTEMPTS", 5): # Its worker kept dying on it
+        result = _give_up(job, field, "The worker stopped during every attempt")
+    else:
+        try:
+            result = _process(job, field)
+        except Exception:
+            logger.exception(f"Image job for {job.source} failed")
+            result = _retry(job, field, traceback.format_exc())
+
+    metrics.image_jobs.inc(result=result)
+    return result
+
+
+def _process(job, field:str) -> str:
+    model = job.content_type.model_class()
+    instance = model.objects.filter(pk=job.object_id).first()
+    if instance is None or getattr(instance, field).name != job.source: # Deleted, or the new upload has its own job
+        models.ImageJob.objects.filter(pk=job.pk, source=job.source, status=Statuses.RUNNING).delete()
+        return "skipped"
+
+    image = getattr(instance, field)
+    storage = image.storage
+    resized = resize(image)
+    try:
+        manifest = renditions.build_renditions(getattr(instance, field)) # Now the resized copy
+    except Exception:
+        storage.delete(resized)
+        raise
+
+    with transaction.atomic():
+        swapped = model.objects.filter(pk=instance.pk, **{field: job.source}).update(**{field: resized, f"{field}_renditions": manifest})
+        models.ImageJob.objects.filter(pk=job.pk, source=job.source, status=Statuses.RUNNING).update(status=Statuses.DONE, error="")
+
+    if not swapped: # Replaced while it was being resized
+        storage.delete(resized)
+        renditions.delete_renditions(manifest)
+        return "skipped"
+
+    storage.delete(job.source)
+    if model is models.Room:
+        fragments.forget_rooms([instance.pk]) # The image changes without touching date_update
+    return "done"
+
+
+def backoff(attempts:int) -> float:
+    """ Seconds before the retry after the given number of attempts """
+    return getattr(settings, "IMAGE_JOB_RETRY_BACKOFF", 30) * 2 ** (attempts - 1)
+
+
+def _retry(job, field:str, error:str) -> str:
+    if job.attempts >= getattr(settings, "IMAGE_JOB_ATTEMPTS", 5):
+        return _give_up(job, field, error)
+
+    models.ImageJob.objects.filter(pk=job.pk, source=job.source, status=Statuses.RUNNING).update(
+        status=Statuses.PENDING, error=error, run_after=timezone.now() + timedelta(seconds=backoff(job.attempts)),
+    )
+    return "retry"
+
+
+def _give_up(job, field:str, error:str) -> str:
+    """ Marks the job failed, the image is shown as it was uploaded from then on """
+
+    model = job.content_type.model_class()
+    with transaction.atomic():
+        updated = models.ImageJob.objects.filter(pk=job.pk, source=job.source, status=Statuses.RUNNING).update(status=Statuses.FAILED, error=error)
+        if updated:
+            model.objects.filter(pk=job.object_id, **{field: job.source}).update(**{f"{field}_renditions": {}})
+
+    if model is models.Room:
+        fragments.forget_rooms([job.object_id])
+    return "failed"
+
+
+
+def submit(pk, delay:float=0):
+    """ Runs the job on this process's IMAGE_JOB_THREADS, after `delay` seconds. Left to `manage.py process_images` when there are none """
+
+    threads = getattr(settings, "IMAGE_JOB_THREADS", 2)
+    if not threads:
+        return
+    if delay > 0:
+        timer = Timer(delay, submit, [pk])
+        timer.daemon = True # A retry that is lost with the process is picked up by process_images
+        timer.start()
+        return
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image-job")
+    _executor.submit(_run_in_thread, pk)
+
+
+def _run_in_thread(pk):
+    try:
+        if run_job(pk) == "retry":
+            job = models.ImageJob.objects.get(pk=pk)
+            submit(pk, delay=(job.run_after - timezone.now()).total_seconds())
+    except Exception:
+        logger.exception(f"Image job {pk} could not be run")
+    finally:
+        connection.close() # Each thread has a connection of its own
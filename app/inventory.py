@@ -0,0 +1,178 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, FilteredRelation, Q
+from django.utils import timezone
+
+from datetime import date, timedelta
+from hashlib import md5
+from uuid import UUID
+import json
+
+from . import models
+
+
+
+class QueryError(ValueError):
+    pass
+
+
+
+def parse_queries(params) -> list:
+    """ [(room pk, or None for every room, from, until)] of the availability API's GET parameters
+
+    ?from= and ?until= (today and a year on by default) go with every ?room=
+    given, or with every room when there's none. Each ?q=<room>,<from>,<until>
+    adds a range of its own for one room.
+    """
+
+    today = timezone.localdate()
+    rooms, ranges = params.getlist("room"), params.getlist("q")
+    try:
+        start = date.fromisoformat(params["from"]) if params.get("from") else today
+        end = date.fromisoformat(params["until"]) if params.get("until") else start + timedelta(days=365)
+        queries = [(UUID(room), start, end) for room in rooms]
+        for query in ranges:
+            room, query_start, query_end = query.split(",")
+            queries.append((UUID(room), date.fromisoformat(query_start), date.fromisoformat(query_end)))
+    except ValueError:
+        raise QueryError("Rooms are UUIDs, dates are YYYY-MM-DD and ?q= is <room>,<from>,<until>.")
+
+    if not rooms and not ranges:
+        queries = [(None, start, end)]
+
+    max_queries = getattr(settings, "AVAILABILITY_API_MAX_QUERIES", 2000)
+    max_nights = getattr(settings, "AVAILABILITY_API_MAX_NIGHTS", 731)
+    max_span = getattr(settings, "AVAILABILITY_API_MAX_SPAN", 1096)
+    if len(queries) > max_queries:
+        raise QueryError(f"At most {max_queries} queries per call.")
+    for _, query_start, query_end in queries:
+        if query_end <= query_start:
+            raise QueryError("The end of a range has to be after its start.")
+        if (query_end - query_start).days > max_nights:
+            raise QueryError(f"Ranges can't be longer than {max_nights} nights.")
+    # answer() keeps a bit for every night of every room between the first start and the last end
+    if (max(end for _, _, end in queries) - min(start for _, start, _ in queries)).days > max_span:
+        raise QueryError(f"The ranges of a call have to fit in {max_span} nights from the earliest to the latest.")
+
+    return queries
+
+
+def bump():
+    """ Counts a change to the rooms or their taken nights, which renews every ETag
+
+    The counter row is written once per transaction, as it commits, however
+    many rows the transaction changed (e.g. a cascade of deletes).
+    """
+
+    connection = transaction.get_connection()
+    hooks = connection.run_on_commit
+    pending = getattr(connection, "_inventory_bump", None) # (hooks, position, callback) of the bump this transaction registered
+    if pending is not None and pending[0] is hooks and pending[1] < len(hooks) and hooks[pending[1]][1] is pending[2]:
+        return
+
+    def committed():
+        connection._inventory_bump = None
+        _write_bump()
+
+    transaction.on_commit(committed)
+    if connection.in_atomic_block: # Run right away otherwise
+        connection._inventory_bump = (hooks, len(hooks) - 1, committed)
+
+
+def _write_bump():
+    if models.InventoryVersion.objects.filter(pk=1).update(version=F('version') + 1):
+        return
+    try:
+        with transaction.atomic():
+            models.InventoryVersion.objects.create(pk=1, version=1)
+    except IntegrityError: # Created in between
+        models.InventoryVersion.objects.filter(pk=1).update(version=F('version') + 1)
+
+
+def inventory_stamp() -> str:
+    """ Changes whenever a room is added or removed, or one of the taken nights is
+
+    A single row read: the room nights are only written through
+    availability.sync_room_nights() and rebuild_room_nights(), and the
+    signals count the deletes that cascade past them (see signals.py).
+    """
+    return str(models.InventoryVersion.objects.filter(pk=1).values_list('version', flat=True).first() or 0)
+
+
+def etag(queries:list) -> str:
+    """ The ETag of the answer to the queries, which only changes with the inventory """
+    key = inventory_stamp() + "|" + "|".join(f"{room}:{start}:{end}" for room, start, end in queries)
+    return f'"{md5(key.encode()).hexdigest()}"'
+
+
+
+def _runs(bits:int):
+    """ (offset, length) of every run of set bits, lowest first """
+    while bits:
+        low = (bits & -bits).bit_length() - 1
+        shifted = bits >> low
+        length = (~shifted & (shifted + 1)).bit_length() - 1 # Trailing ones
+        yield low, length
+        bits &= ~(((1 << length) - 1) << low)
+
+
+def answer(queries:list):
+    """ The taken nights of every (room, from, until) query, as an iterator of results
+
+    The rooms and their taken nights over the span of all the queries are
+    read in a single query. Each room's nights become the bits of an int,
+    so a query is a shift and a mask, and the taken ranges come out run by
+    run rather than night by night.
+    """
+
+    first = min(start for _, start, _ in queries)
+    last = max(end for _, _, end in queries)
+
+    rooms = models.Room.objects.annotate(
+        window=FilteredRelation('nights', condition=Q(nights__date__gte=first, nights__date__lt=last)),
+    )
+    if all(room is not None for room, _, _ in queries):
+        rooms = rooms.filter(pk__in={room for room, _, _ in queries})
+
+    bits = {}
+    for room_id, night in rooms.order_by('date_add', 'uuid').values_list('pk', 'window__date').iterator():
+        bits.setdefault(room_id, 0)
+        if night is not None:
+            bits[room_id] |= 1 << (night - first).days
+
+    # The query runs now, the results are worked out as they're streamed
+    return _results(queries, bits, first)
+
+
+def _results(queries:list, bits:dict, first:date):
+    for room_id, start, end in queries:
+        for room in bits if room_id is None else [room_id]:
+            result = {'room': str(room), 'from': start.isoformat(), 'until': end.isoformat()}
+            if room not in bits:
+                result['error'] = "Unknown room"
+                yield result
+                continue
+
+            nights = (end - start).days
+            taken = (bits[room] >> (start - first).days) & ((1 << nights) - 1)
+            result['available'] = not taken
+            result['taken'] = [
+                [(start + timedelta(days=offset)).isoformat(), (start + timedelta(days=offset + length)).isoformat()]
+                for offset, length in _runs(taken)
+            ]
+            yield result
+
+
+def stream(results, chunk_size:int=100):
+    """ The results as one JSON document, written out a chunk of results at a time """
+    yield '{"results": ['
+    chunk = []
+    separator = ""
+    for result in results:
+        chunk.append(json.dumps(result))
+        if len(chunk) == chunk_size:
+            yield separator + ", ".join(chunk)
+            separator, chunk = ", ", []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    yield ']}'
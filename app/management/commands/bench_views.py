@@ -0,0 +1,261 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.test import Client
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from statistics import quantiles
+from time import perf_counter
+import json
+import platform
+import tracemalloc
+
+from app import models, search
+
+
+# URL names of app/urls.py that aren't benchmarked, and why
+SKIPPED = {
+    "auth:signout": "logs the benchmark user out",
+    "profile:delete": "logs the benchmark user out",
+}
+
+NOISE_MS = 5.0 # Latency changes below this are never reported as regressions
+
+
+
+class Rollback(Exception):
+    pass
+
+
+class BrokenView(Exception):
+    pass
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives the views of app/urls.py through the test client against seeded datasets of increasing size, "
+        "records their latency percentiles, query counts and peak memory, and compares them with a JSON baseline. "
+        "Runs in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="100,10000,1000000", help="Comma separated numbers of reservations to seed")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed requests per view")
+        parser.add_argument("--destructive-repeat", type=int, default=3, help="Timed requests per view that deletes or books")
+        parser.add_argument("--threshold", type=float, default=0.5, help="Allowed relative slowdown or memory growth")
+        parser.add_argument("--baseline", default=str(Path(settings.BASE_DIR) / "benchmarks" / "views.json"))
+        parser.add_argument("--save", action="store_true", help="Write the results as the new baseline")
+        parser.add_argument("--only", default="", help="Comma separated names of the views to run, e.g. room:view")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be comma separated numbers.")
+
+        self.options = options
+        baseline_path = Path(options["baseline"])
+        baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else None
+
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = {str(size): self.run_size(size) for size in sizes}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'seed': options["seed"],
+            'results': results,
+        }
+
+        if options["save"]:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {baseline_path}."))
+            return
+
+        if baseline is None:
+            self.stdout.write(self.style.WARNING(f"No baseline at {baseline_path}, run with --save to create one."))
+            return
+
+        regressions = self.compare(baseline["results"], results)
+        for regression in regressions:
+            self.stdout.write(self.style.ERROR(f"    {regression}"))
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions against {baseline_path}.")
+        self.stdout.write(self.style.SUCCESS("No regressions."))
+
+    def run_size(self, size:int) -> dict:
+        """ Seeds `size` reservations into the empty test database and benchmarks every view against them """
+
+        call_command("flush", interactive=False, verbosity=0)
+        search.rebuild() # The index table isn't a model, flush leaves it alone
+
+        began = perf_counter()
+        call_command(
+            "seed_hotel",
+            users=max(10, size // 50),
+            rooms=max(5, size // 500),
+            reservations=size,
+            seed=self.options["seed"],
+            prefix="bench",
+            stdout=self.stdout if self.options["verbosity"] > 1 else StringIO(),
+        )
+        self.stdout.write(f"{size:,} reservations seeded in {perf_counter() - began:.1f}s")
+
+        # The busiest user and room, so the per-user and per-room pages are at their largest
+        user = User.objects.get(pk=(
+            models.Reservation.objects.values('user').annotate(n=Count('pk')).order_by('-n', 'user').values('user')[:1]
+        ))
+        room = models.Room.objects.annotate(n=Count('reservations')).order_by('-n', 'pk').first()
+        reservation = models.Reservation.objects.filter(user=user).order_by('date_bookfrom', 'pk').last()
+        amenity = models.Amenity.objects.order_by('pk').first()
+        free_from = models.Reservation.objects.aggregate(last=Max('date_bookuntil'))['last'] + timedelta(days=30)
+
+        client = Client(HTTP_HOST="localhost", raise_request_exception=False)
+        client.force_login(user)
+
+        results = {}
+        for name, method, url, data in self.targets(user, room, reservation, amenity, free_from):
+            if self.options["only"] and name not in self.options["only"].split(","):
+                continue
+            destructive = method == "post"
+            repeat = self.options["destructive_repeat"] if destructive else self.options["repeat"]
+            try:
+                results[name] = self.measure(client, method, url, data, repeat)
+            except BrokenView as e:
+                results[name] = {'error': str(e)}
+                self.stdout.write(self.style.ERROR(f"    {name:<36} {e}"))
+                continue
+            self.stdout.write(
+                f"    {name:<36} p50 {results[name]['p50_ms']:>9.1f}ms  p95 {results[name]['p95_ms']:>9.1f}ms  "
+                f"{results[name]['queries']:>6} queries  {results[name]['peak_kb']:>9,} KiB"
+            )
+        return results
+
+    def targets(self, user, room, reservation, amenity, free_from) -> list:
+        """ (name, method, url, data) of every request to time """
+
+        stay = {'date_bookfrom': free_from, 'date_bookuntil': free_from + timedelta(days=2)}
+        targets = [
+            ("app-index", "get", reverse("app-index"), {}),
+            ("auth:signin", "get", reverse("auth:signin"), {}),
+            ("auth:signup", "get", reverse("auth:signup"), {}),
+            ("password-change", "get", reverse("password-change"), {}),
+            ("password_change_done", "get", reverse("password_change_done"), {}),
+            ("password-reset", "get", reverse("password-reset"), {}),
+            ("password_reset_done", "get", reverse("password_reset_done"), {}),
+            ("password_reset_confirm", "get", reverse("password_reset_confirm", args=["x", "y"]), {}),
+            ("password_reset_complete", "get", reverse("password_reset_complete"), {}),
+            ("profile:view", "get", reverse("profile:view", args=[user.profile.pk]), {}),
+            ("amenity:index", "get", reverse("amenity:index"), {}),
+            ("amenity:add", "get", reverse("amenity:add"), {}),
+            ("amenity:update", "get", reverse("amenity:update", args=[amenity.pk]), {}),
+            ("amenity:delete", "get", reverse("amenity:delete", args=[amenity.pk]), {}),
+            ("amenity:delete_all", "get", reverse("amenity:delete_all"), {}),
+            ("amenity:delete_all POST", "post", reverse("amenity:delete_all"), {}),
+            ("room:index", "get", reverse("room:index"), {}),
+            ("room:index search", "get", reverse("room:index"), {'q': "deluxe"}),
+            ("room:search", "get", reverse("room:search"), stay),
+            ("room:availability", "get", reverse("room:availability"), {}),
+            ("room:add", "get", reverse("room:add"), {}),
+            ("room:update", "get", reverse("room:update", args=[room.pk]), {}),
+            ("room:delete", "get", reverse("room:delete", args=[room.pk]), {}),
+            ("room:delete_all", "get", reverse("room:delete_all"), {}),
+            ("room:delete_all POST", "post", reverse("room:delete_all"), {}),
+            ("room:view", "get", reverse("room:view", args=[room.pk]), {}),
+            ("room:view POST", "post", reverse("room:view", args=[room.pk]), stay),
+            ("room:reservation:index", "get", reverse("room:reservation:index"), {}),
+            ("room:reservation:view", "get", reverse("room:reservation:view", args=[reservation.pk]), {}),
+            ("room:reservation:delete", "get", reverse("room:reservation:delete", args=[reservation.pk]), {}),
+            ("room:reservation:delete_all", "get", reverse("room:reservation:delete_all"), {}),
+            ("room:reservation:delete_all POST", "post", reverse("room:reservation:delete_all"), {}),
+            ("room:reservation:checkin", "get", reverse("room:reservation:checkin", args=[reservation.pk]), {}),
+            ("room:reservation:checkout", "get", reverse("room:reservation:checkout", args=[reservation.pk]), {}),
+        ]
+
+        covered = {name.split(" ")[0] for name, *_ in targets} | set(SKIPPED)
+        missing = sorted(set(self.url_names(get_resolver("app.urls"))) - covered)
+        if missing:
+            self.stdout.write(self.style.WARNING(f"Not benchmarked: {', '.join(missing)}"))
+        return targets
+
+    def url_names(self, resolver, namespace:str=""):
+        for pattern in resolver.url_patterns:
+            if isinstance(pattern, URLResolver):
+                yield from self.url_names(pattern, f"{namespace}{pattern.namespace}:" if pattern.namespace else namespace)
+            elif isinstance(pattern, URLPattern) and pattern.name:
+                yield f"{namespace}{pattern.name}"
+
+    def request(self, client, method:str, url:str, data:dict):
+        """ One request, with whatever it writes rolled back so every run sees the same data """
+        try:
+            with transaction.atomic():
+                response = getattr(client, method)(url, data)
+                raise Rollback
+        except Rollback:
+            pass
+        if response.status_code >= 400:
+            raise BrokenView(f"{method.upper()} {url} answered {response.status_code}")
+        return response
+
+    def measure(self, client, method:str, url:str, data:dict, repeat:int) -> dict:
+        self.request(client, method, url, data) # Warm up the caches and the imports
+
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            self.request(client, method, url, data)
+
+        tracemalloc.start()
+        self.request(client, method, url, data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timings = []
+        for _ in range(repeat):
+            began = perf_counter()
+            self.request(client, method, url, data)
+            timings.append((perf_counter() - began) * 1000)
+
+        percentiles = quantiles(timings, n=100, method="inclusive") if len(timings) > 1 else timings * 99
+        return {
+            'p50_ms': round(percentiles[49], 2),
+            'p95_ms': round(percentiles[94], 2),
+            'p99_ms': round(percentiles[98], 2),
+            'queries': len(queries),
+            'peak_kb': peak // 1024,
+        }
+
+    def compare(self, baseline:dict, results:dict) -> list:
+        """ The views that got slower, ran more queries or used more memory than in the baseline """
+
+        threshold = 1 + self.options["threshold"]
+        regressions = []
+        for size, views in results.items():
+            for name, result in views.items():
+                before = baseline.get(size, {}).get(name)
+                if before is None:
+                    continue
+                where = f"{name} at {int(size):,} reservations"
+                if 'error' in result or 'error' in before:
+                    if 'error' in result and 'error' not in before:
+                        regressions.append(f"{where}: {result['error']}")
+                    continue
+                if result['p50_ms'] > before['p50_ms'] * threshold and result['p50_ms'] - before['p50_ms'] > NOISE_MS:
+                    regressions.append(f"{where}: p50 {before['p50_ms']}ms -> {result['p50_ms']}ms")
+                if result['queries'] > before['queries']:
+                    regressions.append(f"{where}: {before['queries']} -> {result['queries']} queries")
+                if result['peak_kb'] > before['peak_kb'] * threshold:
+                    regressions.append(f"{where}: peak memory {before['peak_kb']:,} -> {result['peak_kb']:,} KiB")
+        return regressions
@@ -0,0 +1,139 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models.fields.files import FieldFile
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import monotonic
+import django
+import json
+import os
+
+from app import fragments, models, renditions
+
+
+MODELS = (models.Room, models.Profile)
+CHECKPOINT_EVERY = 100 # Images between the writes of the checkpoint
+
+
+
+def _render(task):
+    """ Renders one image in a worker process, unless its renditions are up to date
+
+    Up to date renditions without a current preview only get one. Returns
+    (name, manifest, "rendered", "previewed", "up to date" or "failed", error).
+    """
+    model, name, manifest, force = task
+    image = FieldFile(None, model._meta.get_field("image"), name)
+    try:
+        if not force and renditions.up_to_date(image, manifest):
+            if renditions.preview_current(manifest):
+                return name, manifest, "up to date", None
+            return name, renditions.add_preview(image, manifest), "previewed", None
+        return name, renditions.build_renditions(image), "rendered", None
+    except Exception as error: # Missing, not an image Pillow can read, or too large to decode (DecompressionBombError)
+        return name, manifest, "failed", f"{type(error).__name__}: {error}"
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Renders the smaller copies of every room and profile image again on a pool of worker processes, "
+        "e.g. after IMAGE_RENDITIONS changed. Images whose renditions match their content hash and the settings are skipped, "
+        "or only given the inline preview they're missing"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Render every image again, even the up to date ones")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+        parser.add_argument("--chunk-size", type=int, default=8, help="Images handed to a worker at a time")
+        parser.add_argument(
+            "--checkpoint", default=settings.BASE_DIR / "build_image_renditions.checkpoint.json",
+            help="File the images done so far are kept in, so an interrupted run picks up where it stopped",
+        )
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an earlier run")
+
+    def _save_checkpoint(self, path:Path, state:dict):
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(state))
+        os.replace(temporary, path) # Never half written, even when interrupted
+
+    def _apply(self, name:str, manifest:dict):
+        """ Gives every row of the image the new manifest, each with references of its own to the files (see storage.py) """
+
+        if name in getattr(settings, "IMAGE_RENDITION_SHARED", ["default.png"]): # Never deleted, so not counted
+            for model in MODELS:
+                model.objects.filter(image=name).update(image_renditions=manifest)
+            return
+
+        shared = False
+        for model in MODELS:
+            for pk, old in model.objects.filter(image=name).values_list('pk', 'image_renditions'):
+                if shared:
+                    renditions.share(manifest)
+                shared = True
+                model.objects.filter(pk=pk).update(image_renditions=manifest)
+                renditions.delete_renditions(old)
+        if not shared: # Removed in the meantime
+            renditions.delete_renditions(manifest)
+
+    def handle(self, *args, **options):
+        checkpoint = Path(options["checkpoint"])
+        state = {'config': renditions.config(), 'force': options["force"], 'done': []}
+        if checkpoint.exists() and not options["restart"]:
+            saved = json.loads(checkpoint.read_text())
+            if (saved['config'], saved['force']) == (state['config'], state['force']): # Not if the settings changed since
+                state['done'] = saved['done']
+        done = set(state['done'])
+
+        images = {} # Image name -> (model, manifest), the default image is shared by many rows
+        for model in MODELS:
+            for instance in model.objects.only('pk', 'image', 'image_renditions').iterator():
+                if not instance.image or renditions.pending(instance.image, instance.image_renditions): # Left to the image workers
+                    continue
+                images.setdefault(instance.image.name, (model, instance.image_renditions))
+
+        tasks = [(model, name, manifest, options["force"]) for name, (model, manifest) in images.items() if name not in done]
+        self.stdout.write(f"    {len(images):,} images, {len(images) - len(tasks):,} done by an earlier run")
+
+        n_rendered = n_previewed = n_skipped = n_failed = 0
+        start = monotonic()
+        connections.close_all() # The worker processes are forked from this one and can't share its connection
+        pool = ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup)
+        try:
+            for name, manifest, outcome, error in pool.map(_render, tasks, chunksize=options["chunk_size"]):
+                if outcome == "failed": # The rows keep the renditions they have, and a later run tries again
+                    self.stdout.write(self.style.ERROR(f"    {name}: {error}"))
+                    n_failed += 1
+                else:
+                    state['done'].append(name)
+
+                if outcome == "rendered":
+                    n_rendered += 1
+                    self._apply(name, manifest)
+                elif outcome == "previewed": # Same files, so the references stay as they are
+                    n_previewed += 1
+                    for model in MODELS:
+                        model.objects.filter(image=name).update(image_renditions=manifest)
+                elif outcome == "up to date":
+                    n_skipped += 1
+                if outcome in ("rendered", "previewed"):
+                    fragments.forget_rooms(models.Room.objects.filter(image=name).values_list('pk', flat=True))
+
+                n_checked = n_rendered + n_previewed + n_skipped + n_failed
+                if n_checked % CHECKPOINT_EVERY == 0:
+                    self._save_checkpoint(checkpoint, state)
+                    self.stdout.write(f"    {n_checked:,}/{len(tasks):,} images, {n_checked / (monotonic() - start):.1f} images/s")
+        except BaseException:
+            self._save_checkpoint(checkpoint, state)
+            raise
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        checkpoint.unlink(missing_ok=True)
+        elapsed = monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{n_rendered:,} images rendered, {n_previewed:,} given a preview, {n_skipped:,} up to date, {n_failed:,} failed "
+            f"in {elapsed:.1f}s ({len(tasks) / elapsed if elapsed else 0:.1f} images/s)."
+        ))
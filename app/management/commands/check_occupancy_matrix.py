@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.occupancy import occupancy_matrix
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the shared occupancy matrix with the active reservations and fails if they disagree. "
+        "A booking committed while it runs may show up as a mismatch, run it again to be sure."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repair", action="store_true", help="Rewrite the rows of the rooms that disagree")
+
+    def handle(self, *args, **options):
+        if not occupancy_matrix.enabled:
+            raise CommandError("OCCUPANCY_MATRIX isn't set.")
+
+        mismatches = occupancy_matrix.check()
+        for room_id, nights in mismatches.items():
+            self.stdout.write(self.style.ERROR(f"Room {room_id}: {len(nights)} nights disagree"))
+            for night, in_matrix, in_reservations in nights[:10]:
+                self.stdout.write(f"    {night}: {'taken' if in_matrix else 'free'} in the matrix, {'taken' if in_reservations else 'free'} in the reservations")
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("The occupancy matrix matches the reservations."))
+        elif options["repair"]:
+            occupancy_matrix.refresh_rooms(mismatches)
+            self.stdout.write(self.style.SUCCESS(f"Rows of {len(mismatches):,} rooms rewritten."))
+        else:
+            raise CommandError(f"{len(mismatches):,} rooms disagree, run with --repair to rewrite them.")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.storage import image_storage
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Removes the image blobs nothing references, e.g. the files of uploads whose transaction rolled back. "
+        "Run it now and then, from cron"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=float, default=3600, help="Seconds a file must be old, younger ones may belong to an open transaction")
+
+    def handle(self, *args, **options):
+        storage = image_storage()
+        if not hasattr(storage, "collect_orphans"):
+            raise CommandError("STORAGES['images'] isn't content-addressed.")
+
+        n_files = storage.collect_orphans(options["older_than"])
+        self.stdout.write(self.style.SUCCESS(f"{n_files:,} orphaned blobs removed."))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep
+import django
+import os
+
+from app import imagejobs
+
+
+
+class Command(BaseCommand):
+    help = "Resizes and renders the uploaded room and profile images waiting in the job queue, on a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+        parser.add_argument("--once", action="store_true", help="Stop once no job is due, e.g. when run from cron")
+        parser.add_argument("--poll", type=float, default=2.0, help="Seconds between looks at the queue when it's empty")
+
+    def handle(self, *args, **options):
+        results = Counter()
+
+        with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+            while True:
+                pks = imagejobs.due_jobs(limit=options["workers"] * 4)
+                if not pks:
+                    if options["once"]:
+                        break
+                    sleep(options["poll"])
+                    continue
+
+                connections.close_all() # The worker processes are forked from this one and can't share its connection
+                batch = Counter(pool.map(imagejobs.run_job, pks))
+                results.update(batch)
+                self.stdout.write(f"    {', '.join(f'{n:,} {result}' for result, n in sorted(batch.items()))}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{results['done']:,} images processed, {results['retry']:,} to be retried, {results['failed']:,} failed."
+        ))
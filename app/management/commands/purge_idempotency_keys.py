@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from app import idempotency
+
+
+
+class Command(BaseCommand):
+    help = "Deletes the expired idempotency keys"
+
+    def handle(self, *args, **options):
+        n_keys = idempotency.purge_expired()
+        self.stdout.write(self.style.SUCCESS(f"{n_keys:,} expired idempotency keys deleted."))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.occupancy import occupancy_matrix
+
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the shared occupancy matrix file from the room nights, the workers switch to it on their next lookup"
+
+    def handle(self, *args, **options):
+        if not occupancy_matrix.enabled:
+            raise CommandError("OCCUPANCY_MATRIX isn't set.")
+
+        occupancy_matrix.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Occupancy matrix rebuilt at {occupancy_matrix.path}."))
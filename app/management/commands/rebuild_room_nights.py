@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import availability
+
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the room night occupancy table from the active reservations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        n_nights = availability.rebuild_room_nights(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"{n_nights:,} room nights rebuilt."))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from app import models
+
+
+
+class Command(BaseCommand):
+    help = "Recomputes the stored amenity fee and price of every room in one pass"
+
+    def handle(self, *args, **options):
+        n_rooms = models.Room.objects.all().update_prices()
+        self.stdout.write(self.style.SUCCESS(f"Prices of {n_rooms:,} rooms rebuilt."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app import search
+
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the room full-text search index"
+
+    def handle(self, *args, **options):
+        if not search.fts_enabled():
+            self.stdout.write(self.style.WARNING("The full-text index needs SQLite with FTS5, searches fall back to LIKE lookups."))
+            return
+
+        n_rooms = search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"{n_rooms:,} rooms indexed."))
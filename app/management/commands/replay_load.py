@@ -0,0 +1,314 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import Client
+from django.urls import Resolver404, resolve, reverse
+from django.utils.crypto import get_random_string
+from django.utils.module_loading import import_string
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from random import Random
+from statistics import quantiles
+from time import perf_counter
+from urllib.parse import urlencode
+import asyncio
+import json
+
+from app import models
+
+
+MIX = "browse=50,search=20,book=15,checkin=8,checkout=7"
+SEARCH_WORDS = ["deluxe", "suite", "standard", "view", "balcony", "breakfast", "wifi", "pool", "family", "quiet"]
+
+
+
+def percentiles(timings:list) -> tuple:
+    """ p50, p95 and p99 of `timings` """
+    if len(timings) < 2:
+        return (timings * 3)[:3] or (0, 0, 0)
+    cuts = quantiles(timings, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays a recorded or synthetic mix of browse, search, book, check-in and check-out traffic against the "
+        "WSGI (threads) or ASGI (asyncio) application in-process, and reports the throughput, latency percentiles "
+        "and error and conflict rates per endpoint. The bookings and check-ins are real, run it against a scratch "
+        "database filled with seed_hotel."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interface", choices=["wsgi", "asgi"], default="wsgi", help="wsgi runs on threads, asgi on asyncio")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--requests", type=int, default=1000, help="Length of the synthetic trace")
+        parser.add_argument("--mix", default=MIX, help=f"Weights of the synthetic traffic, default {MIX}")
+        parser.add_argument("--users", type=int, default=50, help="Number of users the synthetic traffic signs in as")
+        parser.add_argument("--trace", help="Replay this JSON lines trace instead of a synthetic one")
+        parser.add_argument("--record", help="Write the synthetic trace here, to replay it again later")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["trace"]:
+            with open(options["trace"]) as file:
+                trace = [json.loads(line) for line in file if line.strip()]
+        else:
+            trace = self.synthetic_trace(options)
+
+        if options["record"]:
+            with open(options["record"], "w") as file:
+                file.writelines(json.dumps(entry) + "\n" for entry in trace)
+            self.stdout.write(f"Trace of {len(trace):,} requests written to {options['record']}")
+
+        if not trace:
+            raise CommandError("Nothing to replay.")
+
+        # Every user gets a session and a CSRF token up front, like a signed in browser
+        cookies = {}
+        for user in User.objects.filter(pk__in={entry["user"] for entry in trace if entry.get("user")}):
+            client = Client()
+            client.force_login(user)
+            cookies[user.pk] = {
+                settings.SESSION_COOKIE_NAME: client.cookies[settings.SESSION_COOKIE_NAME].value,
+                settings.CSRF_COOKIE_NAME: get_random_string(32),
+            }
+        connections.close_all()
+
+        if options["interface"] == "wsgi":
+            application = import_string(settings.WSGI_APPLICATION)
+            began = perf_counter()
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                results = list(pool.map(lambda entry: self.call_wsgi(application, entry, cookies), trace))
+        else:
+            application = import_string("main.asgi.application")
+            began = perf_counter()
+            results = asyncio.run(self.replay_asgi(application, trace, cookies, options["concurrency"]))
+        elapsed = perf_counter() - began
+
+        self.report(trace, results, elapsed, options)
+
+    def synthetic_trace(self, options) -> list:
+        """ Requests drawn from the --mix weights, against the rooms, users and reservations in the database """
+
+        rng = Random(options["seed"])
+        try:
+            mix = {kind: int(weight) for kind, weight in (part.split("=") for part in options["mix"].split(","))}
+        except ValueError:
+            raise CommandError("--mix must look like browse=50,search=20,...")
+        unknown = set(mix) - {"browse", "search", "book", "checkin", "checkout"}
+        if unknown:
+            raise CommandError(f"Unknown traffic in --mix: {', '.join(sorted(unknown))}")
+
+        rooms = list(models.Room.objects.values_list('pk', flat=True)[:1000])
+        users = list(User.objects.filter(is_active=True).order_by('pk').values_list('pk', flat=True)[:options["users"]])
+        if not rooms or not users:
+            raise CommandError("There are no rooms or users, fill the database with seed_hotel first.")
+
+        today = date.today()
+        not_checked_in = defaultdict(list)
+        checked_in = defaultdict(list)
+        for pk, user, date_checkin in models.Reservation.objects.filter(
+            user__in=users, date_checkout__isnull=True,
+        ).values_list('pk', 'user', 'date_checkin').iterator():
+            (checked_in if date_checkin else not_checked_in)[user].append(pk)
+
+        kinds, weights = list(mix), list(mix.values())
+        trace = []
+        for _ in range(options["requests"]):
+            kind = rng.choices(kinds, weights)[0]
+            user = rng.choice(users)
+            entry = {'kind': kind, 'user': user, 'method': "GET", 'data': {}}
+
+            if kind == "browse":
+                entry['path'] = rng.choice([
+                    reverse("app-index"),
+                    reverse("room:index"),
+                    reverse("room:view", args=[rng.choice(rooms)]),
+                    reverse("room:reservation:index"),
+                ])
+            elif kind == "search":
+                if rng.random() < 0.5:
+                    entry['path'], entry['data'] = reverse("room:index"), {'q': rng.choice(SEARCH_WORDS)}
+                else:
+                    date_bookfrom = today + timedelta(days=rng.randrange(1, 120))
+                    entry['path'] = reverse("room:search")
+                    entry['data'] = {
+                        'date_bookfrom': date_bookfrom.isoformat(),
+                        'date_bookuntil': (date_bookfrom + timedelta(days=rng.randint(1, 7))).isoformat(),
+                    }
+            elif kind == "book":
+                date_bookfrom = today + timedelta(days=rng.randrange(1, 120))
+                entry['method'] = "POST"
+                entry['path'] = reverse("room:view", args=[rng.choice(rooms)])
+                entry['data'] = {
+                    'date_bookfrom': date_bookfrom.isoformat(),
+                    'date_bookuntil': (date_bookfrom + timedelta(days=rng.randint(1, 7))).isoformat(),
+                }
+            else:
+                pending = not_checked_in if kind == "checkin" else checked_in
+                owners = [user for user in users if pending[user]]
+                if not owners: # Nothing left to check in or out, browse instead
+                    entry.update(kind="browse", path=reverse("room:reservation:index"))
+                else:
+                    entry['user'] = rng.choice(owners)
+                    reservation = pending[entry['user']].pop()
+                    if kind == "checkin":
+                        checked_in[entry['user']].append(reservation)
+                    entry['method'] = "POST"
+                    entry['path'] = reverse(f"room:reservation:{kind}", args=[reservation])
+
+            entry['path'] = str(entry['path'])
+            trace.append(entry)
+        return trace
+
+    def request_parts(self, entry:dict, cookies:dict):
+        """ The query string, body and headers of a trace entry """
+        cookie = dict(cookies.get(entry.get("user"), {}))
+        data = dict(entry.get("data", {}))
+        if entry["method"] == "POST" and settings.CSRF_COOKIE_NAME in cookie:
+            data["csrfmiddlewaretoken"] = cookie[settings.CSRF_COOKIE_NAME]
+
+        query, body = ("", urlencode(data, doseq=True).encode()) if entry["method"] == "POST" else (urlencode(data, doseq=True), b"")
+        headers = {
+            'host': "localhost",
+            'cookie': "; ".join(f"{name}={value}" for name, value in cookie.items()),
+            'content-type': "application/x-www-form-urlencoded",
+            'content-length': str(len(body)),
+        }
+        return query, body, headers
+
+    def call_wsgi(self, application, entry:dict, cookies:dict):
+        query, body, headers = self.request_parts(entry, cookies)
+        environ = {
+            'REQUEST_METHOD': entry["method"],
+            'PATH_INFO': entry["path"],
+            'QUERY_STRING': query,
+            'SERVER_NAME': "localhost",
+            'SERVER_PORT': "80",
+            'SERVER_PROTOCOL': "HTTP/1.1",
+            'REMOTE_ADDR': "127.0.0.1",
+            'CONTENT_TYPE': headers.pop('content-type'),
+            'CONTENT_LENGTH': headers.pop('content-length'),
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': StringIO(),
+            'wsgi.url_scheme': "http",
+            'wsgi.version': (1, 0),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            **{f"HTTP_{name.upper().replace('-', '_')}": value for name, value in headers.items()},
+        }
+        status = []
+
+        began = perf_counter()
+        try:
+            response = application(environ, lambda s, h, exc_info=None: status.append(int(s.split()[0])))
+            try:
+                for _ in response: # The body has to be consumed for streaming responses
+                    pass
+            finally:
+                if hasattr(response, "close"):
+                    response.close()
+        except Exception as e:
+            return perf_counter() - began, None, repr(e)
+        return perf_counter() - began, status[0], None
+
+    async def call_asgi(self, application, entry:dict, cookies:dict):
+        query, body, headers = self.request_parts(entry, cookies)
+        scope = {
+            'type': "http",
+            'asgi': {'version': "3.0"},
+            'http_version': "1.1",
+            'method': entry["method"],
+            'scheme': "http",
+            'path': entry["path"],
+            'raw_path': entry["path"].encode(),
+            'query_string': query.encode(),
+            'root_path': "",
+            'headers': [(name.encode(), value.encode()) for name, value in headers.items()],
+            'client': ("127.0.0.1", 0),
+            'server': ("localhost", 80),
+        }
+        status = []
+        done = asyncio.Event()
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': "http.request", 'body': body, 'more_body': False}
+            await done.wait() # The client only goes away once the response is complete
+            return {'type': "http.disconnect"}
+
+        async def send(message):
+            if message['type'] == "http.response.start":
+                status.append(message['status'])
+            elif message['type'] == "http.response.body" and not message.get('more_body'):
+                done.set()
+
+        began = perf_counter()
+        try:
+            await application(scope, receive, send)
+        except Exception as e:
+            return perf_counter() - began, None, repr(e)
+        finally:
+            done.set()
+        return perf_counter() - began, status[0] if status else None, None
+
+    async def replay_asgi(self, application, trace:list, cookies:dict, concurrency:int) -> list:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(entry):
+            async with semaphore:
+                return await self.call_asgi(application, entry, cookies)
+
+        return await asyncio.gather(*(limited(entry) for entry in trace))
+
+    def endpoint(self, entry:dict) -> str:
+        try:
+            name = resolve(entry["path"]).view_name
+        except Resolver404:
+            name = entry["path"]
+        return f"{entry['kind']} {entry['method']} {name}"
+
+    def report(self, trace:list, results:list, elapsed:float, options):
+        endpoints = defaultdict(lambda: {'timings': [], 'errors': 0, 'conflicts': 0})
+        exceptions = set()
+        for entry, (seconds, status, exception) in zip(trace, results):
+            stats = endpoints[self.endpoint(entry)]
+            stats['timings'].append(seconds * 1000)
+            if exception or status is None or status >= 500:
+                stats['errors'] += 1
+                if exception:
+                    exceptions.add(exception)
+            elif status == 409 or (entry["kind"] == "book" and status == 200):
+                # A booking that comes back as the form again was turned away by an overlap
+                stats['conflicts'] += 1
+            elif status >= 400:
+                stats['errors'] += 1
+
+        self.stdout.write(
+            f"{len(trace):,} requests over {options['interface'].upper()} with a concurrency of {options['concurrency']} "
+            f"in {elapsed:.2f}s, {len(trace) / elapsed:,.1f} requests/s"
+        )
+        self.stdout.write(f"    {'endpoint':<48} {'count':>6} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7} {'conflicts':>9}")
+        for name, stats in sorted(endpoints.items()):
+            count = len(stats['timings'])
+            p50, p95, p99 = percentiles(stats['timings'])
+            self.stdout.write(
+                f"    {name:<48} {count:>6} {count / elapsed:>8.1f} {p50:>7.1f}ms {p95:>7.1f}ms {p99:>7.1f}ms "
+                f"{stats['errors'] / count:>7.1%} {stats['conflicts'] / count:>9.1%}"
+            )
+
+        for exception in sorted(exceptions):
+            self.stdout.write(self.style.ERROR(f"    {exception}"))
+
+        n_errors = sum(stats['errors'] for stats in endpoints.values())
+        style = self.style.ERROR if n_errors else self.style.SUCCESS
+        self.stdout.write(style(f"{n_errors:,} errors."))
@@ -0,0 +1,231 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from datetime import date, timedelta
+from decimal import Decimal
+from heapq import heapify, heapreplace
+from random import Random
+from time import perf_counter
+from uuid import UUID
+
+from app import availability, models, search
+from app.occupancy import occupancy_matrix
+
+
+AMENITIES = [
+    ("WiFi", 0), ("Breakfast", 350), ("Minibar", 500), ("Ocean view", 1200), ("Balcony", 800),
+    ("Jacuzzi", 1500), ("Parking", 200), ("Airport shuttle", 900), ("Spa access", 1800), ("Gym access", 250),
+    ("Late checkout", 600), ("Room service", 400), ("Pet friendly", 700), ("Extra bed", 650), ("Smart TV", 150),
+    ("Kitchenette", 1000),
+]
+
+# (base price range, capacity range) of every room type
+ROOM_TYPES = {
+    models.Room.RoomTypes.STANDARD: ((1500, 3000), (1, 2)),
+    models.Room.RoomTypes.DELUXE: ((3500, 6000), (2, 4)),
+    models.Room.RoomTypes.SUITE: ((8000, 15000), (3, 6)),
+}
+
+DESCRIPTIONS = [
+    "A quiet room facing the garden, with a queen bed and a work desk.",
+    "Bright corner room with floor to ceiling windows and a city view.",
+    "Spacious room with a sitting area, blackout curtains and a rain shower.",
+    "Cozy room close to the pool, ideal for short stays.",
+    "Family friendly room with two double beds and a sofa bed.",
+    "Top floor room with a private terrace overlooking the bay.",
+]
+
+FIRST_NAMES = ["Maria", "Jose", "Ana", "Juan", "Andrea", "Mark", "Angel", "John", "Grace", "Paolo", "Camille", "Miguel"]
+LAST_NAMES = ["Santos", "Reyes", "Cruz", "Bautista", "Garcia", "Mendoza", "Torres", "Flores", "Ramos", "Villanueva"]
+
+STAY_NIGHTS = (1, 7)
+GAP_DAYS = (0, 3) # Days a room stays empty between two reservations
+PAST_SHARE = 0.9 # Share of each room's timeline that lies before today
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the database with synthetic users, amenities, rooms and non-overlapping reservations for load and scale testing. "
+        "The same seed always gives the same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--amenities", type=int, default=len(AMENITIES))
+        parser.add_argument("--rooms", type=int, default=200)
+        parser.add_argument("--reservations", type=int, default=100_000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--prefix", default="guest", help="Prefix of the generated usernames, they must not exist yet")
+
+    def handle(self, *args, **options):
+        if options["users"] < 1 or options["rooms"] < 1:
+            raise CommandError("At least one user and one room are needed.")
+        if User.objects.filter(username__startswith=f"{options['prefix']}_").exists():
+            raise CommandError(f"Users named {options['prefix']}_* already exist, pick another --prefix.")
+
+        self.rng = Random(options["seed"])
+        # The keys have a generator of their own that also depends on the prefix,
+        # so a second run with another prefix doesn't draw the keys of the first
+        self.keys = Random(f"{options['seed']}:{options['prefix']}")
+        self.batch_size = options["batch_size"]
+        began = perf_counter()
+
+        # bulk_create sends no post_save or m2m_changed signals, so what the
+        # signals would have done (profiles, room prices, the search index, the
+        # room nights) is done here in bulk instead. A run that fails leaves nothing behind
+        with transaction.atomic():
+            users = self.seed_users(options["users"], options["prefix"])
+            amenities = self.seed_amenities(options["amenities"])
+            rooms = self.seed_rooms(options["rooms"], amenities)
+            n_reservations = self.seed_reservations(options["reservations"], users, rooms)
+            self.seed_room_nights()
+        if occupancy_matrix.enabled:
+            occupancy_matrix.rebuild()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(users):,} users, {len(amenities):,} amenities, {len(rooms):,} rooms "
+            f"and {n_reservations:,} reservations in {perf_counter() - began:.1f}s."
+        ))
+
+    def uuid(self) -> UUID:
+        """ A random UUID4 drawn from the seeded generator, so reruns give the same keys """
+        return UUID(int=self.keys.getrandbits(128), version=4)
+
+    def bulk_create(self, model, objects:list) -> list:
+        created = []
+        for i in range(0, len(objects), self.batch_size):
+            with transaction.atomic():
+                created += model.objects.bulk_create(objects[i:i + self.batch_size])
+        return created
+
+    def seed_users(self, n:int, prefix:str) -> list:
+        start = perf_counter()
+        password = make_password("password") # Hashing is slow, every user shares the same one
+
+        users = []
+        for i in range(n):
+            first_name, last_name = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+            users.append(User(
+                username=f"{prefix}_{i}",
+                first_name=first_name,
+                last_name=last_name,
+                email=f"{prefix}_{i}@example.com",
+                password=password,
+            ))
+        users = self.bulk_create(User, users)
+
+        # Rule 1 of signals.py, every user has a profile
+        self.bulk_create(models.Profile, [models.Profile(uuid=self.uuid(), user=user) for user in users])
+
+        self.stdout.write(f"    {len(users):,} users and profiles in {perf_counter() - start:.1f}s")
+        return users
+
+    def seed_amenities(self, n:int) -> list:
+        amenities = []
+        for i in range(n):
+            name, fee = AMENITIES[i % len(AMENITIES)]
+            if i >= len(AMENITIES):
+                name = f"{name} {i // len(AMENITIES) + 1}"
+            amenities.append(models.Amenity(uuid=self.uuid(), name=name, fee=Decimal(fee)))
+        return self.bulk_create(models.Amenity, amenities)
+
+    def seed_rooms(self, n:int, amenities:list) -> list:
+        start = perf_counter()
+
+        rooms = []
+        room_amenities = []
+        for i in range(n):
+            type = self.rng.choice(list(ROOM_TYPES))
+            (low_price, high_price), (low_capacity, high_capacity) = ROOM_TYPES[type]
+            room = models.Room(
+                uuid=self.uuid(),
+                name=f"{type.label} {i // 50 + 1}{i % 50 + 1:02d}", # Floor and door number
+                description=self.rng.choice(DESCRIPTIONS),
+                type=type,
+                base_price=Decimal(self.rng.randrange(low_price, high_price + 1, 50)),
+                capacity=self.rng.randint(low_capacity, high_capacity),
+            )
+            rooms.append(room)
+            for amenity in self.rng.sample(amenities, self.rng.randint(0, min(6, len(amenities)))):
+                room_amenities.append(models.Room.amenities.through(room_id=room.pk, amenity_id=amenity.pk))
+
+        rooms = self.bulk_create(models.Room, rooms)
+        self.bulk_create(models.Room.amenities.through, room_amenities)
+
+        # Rule 3 and 4 of signals.py, the stored prices and the search index
+        pks = [room.pk for room in rooms]
+        for i in range(0, len(pks), self.batch_size):
+            batch = models.Room.objects.filter(pk__in=pks[i:i + self.batch_size])
+            batch.update_prices()
+            search.index_rooms(batch)
+        prices = dict(models.Room.objects.filter(pk__in=pks).values_list('pk', 'price'))
+        for room in rooms:
+            room.price = prices[room.pk]
+
+        self.stdout.write(f"    {len(rooms):,} rooms with {len(room_amenities):,} amenities in {perf_counter() - start:.1f}s")
+        return rooms
+
+    def seed_reservations(self, n:int, users:list, rooms:list) -> int:
+        """ Lays the reservations out on every room's timeline, earliest first, so no
+            room and no user is ever booked twice for the same night
+        """
+
+        start = perf_counter()
+        today = date.today()
+
+        # Going through the rooms by their next free night keeps the timelines
+        # in step, and lets each user only take stays after their last one
+        average_cycle = sum(STAY_NIGHTS) / 2 + sum(GAP_DAYS) / 2
+        first_night = today.toordinal() - int(n / len(rooms) * average_cycle * PAST_SHARE)
+        timeline = [(first_night + self.rng.randint(*GAP_DAYS), i) for i in range(len(rooms))]
+        heapify(timeline)
+        user_free = [0] * len(users) # The first night each user is free again
+
+        created = 0
+        batch = []
+        while created + len(batch) < n:
+            night, room_index = timeline[0]
+            nights = self.rng.randint(*STAY_NIGHTS)
+            heapreplace(timeline, (night + nights + self.rng.randint(*GAP_DAYS), room_index))
+
+            for _ in range(5):
+                user_index = self.rng.randrange(len(users))
+                if user_free[user_index] <= night:
+                    break
+            else:
+                continue # Everyone tried is away, the room stays empty
+            user_free[user_index] = night + nights
+
+            room = rooms[room_index]
+            date_bookfrom = date.fromordinal(night)
+            date_bookuntil = date_bookfrom + timedelta(days=nights)
+            batch.append(models.Reservation(
+                uuid=self.uuid(),
+                user=users[user_index],
+                room=room,
+                date_bookfrom=date_bookfrom,
+                date_bookuntil=date_bookuntil,
+                # Past stays are checked out, the current ones checked in
+                date_checkin=date_bookfrom if date_bookfrom <= today else None,
+                date_checkout=date_bookuntil if date_bookuntil < today else None,
+                paid_price=room.price * nights,
+            ))
+
+            if len(batch) == self.batch_size:
+                created += len(self.bulk_create(models.Reservation, batch))
+                batch = []
+                if created % (self.batch_size * 20) == 0:
+                    self.stdout.write(f"    {created:,} reservations...")
+
+        created += len(self.bulk_create(models.Reservation, batch))
+        self.stdout.write(f"    {created:,} reservations in {perf_counter() - start:.1f}s")
+        return created
+
+    def seed_room_nights(self):
+        start = perf_counter()
+        n_nights = availability.rebuild_room_nights(self.batch_size)
+        self.stdout.write(f"    {n_nights:,} room nights in {perf_counter() - start:.1f}s")
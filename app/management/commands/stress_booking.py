@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from random import Random
+from threading import Event
+from time import perf_counter
+from uuid import uuid4
+
+from app import models
+
+
+
+class Command(BaseCommand):
+    help = (
+        "Fires many simultaneous conflicting bookings through room_view and checks that exactly one wins per room. "
+        "Creates (and afterwards deletes) its own rooms and users, run it against a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=5, help="Number of contested rooms")
+        parser.add_argument("--attempts", type=int, default=200, help="Total number of booking attempts")
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            raise CommandError("An in-memory database can't be shared between threads.")
+
+        rng = Random(options["seed"])
+        tag = uuid4().hex[:8]
+        rooms = [
+            models.Room.objects.create(name=f"Stress {tag} {i}", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1)
+            for i in range(options["rooms"])
+        ]
+        users = [User.objects.create_user(f"stress_{tag}_{i}") for i in range(options["attempts"])]
+
+        # Every attempt asks for the same stay, only the room differs
+        date_bookfrom = date.today() + timedelta(days=30)
+        data = {'date_bookfrom': date_bookfrom, 'date_bookuntil': date_bookfrom + timedelta(days=2)}
+        attempts = [(user, rng.choice(rooms)) for user in users]
+        start = Event()
+
+        def attempt(args):
+            user, room = args
+            client = Client(HTTP_HOST="localhost")
+            client.force_login(user)
+            start.wait() # Line the first wave up
+            try:
+                response = client.post(reverse("room:view", args=[room.pk]), data)
+                return room.pk, response.status_code == 302
+            finally:
+                connections.close_all()
+
+        try:
+            began = perf_counter()
+            with ThreadPoolExecutor(max_workers=options["threads"]) as pool:
+                futures = [pool.submit(attempt, args) for args in attempts]
+                start.set()
+                results = [future.result() for future in futures]
+            elapsed = perf_counter() - began
+
+            wins = {room.pk: 0 for room in rooms}
+            for room_pk, won in results:
+                wins[room_pk] += won
+            booked = {
+                room.pk: models.Reservation.objects.filter(room=room, date_checkout__isnull=True).count()
+                for room in rooms
+            }
+
+            self.stdout.write(f"{len(attempts):,} attempts on {len(rooms)} rooms with {options['threads']} threads in {elapsed:.2f}s")
+            for room in rooms:
+                self.stdout.write(f"    {room.name}: {wins[room.pk]} won, {booked[room.pk]} booked")
+
+            contested = [room for room in rooms if any(r == room for _, r in attempts)]
+            wrong = [room.name for room in contested if wins[room.pk] != 1 or booked[room.pk] != 1]
+            if wrong:
+                raise CommandError(f"Not exactly one booking won in: {', '.join(wrong)}")
+            self.stdout.write(self.style.SUCCESS("Exactly one booking won per room."))
+        finally:
+            models.Room.objects.filter(pk__in=[room.pk for room in rooms]).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
@@ -0,0 +1,247 @@
+from django.conf import settings
+
+from bisect import bisect_left
+from pathlib import Path
+from threading import Lock
+from time import monotonic, time
+from uuid import uuid4
+import atexit
+import json
+import os
+
+
+# Every process writes its own values to METRICS_DIR/<this>.json, /metrics adds them all up
+_PROCESS = f"{os.getpid()}-{uuid4().hex[:8]}"
+
+_lock = Lock()
+_values = {} # (metric name, labels) -> value, or [bucket counts..., sum, count] for histograms
+_registry = []
+_last_flush = 0.0
+
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name:str, help:str, labelnames:tuple=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels:dict) -> tuple:
+        return self.name, tuple((name, str(labels[name])) for name in self.labelnames)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            _values[key] = _values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ A gauge that is summed over the live processes, e.g. the requests in flight """
+    type = "gauge"
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            _values[key] = _values.get(key, 0) + amount
+
+    def dec(self, amount:float=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name:str, help:str, labelnames:tuple=(), buckets:tuple=()):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts = _values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            counts[bisect_left(self.buckets, value)] += 1 # Cumulated when exported
+            counts[-2] += value
+            counts[-1] += 1
+
+
+
+# Requests (app/middleware.py)
+requests_in_flight = Gauge("hotel_http_requests_in_flight", "Requests being handled")
+requests = Counter("hotel_http_requests_total", "Requests handled", ("view", "method", "status"))
+request_duration = Histogram(
+    "hotel_http_request_duration_seconds", "Time taken to answer a request", ("view", "method"),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+request_queries = Histogram(
+    "hotel_http_request_db_queries", "SQL queries run by a request", ("view",),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+# Reservations (app/views.py)
+bookings = Counter("hotel_bookings_total", "Reservations made through room_view")
+booking_rejections = Counter(
+    "hotel_booking_rejections_total", "Bookings turned away by room_view", ("reason",), # room_overlap, user_overlap, busy or dates
+)
+checkins = Counter("hotel_checkins_total", "Reservations checked in")
+checkouts = Counter("hotel_checkouts_total", "Reservations checked out")
+
+# Room fragment cache (app/fragments.py), the hit ratio is hits / (hits + misses)
+fragment_cache = Counter("hotel_fragment_cache_lookups_total", "Cached room fragment lookups", ("fragment", "result")) # hit or miss
+
+# Uploaded image processing (app/imagejobs.py)
+image_jobs = Counter("hotel_image_jobs_total", "Image jobs run by the workers", ("result",)) # done, skipped, retry or failed
+
+
+
+def _directory():
+    directory = getattr(settings, "METRICS_DIR", None)
+    return Path(directory) if directory else None
+
+
+def flush(force:bool=False):
+    """ Writes this process's values to METRICS_DIR, at most every METRICS_FLUSH_INTERVAL seconds """
+    global _last_flush
+
+    directory = _directory()
+    if directory is None or (not force and monotonic() - _last_flush < getattr(settings, "METRICS_FLUSH_INTERVAL", 1)):
+        return
+
+    with _lock:
+        _last_flush = monotonic()
+        values = [[name, labels, value] for (name, labels), value in _values.items()]
+
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{_PROCESS}.json"
+    temporary = path.with_suffix(".tmp")
+    temporary.write_text(json.dumps({'time': time(), 'values': values}))
+    os.replace(temporary, path) # Readers never see half a file
+
+atexit.register(flush, force=True)
+
+
+def _add(total:dict, key:tuple, value):
+    if isinstance(value, list):
+        current = total.setdefault(key, [0] * len(value))
+        for i, v in enumerate(value):
+            current[i] += v
+    else:
+        total[key] = total.get(key, 0) + value
+
+
+def _alive(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # Another user's
+        return True
+    return True
+
+
+def adopt_dead(directory:Path):
+    """ Takes the counters and histograms of the processes of this host that have exited into this one's, and removes their files
+
+    Each file is renamed before it's read, so only one process adopts it.
+    Their gauges went with them.
+    """
+
+    gauges = {metric.name for metric in _registry if metric.type == "gauge"}
+    adopted = []
+    for path in list(directory.glob("*.json")) + list(directory.glob("*.tmp")):
+        pid = path.stem.split("-")[0]
+        if path.stem == _PROCESS or not pid.isdigit() or _alive(int(pid)):
+            continue
+        claimed = path.with_name(f"{path.name}.{_PROCESS}.adopted")
+        try:
+            os.rename(path, claimed)
+        except OSError: # Adopted by another process
+            continue
+        try:
+            data = json.loads(claimed.read_text()) if path.suffix == ".json" else {'values': []}
+        except (OSError, ValueError):
+            data = {'values': []}
+        with _lock:
+            for name, labels, value in data['values']:
+                if name not in gauges:
+                    _add(_values, (name, tuple(tuple(label) for label in labels)), value)
+        adopted.append(claimed)
+
+    if adopted:
+        flush(force=True) # Before the files go, so the values are never lost in between
+        for claimed in adopted:
+            claimed.unlink(missing_ok=True)
+
+
+def collect() -> dict:
+    """ The values of every process added up. Gauges of processes that haven't written in a while are left out """
+
+    gauges = {metric.name for metric in _registry if metric.type == "gauge"}
+    stale = time() - getattr(settings, "METRICS_GAUGE_TTL", 60)
+    total = {}
+
+    directory = _directory()
+    if directory and directory.exists():
+        adopt_dead(directory)
+
+    with _lock:
+        for key, value in _values.items():
+            _add(total, key, list(value) if isinstance(value, list) else value)
+
+    for path in directory.glob("*.json") if directory and directory.exists() else []:
+        if path.stem == _PROCESS:
+            continue
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError): # Removed or being replaced
+            continue
+        for name, labels, value in data['values']:
+            if name in gauges and data['time'] < stale:
+                continue
+            _add(total, (name, tuple(tuple(label) for label in labels)), value)
+
+    return total
+
+
+def _labels(labels, extra:tuple=()) -> str:
+    labels = tuple(labels) + extra
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def render() -> str:
+    """ Every metric in the Prometheus text format """
+
+    total = collect()
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        series = sorted((labels, value) for (name, labels), value in total.items() if name == metric.name)
+        if not series and not metric.labelnames and metric.type != "histogram":
+            series = [((), 0)]
+
+        for labels, value in series:
+            if metric.type != "histogram":
+                lines.append(f"{metric.name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append(f"{metric.name}_bucket{_labels(labels, (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(labels)} {_number(value[-2])}")
+            lines.append(f"{metric.name}_count{_labels(labels)} {value[-1]}")
+
+    return "\n".join(lines) + "\n"
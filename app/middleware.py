@@ -0,0 +1,339 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse
+from django.template import base
+from django.template.backends.django import Template
+from django.utils import timezone
+
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from io import StringIO
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+import cProfile
+import json
+import logging
+import pstats
+import re
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# The timings of the request being handled, None outside of RequestTimingMiddleware
+_timings = ContextVar("request_timings", default=None)
+
+# The template profile of the request being handled, None outside of RequestProfilerMiddleware
+_template_profile = ContextVar("template_profile", default=None)
+
+
+
+class RequestTimings:
+    """ What a single request spent its time on """
+
+    def __init__(self):
+        self.queries = Counter() # Normalized SQL -> times run
+        self.query_count = 0
+        self.db = 0.0
+        self.template = 0.0
+        self.view = 0.0
+        self.total = 0.0
+
+    @property
+    def duplicates(self) -> list:
+        """ [(normalized SQL, times run)] of the queries that ran more than once, e.g. an N+1 """
+        return [(sql, count) for sql, count in self.queries.most_common() if count > 1]
+
+    def server_timing(self) -> str:
+        metrics = [
+            f'db;dur={self.db * 1000:.1f};desc="{self.query_count} queries"',
+            f'tpl;dur={self.template * 1000:.1f};desc="Templates"',
+            f'view;dur={self.view * 1000:.1f};desc="View"',
+            f'total;dur={self.total * 1000:.1f};desc="Total"',
+        ]
+        if self.duplicates:
+            metrics.append(f'dup;desc="{sum(count for _, count in self.duplicates)} duplicate queries"')
+        return ", ".join(metrics)
+
+
+
+def normalize_sql(sql:str) -> str:
+    """ The shape of a query, without its literals, so the same query with other parameters counts as a duplicate """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)", "(...)", sql) # IN lists of any length
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _record_query(execute, sql, params, many, context):
+    timings = _timings.get()
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if timings is not None:
+            timings.db += perf_counter() - start
+            timings.query_count += 1
+            timings.queries[normalize_sql(sql)] += 1
+
+
+_render = Template.render
+
+def _timed_render(self, context=None, request=None):
+    """ Template.render of the Django backend, timed. Included templates render inside it so they aren't counted twice """
+    timings = _timings.get()
+    if timings is None:
+        return _render(self, context, request)
+
+    start = perf_counter()
+    try:
+        return _render(self, context, request)
+    finally:
+        timings.template += perf_counter() - start
+
+
+
+class RequestTimingMiddleware:
+    """ Adds the query count and the DB, template, view and total time of a request as
+        Server-Timing headers and logs them as one JSON line, together with the duplicate queries
+
+    Only installed when REQUEST_TIMING is on, otherwise Django drops it from
+    the chain and it costs nothing. It should be the first middleware so the
+    total covers the others.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "REQUEST_TIMING", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        Template.render = _timed_render
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        request.timings = timings
+        start = perf_counter()
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(_record_query))
+                response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+
+        timings.total = perf_counter() - start
+        if hasattr(request, "view_start"):
+            timings.view = perf_counter() - request.view_start
+
+        response["Server-Timing"] = timings.server_timing()
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': timings.query_count,
+            'db_ms': round(timings.db * 1000, 1),
+            'template_ms': round(timings.template * 1000, 1),
+            'view_ms': round(timings.view * 1000, 1),
+            'total_ms': round(timings.total * 1000, 1),
+            'duplicates': [{'sql': sql, 'count': count} for sql, count in timings.duplicates],
+        }))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # The view runs right after the other middlewares' process_view
+        request.view_start = perf_counter()
+
+
+
+class TemplateProfile:
+    """ The time spent in every template file of a request, without the templates it includes """
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counts = Counter()
+        self.stack = [] # [name, start, time spent in included templates] of the templates being rendered
+
+    def enter(self, name:str):
+        self.stack.append([name, perf_counter(), 0.0])
+
+    def exit(self):
+        name, start, children = self.stack.pop()
+        elapsed = perf_counter() - start
+        self.times[name] += elapsed - children
+        self.counts[name] += 1
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+
+_base_render = base.Template.render
+_profiles_running = 0 # Profiled requests being handled, by any thread
+_profiles_lock = Lock()
+
+def _profiled_render(self, context):
+    """ base.Template.render, timed per template file. Included templates go through it too """
+    profile = _template_profile.get()
+    if profile is None:
+        return _base_render(self, context)
+
+    profile.enter(self.origin.template_name or self.origin.name if self.origin else "<string>")
+    try:
+        return _base_render(self, context)
+    finally:
+        profile.exit()
+
+
+@contextmanager
+def _profiling_templates():
+    """ Swaps _profiled_render in while at least one profiled request is being handled, so the others don't go through it """
+    global _profiles_running
+    with _profiles_lock:
+        if not _profiles_running:
+            base.Template.render = _profiled_render
+        _profiles_running += 1
+    try:
+        yield
+    finally:
+        with _profiles_lock:
+            _profiles_running -= 1
+            if not _profiles_running:
+                base.Template.render = _base_render
+
+
+
+class RequestProfilerMiddleware:
+    """ Answers a staff user's request with ?_profile=1 with a cProfile report of it instead of the page
+
+    The report breaks the time down by app.views function, SQL query and
+    template file, followed by the slowest functions. With PROFILE_DIR set
+    every profile is also saved there as a .prof file, for pstats, snakeviz
+    or a flame graph. Other requests only pay for the query string lookup,
+    templates only go through the profiler while a profile is running.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.GET.get("_profile") != "1" or not request.user.is_staff:
+            return self.get_response(request)
+
+        templates = TemplateProfile()
+        token = _template_profile.set(templates)
+        queries = []
+
+        def record_query(execute, sql, params, many, context):
+            start = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append((perf_counter() - start, sql))
+
+        profiler = cProfile.Profile()
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(_profiling_templates())
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_query))
+                profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profiler.disable()
+        finally:
+            _template_profile.reset(token)
+        total = perf_counter() - start
+
+        path = self.save(request, profiler)
+        report = self.report(request, response, profiler, queries, templates, total, path)
+        return HttpResponse(report, content_type="text/plain; charset=utf-8")
+
+    def save(self, request, profiler):
+        """ Saves the profile to PROFILE_DIR, if it's set """
+        directory = getattr(settings, "PROFILE_DIR", None)
+        if not directory:
+            return None
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        name = re.sub(r"[^\w-]+", "_", request.path).strip("_") or "index"
+        path = Path(directory) / f"{timezone.now():%Y%m%d-%H%M%S-%f}-{name}.prof"
+        profiler.dump_stats(path)
+        return path
+
+    def report(self, request, response, profiler, queries, templates, total, path) -> str:
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+
+        out.write(f"{request.method} {request.get_full_path()} -> {response.status_code} in {total * 1000:.1f}ms\n")
+        if path:
+            out.write(f"Saved to {path}\n")
+
+        # Cumulative time of the view functions, from the profile
+        out.write("\nViews (app/views.py, cumulative)\n")
+        views_file = str(Path(__file__).with_name("views.py"))
+        view_rows = [
+            (cumulative, calls, function)
+            for (filename, _, function), (_, calls, _, cumulative, _) in stats.stats.items()
+            if filename == views_file and function != "<module>"
+        ]
+        for cumulative, calls, function in sorted(view_rows, reverse=True):
+            out.write(f"    {cumulative * 1000:>9.1f}ms {calls:>6}x  {function}\n")
+
+        db_time = sum(seconds for seconds, _ in queries)
+        out.write(f"\nSQL: {len(queries)} queries in {db_time * 1000:.1f}ms\n")
+        by_sql = defaultdict(lambda: [0, 0.0])
+        for seconds, sql in queries:
+            by_sql[normalize_sql(sql)][0] += 1
+            by_sql[normalize_sql(sql)][1] += seconds
+        for sql, (count, seconds) in sorted(by_sql.items(), key=lambda item: -item[1][1])[:15]:
+            out.write(f"    {seconds * 1000:>9.1f}ms {count:>6}x  {sql[:160]}\n")
+
+        out.write(f"\nTemplates: {sum(templates.times.values()) * 1000:.1f}ms (own time, without included templates)\n")
+        for name, seconds in sorted(templates.times.items(), key=lambda item: -item[1]):
+            out.write(f"    {seconds * 1000:>9.1f}ms {templates.counts[name]:>6}x  {name}\n")
+
+        out.write("\nSlowest functions\n")
+        stats.sort_stats("cumulative").print_stats(40)
+        return out.getvalue()
+
+
+
+class MetricsMiddleware:
+    """ Feeds the request metrics of /metrics (see metrics.py): requests in flight, and the
+        latency, status and query count of every request by URL name
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "METRICS_ENABLED", True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        n_queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal n_queries
+            n_queries += 1
+            return execute(sql, params, many, context)
+
+        metrics.requests_in_flight.inc()
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count_query))
+                response = self.get_response(request)
+        finally:
+            metrics.requests_in_flight.dec()
+
+        view = request.resolver_match.view_name if request.resolver_match else "<unresolved>"
+        metrics.request_duration.observe(perf_counter() - start, view=view, method=request.method)
+        metrics.request_queries.observe(n_queries, view=view)
+        metrics.requests.inc(view=view, method=request.method, status=response.status_code)
+        metrics.flush()
+        return response
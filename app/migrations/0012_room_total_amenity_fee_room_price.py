@@ -0,0 +1,49 @@
+# Generated by Django 5.2 on 2026-10-18 09:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def compute_prices(apps, schema_editor):
+    Amenity = apps.get_model('app', 'Amenity')
+    Room = apps.get_model('app', 'Room')
+
+    amenity_fees = (
+        Amenity.objects
+        .filter(rooms=models.OuterRef('pk'))
+        .values('rooms')
+        .annotate(total=models.Sum('fee'))
+        .values('total')
+    )
+    total_amenity_fee = Coalesce(
+        models.Subquery(amenity_fees),
+        models.Value(Decimal(0)),
+        output_field=models.DecimalField(max_digits=10, decimal_places=2),
+    )
+    Room.objects.update(
+        total_amenity_fee=total_amenity_fee,
+        price=models.F('base_price') + total_amenity_fee,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_alter_amenity_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='total_amenity_fee',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.RunPython(compute_prices, migrations.RunPython.noop),
+    ]
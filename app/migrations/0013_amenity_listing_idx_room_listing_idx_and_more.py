@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-18 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_room_total_amenity_fee_room_price'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='amenity',
+            index=models.Index(fields=['date_update', 'uuid'], name='amenity_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['date_update', 'uuid'], name='room_listing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['user', 'date_bookfrom', 'uuid'], name='reservation_listing_idx'),
+        ),
+    ]
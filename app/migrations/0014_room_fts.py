@@ -0,0 +1,54 @@
+# Generated by Django 5.2 on 2026-10-18 11:20
+
+from django.db import migrations
+
+
+def create_room_fts(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return # Other backends fall back to LIKE lookups, see app/search.py
+
+    Room = apps.get_model('app', 'Room')
+    labels = {"ST": "Standard", "DL": "Deluxe", "SU": "Suite"}
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE VIRTUAL TABLE app_room_fts USING fts5("
+            "uuid UNINDEXED, name, description, type, amenities, "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        cursor.executemany(
+            "INSERT INTO app_room_fts (rowid, uuid, name, description, type, amenities) VALUES (%s, %s, %s, %s, %s, %s)",
+            [
+                [
+                    room.pk.int >> 65, # See app.search._rowid
+                    room.pk.hex,
+                    room.name,
+                    room.description,
+                    labels.get(room.type, room.type),
+                    " ".join(amenity.name for amenity in room.amenities.all()),
+                ]
+                for room in Room.objects.prefetch_related('amenities')
+            ],
+        )
+
+
+def drop_room_fts(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS app_room_fts")
+    connection.room_fts_enabled = False
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_amenity_listing_idx_room_listing_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_room_fts, drop_room_fts),
+    ]
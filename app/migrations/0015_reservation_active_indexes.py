@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_room_fts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('date_checkout__isnull', True)), fields=['room', 'date_bookfrom', 'date_bookuntil'], name='reservation_room_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('date_checkout__isnull', True)), fields=['user', 'date_bookfrom', 'date_bookuntil'], name='reservation_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('date_checkout__isnull', True)), fields=['date_bookfrom', 'date_bookuntil'], name='reservation_active_idx'),
+        ),
+    ]
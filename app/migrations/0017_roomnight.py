@@ -0,0 +1,51 @@
+# Generated by Django 5.2 on 2026-10-18 18:05
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_room_nights(apps, schema_editor):
+    """ The nights of the active reservations, as availability.rebuild_room_nights() fills them """
+    Reservation = apps.get_model('app', 'Reservation')
+    RoomNight = apps.get_model('app', 'RoomNight')
+
+    rows = (
+        Reservation.objects
+        .filter(date_checkout__isnull=True)
+        .values_list('pk', 'room_id', 'date_bookfrom', 'date_bookuntil')
+    )
+    batch = []
+    for pk, room_id, date_bookfrom, date_bookuntil in rows.iterator(chunk_size=5000):
+        batch.extend(
+            RoomNight(room_id=room_id, reservation_id=pk, date=date_bookfrom + timedelta(days=i))
+            for i in range((date_bookuntil - date_bookfrom).days)
+        )
+        if len(batch) >= 5000:
+            RoomNight.objects.bulk_create(batch)
+            batch = []
+    RoomNight.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomNight',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='nights', to='app.reservation')),
+                ('room', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='nights', to='app.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'date'], name='roomnight_room_date_idx'), models.Index(fields=['date', 'room'], name='roomnight_date_room_idx')],
+            },
+        ),
+        migrations.RunPython(fill_room_nights, migrations.RunPython.noop),
+    ]
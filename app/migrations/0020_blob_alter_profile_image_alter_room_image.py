@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 22:30
+
+import app.storage
+import django.core.validators
+import django_resized.forms
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_imagejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('references', models.PositiveIntegerField(default=0)),
+                ('size', models.PositiveBigIntegerField()),
+                ('date_add', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='image',
+            field=django_resized.forms.ResizedImageField(blank=True, crop=['middle', 'center'], default='default.png', force_format='JPEG', keep_meta=True, null=True, quality=90, scale=0.5, size=[200, 200], storage=app.storage.image_storage, upload_to='images/profiles', validators=[django.core.validators.FileExtensionValidator(['png', 'jpg', 'jpeg', 'jfif', 'PNG', 'JPG'])]),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='image',
+            field=django_resized.forms.ResizedImageField(blank=True, crop=None, default='default.png', force_format='JPEG', keep_meta=True, null=True, quality=90, scale=0.5, size=[1920, 1080], storage=app.storage.image_storage, upload_to='images/rooms/', validators=[django.core.validators.FileExtensionValidator(['png', 'jpg', 'jpeg', 'jfif', 'PNG', 'JPG'])]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-18 23:05
+
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    """ The row inventory.bump() counts on """
+    apps.get_model("app", "InventoryVersion").objects.create(pk=1, version=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_blob_alter_profile_image_alter_room_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryVersion',
+            fields=[
+                ('id', models.PositiveSmallIntegerField(default=1, primary_key=True, serialize=False)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
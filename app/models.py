@@ -1,11 +1,16 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django_resized import ResizedImageField
 from django.core import validators
+from django.db.models.functions import Coalesce
 from datetime import date
+from decimal import Decimal
 
 from uuid import uuid4
 
+from .storage import image_storage
+
 
 
 class Profile(models.Model):
@@ -18,10 +23,12 @@ class Profile(models.Model):
         size = [200, 200],
         crop = ['middle', 'center'],
         upload_to = 'images/profiles',
+        storage = image_storage,
         blank = True,
         null = True,
         default = "default.png",
     )
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False) # The smaller copies of the image (see renditions.py)
 
     date_add = models.DateTimeField(auto_now_add=True)
     date_update = models.DateTimeField(auto_now=True)
@@ -40,6 +47,9 @@ class Amenity(models.Model):
 
     class Meta:
         verbose_name_plural = "Amenities" # The text you see in the django admin panel
+        indexes = [
+            models.Index(fields=['date_update', 'uuid'], name='amenity_listing_idx'), # Keyset pagination order
+        ]
 
     uuid = models.UUIDField(primary_key=True, editable=False, auto_created=True, default=uuid4)
     name = models.CharField(max_length=100,
@@ -65,46 +75,101 @@ class Amenity(models.Model):
 
 
 
+class RoomQuerySet(models.QuerySet):
+    def with_listing(self):
+        """ Prefetches what the room listings show, so they render in a constant number of queries
+
+        The active reservations are stored on each room as `active_reservations`.
+        """
+        return self.prefetch_related(
+            'amenities',
+            models.Prefetch(
+                'reservations',
+                queryset=Reservation.objects.filter(date_checkout__isnull=True).order_by('date_bookfrom'),
+                to_attr='active_reservations',
+            ),
+        )
+
+    def update_prices(self) -> int:
+        """ Recomputes the stored amenity fee and price of the rooms in a single UPDATE """
+        amenity_fees = (
+            Amenity.objects
+            .filter(rooms=models.OuterRef('pk'))
+            .values('rooms')
+            .annotate(total=models.Sum('fee'))
+            .values('total')
+        )
+        total_amenity_fee = Coalesce(
+            models.Subquery(amenity_fees),
+            models.Value(Decimal(0)),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        )
+        return self.update(
+            total_amenity_fee=total_amenity_fee,
+            price=models.F('base_price') + total_amenity_fee,
+        )
+
+
+
 class Room(models.Model):
     class RoomTypes(models.TextChoices):
         STANDARD = "ST", "Standard"
         DELUXE = "DL", "Deluxe"
         SUITE = "SU", "Suite"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_update', 'uuid'], name='room_listing_idx'), # Keyset pagination order
+        ]
+
     uuid = models.UUIDField(primary_key=True, editable=False, auto_created=True, default=uuid4)
     image = ResizedImageField(
         validators=[validators.FileExtensionValidator(['png', 'jpg', 'jpeg', 'jfif', 'PNG', 'JPG'])],
         upload_to = "images/rooms/",
+        storage = image_storage,
         blank = True,
         null = True,
         default = "default.png",
     )
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False) # The smaller copies of the image (see renditions.py)
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     type = models.CharField(choices=RoomTypes.choices)
     amenities = models.ManyToManyField(Amenity, blank=True, related_name="rooms")
     base_price = models.DecimalField(max_digits=10, decimal_places=2)
     capacity = models.IntegerField()
+    # Kept up to date by the amenity signals (see signals.py), so showing a
+    # price never has to go through the amenities
+    total_amenity_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False) # The total fee of all the amenities
+    price = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False) # The base price plus the total amenity fee
     date_add = models.DateTimeField(auto_now_add=True)
     date_update = models.DateTimeField(auto_now=True)
-    
-    @property
-    def total_amenity_fee(self) -> float:
-        """ The total fee of all the amenities """
-        total = 0
-        # Adds all amenity fees is there are any
-        if self.amenities.all():
-            for amenity in self.amenities.all():
-                total += amenity.fee
-        return total
 
-    @property
-    def price(self) -> float:
-        """ The total price of the room, including the base price and the total amenity fee """
-        if self.amenities.exists():
-            return self.base_price + self.total_amenity_fee 
+    objects = RoomQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if self._state.adding: # No amenities yet
+            self.price = self.base_price + self.total_amenity_fee
+            return super().save(*args, **kwargs)
+
+        # The stored fee and price belong to the amenity signals (see signals.py). An instance
+        # loaded before they last ran would write stale ones back, so they're left out of the
+        # UPDATE and worked out again from the amenities, in case the base price changed
+        stored = ('total_amenity_fee', 'price')
+        update_fields = kwargs.pop('update_fields', None)
+        if update_fields is None:
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in stored and field.attname not in deferred
+            ]
         else:
-            return self.base_price
+            update_fields = [name for name in update_fields if name not in stored]
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+        if 'base_price' in update_fields:
+            Room.objects.filter(pk=self.pk).update_prices()
+        self.refresh_from_db(fields=stored)
     
     @property
     def get_price_display(self) -> str:
@@ -130,6 +195,27 @@ class Room(models.Model):
 
 
 class Reservation(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'date_bookfrom', 'uuid'], name='reservation_listing_idx'), # Keyset pagination order
+            # Only the active (not checked out) reservations take part in the overlap checks and listings
+            models.Index(
+                fields=['room', 'date_bookfrom', 'date_bookuntil'],
+                condition=models.Q(date_checkout__isnull=True),
+                name='reservation_room_active_idx',
+            ),
+            models.Index(
+                fields=['user', 'date_bookfrom', 'date_bookuntil'],
+                condition=models.Q(date_checkout__isnull=True),
+                name='reservation_user_active_idx',
+            ),
+            models.Index(
+                fields=['date_bookfrom', 'date_bookuntil'],
+                condition=models.Q(date_checkout__isnull=True),
+                name='reservation_active_idx',
+            ),
+        ]
+
     uuid = models.UUIDField(primary_key=True, editable=False, auto_created=True, default=uuid4)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="reservations") 
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="reservations")
@@ -162,3 +248,124 @@ class Reservation(models.Model):
 
     def __str__(self) -> str:
         return f"{self.__class__.__name__}: {self.room.name=}"
+
+
+
+class RoomNight(models.Model):
+    """ A night a room is taken by an active reservation, one row per night
+
+    Kept in sync with the reservations (see signals.py) so the free and busy
+    nights of a room over any range are one indexed lookup instead of going
+    through every reservation's dates. Rebuilt by `manage.py rebuild_room_nights`.
+    """
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'date'], name='roomnight_room_date_idx'),
+            models.Index(fields=['date', 'room'], name='roomnight_date_room_idx'), # Every room over a range
+        ]
+
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="nights", db_index=False) # Covered by the (room, date) index
+    reservation = models.ForeignKey(Reservation, on_delete=models.CASCADE, related_name="nights")
+    date = models.DateField() # The night from this date to the next
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.room_id=}, {self.date=}, {self.reservation_id=})"
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}: {self.date}"
+
+
+class InventoryVersion(models.Model):
+    """ One row, counting the changes to the rooms and their taken nights, that the availability API's ETags are made of (see inventory.py) """
+
+    id = models.PositiveSmallIntegerField(primary_key=True, default=1)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.version=})"
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}: {self.version}"
+
+
+class IdempotencyKey(models.Model):
+    """ The first response to a POST sent with an idempotency key, replayed on retries """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+
+    uuid = models.UUIDField(primary_key=True, editable=False, auto_created=True, default=uuid4)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="idempotency_keys")
+    key = models.CharField(max_length=255)
+    path = models.CharField(max_length=255) # The key can't be reused on another URL
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True) # Empty while the first request is still running
+    content_type = models.CharField(max_length=255, blank=True)
+    location = models.CharField(max_length=2048, blank=True) # Where a redirect went
+    content = models.BinaryField(blank=True)
+    date_add = models.DateTimeField(auto_now_add=True)
+    date_expire = models.DateTimeField(db_index=True)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.user_id=}, {self.key=}, {self.path=}, {self.status_code=}, {self.date_expire=})"
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}: {self.key}"
+
+
+
+class ImageJob(models.Model):
+    """ An uploaded room or profile image waiting to be resized and rendered by the image workers (see imagejobs.py)
+
+    There's one per image field, a new upload queues it again.
+    """
+
+    class Statuses(models.TextChoices):
+        PENDING = "PE", "Pending"
+        RUNNING = "RU", "Running"
+        DONE = "DO", "Done"
+        FAILED = "FA", "Failed"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id'], name='unique_image_job'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='imagejob_due_idx'),
+        ]
+
+    uuid = models.UUIDField(primary_key=True, editable=False, auto_created=True, default=uuid4)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE) # Room or Profile
+    object_id = models.UUIDField()
+    source = models.CharField(max_length=255) # The name the upload was stored under, as it was sent
+    status = models.CharField(max_length=2, choices=Statuses.choices, default=Statuses.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True) # Of the last failed attempt
+    run_after = models.DateTimeField() # Retries wait a while
+    date_claimed = models.DateTimeField(blank=True, null=True) # When a worker took it
+    date_add = models.DateTimeField(auto_now_add=True)
+    date_update = models.DateTimeField(auto_now=True)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.content_type_id=}, {self.object_id=}, {self.source=}, {self.status=}, {self.attempts=})"
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}: {self.source}"
+
+
+
+class Blob(models.Model):
+    """ A file of the content-addressed image storage, and how many references to it are left (see storage.py) """
+
+    name = models.CharField(max_length=255, primary_key=True) # blobs/<ab>/<cd>/<sha256>.<extension>
+    references = models.PositiveIntegerField(default=0) # Removed with its file when it drops to 0
+    size = models.PositiveBigIntegerField()
+    date_add = models.DateTimeField(auto_now_add=True)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.name=}, {self.references=}, {self.size=})"
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}: {self.name}"
@@ -0,0 +1,327 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from contextlib import contextmanager
+from datetime import date, timedelta
+from pathlib import Path
+from threading import RLock
+from time import sleep
+from uuid import UUID
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+from . import models
+
+
+# File layout: a header, the UUIDs of the rooms by row, then one bit per room and
+# night, row by row. Night i of a row is bit i % 8 of its byte i // 8.
+MAGIC = b"HOTELOCC"
+LAYOUT = 1
+HEADER = struct.Struct("<8sIIQIII") # magic, layout, flags, generation, first night (ordinal), nights, capacity
+HEADER_SIZE = 64
+ROOMS_USED = struct.Struct("<I") # Rows taken so far, right after the header
+ROOMS_USED_AT = HEADER.size
+GENERATION_AT = 16
+FLAGS_AT = 12
+REPLACED = 1 # Set on the old file once a rebuild swapped in a new one
+
+REBUILD_AFTER_DAYS = 30 # The window is moved forward once its first night is this far behind
+READ_RETRIES = 1000 # Reads given up on (and left to the database) when a writer died halfway
+
+
+
+class OccupancyMatrix:
+    """ A rooms × nights bitmap of the taken nights, in a memory-mapped file shared by every worker
+
+    Reads go straight to the mapped pages, without the database or the file lock.
+    Writers take an exclusive lock on a separate .lock file, make the
+    generation counter odd, change the bits and make it even again, so a
+    reader that saw the generation change while it read (a seqlock) just
+    reads again. A room's row is always rewritten from the committed room
+    nights while the lock is held, so the last writer leaves it right.
+
+    Only covers OCCUPANCY_MATRIX_NIGHTS nights from the day it was built,
+    lookups outside of them return None and the callers go to the database.
+    """
+
+    def __init__(self):
+        self.lock = RLock() # Threads of this process, the file lock is per process
+        self.path = None
+        self.file = None
+        self.map = None
+        self.view = None # A memoryview of the map, so reads slice the pages without copying them
+        self.rows = {} # Room pk -> row
+        self.lock_depth = 0 # flock() isn't reentrant across open() calls, so nested locks reuse the outer one
+
+    @property
+    def enabled(self) -> bool:
+        return bool(getattr(settings, "OCCUPANCY_MATRIX", None))
+
+    # Layout
+
+    def _header(self) -> tuple:
+        magic, layout, flags, generation, first_night, nights, capacity = HEADER.unpack_from(self.map, 0)
+        return flags, generation, first_night, nights, capacity
+
+    def _row_bytes(self, nights:int) -> int:
+        return (nights + 7) // 8
+
+    def _bits_at(self, capacity:int) -> int:
+        return HEADER_SIZE + capacity * 16
+
+    def _generation(self) -> int:
+        return struct.unpack_from("<Q", self.map, GENERATION_AT)[0]
+
+    def _set_generation(self, generation:int):
+        struct.pack_into("<Q", self.map, GENERATION_AT, generation)
+
+    # Opening and locking
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            raise ImproperlyConfigured("OCCUPANCY_MATRIX needs fcntl file locks, which this platform doesn't have.")
+        with self.lock:
+            if self.lock_depth:
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+
+            with open(f"{self.path}.lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth = 0
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _close(self):
+        if self.map is not None:
+            self.view.release()
+            self.map.close()
+            self.file.close()
+        self.file = self.map = self.view = None
+        self.rows = {}
+
+    def _open(self):
+        self._close()
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.view = memoryview(self.map)
+        magic, layout = HEADER.unpack_from(self.map, 0)[:2]
+        if magic != MAGIC or layout != LAYOUT:
+            self._close()
+            raise ValueError(f"{self.path} isn't an occupancy matrix.")
+
+    def _ensure_open(self):
+        """ Maps the file, building it first if there's none, and follows rebuilds by other processes """
+
+        path = str(settings.OCCUPANCY_MATRIX)
+        with self.lock:
+            if self.map is not None and self.path == path and not self._header()[0] & REPLACED:
+                if timezone.localdate().toordinal() - self._header()[2] < REBUILD_AFTER_DAYS:
+                    return
+            self.path = path
+            if not Path(path).exists():
+                self.rebuild()
+                return
+            if self.map is None or self._header()[0] & REPLACED:
+                self._open()
+            if timezone.localdate().toordinal() - self._header()[2] >= REBUILD_AFTER_DAYS:
+                self.rebuild()
+
+    def _load_rows(self):
+        """ Reads the rooms that were given a row since this process last looked """
+        _, _, _, _, capacity = self._header()
+        used = ROOMS_USED.unpack_from(self.map, ROOMS_USED_AT)[0]
+        for row in range(len(self.rows), min(used, capacity)):
+            offset = HEADER_SIZE + row * 16
+            self.rows[UUID(bytes=bytes(self.map[offset:offset + 16]))] = row
+
+    # Reads
+
+    def _read(self, read):
+        """ Runs read() until no writer changed the matrix while it ran """
+        with self.lock: # Keeps the other threads from remapping it meanwhile
+            for _ in range(READ_RETRIES):
+                generation = self._generation()
+                if generation % 2: # A write is under way
+                    sleep(0)
+                    continue
+                result = read()
+                if self._generation() == generation:
+                    return result
+            return None
+
+    def _range(self, start:date, end:date):
+        """ (row bytes, where the bits start, first column, last column) of the nights [start, end), None outside the window """
+        _, _, first_night, nights, capacity = self._header()
+        first, last = start.toordinal() - first_night, end.toordinal() - first_night - 1
+        if first < 0 or last >= nights or last < first:
+            return None
+        return self._row_bytes(nights), self._bits_at(capacity), first, last
+
+    def _taken(self, row:int, row_bytes:int, bits_at:int, first:int, last:int) -> bool:
+        offset = bits_at + row * row_bytes
+        window = self.view[offset + first // 8:offset + last // 8 + 1] # Only the bytes of the range are read
+        bits = int.from_bytes(window, "little") >> (first % 8)
+        return bits & ((1 << (last - first + 1)) - 1) != 0
+
+    def taken_rooms(self, start:date, end:date):
+        """ The pks of the rooms taken for some night of [start, end), None when the matrix can't tell """
+        if not self.enabled:
+            return None
+        self._ensure_open()
+
+        def read():
+            columns = self._range(start, end)
+            if columns is None:
+                return None
+            self._load_rows()
+            return {room_id for room_id, row in self.rows.items() if self._taken(row, *columns)}
+        return self._read(read)
+
+    # Writes
+
+    def _expected_rows(self, first_night:int, nights:int, room_ids=None) -> dict:
+        """ {room pk: bytearray row} of the committed room nights in the window """
+        start = date.fromordinal(first_night)
+        room_nights = models.RoomNight.objects.filter(date__gte=start, date__lt=start + timedelta(days=nights))
+        if room_ids is not None:
+            room_nights = room_nights.filter(room__in=room_ids)
+
+        rows = {room_id: bytearray(self._row_bytes(nights)) for room_id in room_ids or ()}
+        for room_id, night in room_nights.values_list('room_id', 'date').iterator():
+            column = night.toordinal() - first_night
+            rows.setdefault(room_id, bytearray(self._row_bytes(nights)))[column // 8] |= 1 << (column % 8)
+        return rows
+
+    def refresh_rooms(self, room_ids):
+        """ Rewrites the rows of the rooms from their committed room nights. Call it once the write is committed """
+        room_ids = list(room_ids)
+        if not self.enabled or not room_ids:
+            return
+        self._ensure_open()
+
+        with self._file_lock():
+            if self._header()[0] & REPLACED:
+                self._open()
+            self._load_rows()
+            _, generation, first_night, nights, capacity = self._header()
+            generation += generation % 2 # Odd if a writer died halfway
+
+            new_rooms = [room_id for room_id in room_ids if room_id not in self.rows]
+            if len(self.rows) + len(new_rooms) > capacity:
+                self.rebuild() # Twice as large, with every room
+                return
+
+            expected = self._expected_rows(first_night, nights, room_ids)
+            row_bytes, bits_at = self._row_bytes(nights), self._bits_at(capacity)
+
+            self._set_generation(generation + 1)
+            try:
+                for room_id in new_rooms:
+                    row = len(self.rows)
+                    self.map[HEADER_SIZE + row * 16:HEADER_SIZE + row * 16 + 16] = room_id.bytes
+                    self.rows[room_id] = row
+                ROOMS_USED.pack_into(self.map, ROOMS_USED_AT, len(self.rows))
+                for room_id, bits in expected.items():
+                    offset = bits_at + self.rows[room_id] * row_bytes
+                    self.map[offset:offset + row_bytes] = bits
+            finally:
+                self._set_generation(generation + 2)
+
+    def rebuild(self):
+        """ Builds the whole matrix again from the room nights, for OCCUPANCY_MATRIX_NIGHTS nights from today,
+            and swaps it in for the one the workers have mapped
+        """
+
+        self.path = str(settings.OCCUPANCY_MATRIX)
+        with self._file_lock():
+            if Path(self.path).exists() and (self.map is None or self._header()[0] & REPLACED):
+                try:
+                    self._open() # To carry its generation on, and to flag it as replaced
+                except ValueError:
+                    pass
+            old_generation = self._generation() if self.map is not None else 0
+            first_night = timezone.localdate().toordinal()
+            nights = getattr(settings, "OCCUPANCY_MATRIX_NIGHTS", 730)
+            room_ids = list(models.Room.objects.order_by('date_add').values_list('pk', flat=True))
+            capacity = max(getattr(settings, "OCCUPANCY_MATRIX_ROOMS", 256), 2 * len(room_ids))
+            row_bytes = self._row_bytes(nights)
+
+            data = bytearray(self._bits_at(capacity) + capacity * row_bytes)
+            HEADER.pack_into(data, 0, MAGIC, LAYOUT, 0, old_generation + 2 + old_generation % 2, first_night, nights, capacity)
+            ROOMS_USED.pack_into(data, ROOMS_USED_AT, len(room_ids))
+            rows = {room_id: row for row, room_id in enumerate(room_ids)}
+            for room_id, row in rows.items():
+                data[HEADER_SIZE + row * 16:HEADER_SIZE + row * 16 + 16] = room_id.bytes
+            for room_id, bits in self._expected_rows(first_night, nights).items():
+                if room_id in rows:
+                    offset = self._bits_at(capacity) + rows[room_id] * row_bytes
+                    data[offset:offset + row_bytes] = bits
+
+            temporary = f"{self.path}.tmp"
+            Path(temporary).write_bytes(data)
+            os.replace(temporary, self.path)
+
+            # Tell the processes that still map the old file to map the new one
+            if self.map is not None:
+                struct.pack_into("<I", self.map, FLAGS_AT, self._header()[0] | REPLACED)
+            self._open()
+
+    def check(self) -> dict:
+        """ {room pk: [(night, in the matrix, in the reservations)]} of the nights where the matrix and
+            the active reservations disagree. Holds the lock, so no worker writes while it compares
+        """
+
+        self._ensure_open()
+        with self._file_lock():
+            if self._header()[0] & REPLACED:
+                self._open()
+            self._load_rows()
+            _, _, first_night, nights, capacity = self._header()
+            window_start = date.fromordinal(first_night)
+            window_end = window_start + timedelta(days=nights)
+
+            expected = {}
+            reservations = (
+                models.Reservation.objects
+                .filter(date_checkout__isnull=True, date_bookfrom__lt=window_end, date_bookuntil__gt=window_start)
+                .values_list('room_id', 'date_bookfrom', 'date_bookuntil')
+            )
+            for room_id, date_bookfrom, date_bookuntil in reservations.iterator():
+                first = max(date_bookfrom.toordinal(), first_night) - first_night
+                last = min(date_bookuntil.toordinal(), first_night + nights) - first_night
+                expected.setdefault(room_id, set()).update(range(first, last))
+
+            row_bytes, bits_at = self._row_bytes(nights), self._bits_at(capacity)
+            mismatches = {}
+            for room_id in set(expected) | set(self.rows):
+                row = self.rows.get(room_id)
+                actual = set()
+                if row is not None:
+                    bits = int.from_bytes(self.map[bits_at + row * row_bytes:bits_at + (row + 1) * row_bytes], "little")
+                    actual = {column for column in range(nights) if bits >> column & 1}
+                wrong = actual ^ expected.get(room_id, set())
+                if wrong:
+                    mismatches[room_id] = [
+                        (date.fromordinal(first_night + column), column in actual, column in expected.get(room_id, set()))
+                        for column in sorted(wrong)
+                    ]
+            return mismatches
+
+
+
+occupancy_matrix = OccupancyMatrix()
@@ -0,0 +1,145 @@
+from django.conf import settings
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import date, datetime
+import json
+
+
+
+class KeysetPage:
+    """ One page of a keyset paginated listing """
+
+    def __init__(self, object_list, next_cursor, previous_cursor, query):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.query = query # The current GET parameters, without the cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self) -> int:
+        return len(self.object_list)
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self) -> bool:
+        return self.has_next or self.has_previous
+
+    def _query_with(self, cursor:str) -> str:
+        query = self.query.copy()
+        query["cursor"] = cursor
+        return query.urlencode()
+
+    @property
+    def next_query(self) -> str:
+        """ The query string of the next page """
+        return self._query_with(self.next_cursor)
+
+    @property
+    def previous_query(self) -> str:
+        """ The query string of the previous page """
+        return self._query_with(self.previous_cursor)
+
+
+
+def encode_cursor(values:list, direction:str) -> str:
+    # Dates are written out in full, DjangoJSONEncoder would cut them down to milliseconds
+    values = [value.isoformat() if isinstance(value, (date, datetime)) else str(value) for value in values]
+    data = json.dumps({"k": values, "d": direction})
+    return urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor:str):
+    """ The key values and direction of a cursor, or (None, None) if it's invalid """
+    try:
+        data = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        values, direction = data["k"], data["d"]
+    except (Base64Error, ValueError, TypeError, KeyError):
+        return None, None
+
+    if not isinstance(values, list) or direction not in ("next", "previous"):
+        return None, None
+
+    return values, direction
+
+
+def _after(ordering:list, values:list) -> Q:
+    """ The rows that come after `values` in `ordering`, e.g. for ['-date_update', '-uuid']:
+        date_update < v0 OR (date_update = v0 AND uuid < v1)
+    """
+    condition = Q()
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip("-")
+        lookup = "lt" if field.startswith("-") else "gt"
+        condition |= equal & Q(**{f"{name}__{lookup}": value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+def _reverse(ordering:list) -> list:
+    return [field[1:] if field.startswith("-") else f"-{field}" for field in ordering]
+
+
+def _page(queryset, ordering:list, values, direction:str, per_page:int, query) -> KeysetPage:
+    fields = [field.lstrip("-") for field in ordering]
+
+    # Going backwards walks the reversed order from the cursor, then puts the page back in order
+    order = _reverse(ordering) if direction == "previous" else ordering
+    rows = queryset.order_by(*order)
+    if values is not None:
+        rows = rows.filter(_after(order, values))
+
+    rows = list(rows[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if direction == "previous":
+        if not has_more:
+            # Back at the start, show a full first page instead of a partial one
+            return _page(queryset, ordering, None, "next", per_page, query)
+        rows.reverse()
+        has_next, has_previous = True, True
+    else:
+        has_next, has_previous = has_more, values is not None
+
+    return KeysetPage(
+        rows,
+        encode_cursor([getattr(rows[-1], f) for f in fields], "next") if has_next and rows else None,
+        encode_cursor([getattr(rows[0], f) for f in fields], "previous") if has_previous and rows else None,
+        query,
+    )
+
+
+def paginate(request, queryset, ordering:list, per_page:int=None) -> KeysetPage:
+    """ Keyset (cursor) paginates `queryset` on the `ordering` fields
+
+    Instead of an OFFSET, each page filters on the last row of the page
+    before it, so deep pages cost the same as the first one as long as
+    `ordering` is backed by an index. The last field of `ordering` has to be
+    unique (e.g. the primary key) to keep the order total.
+    """
+
+    per_page = per_page or getattr(settings, "LISTING_PAGE_SIZE", 25)
+    query = request.GET.copy()
+    query.pop("cursor", None)
+
+    values, direction = decode_cursor(request.GET.get("cursor", ""))
+    if values is None or len(values) != len(ordering):
+        values, direction = None, "next"
+
+    try:
+        return _page(queryset, ordering, values, direction, per_page, query)
+    except (ValidationError, ValueError, TypeError): # Tampered cursor, e.g. text for a number, start over
+        return _page(queryset, ordering, None, "next", per_page, query)
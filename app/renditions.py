@@ -0,0 +1,201 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.templatetags.static import static
+from django.utils.html import format_html, format_html_join
+
+from base64 import b64encode
+from hashlib import md5, sha256
+from io import BytesIO
+from pathlib import PurePosixPath
+import json
+
+from PIL import Image, ImageOps
+
+from .storage import image_storage
+
+
+# Encoder settings of every rendition format, by file extension
+FORMATS = {
+    'jpg': ('JPEG', {'progressive': True, 'optimize': True}),
+    'webp': ('WEBP', {'method': 4}),
+}
+MIME_TYPES = {'jpg': "image/jpeg", 'webp': "image/webp"}
+PLACEHOLDER = "images/processing.svg" # Static file shown while an upload is being processed
+
+
+
+def rendition_name(source:str, size:str, extension:str) -> str:
+    """ Where the `size` rendition of the image stored as `source` goes, e.g. renditions/images/rooms/a/card.webp """
+    return str(PurePosixPath("renditions") / PurePosixPath(source).with_suffix("") / f"{size}.{extension}")
+
+
+def config() -> str:
+    """ Sets apart the renditions of different IMAGE_RENDITIONS, quality or encoder settings """
+    options = [
+        getattr(settings, "IMAGE_RENDITIONS", {'thumb': 200, 'card': 640, 'full': 1600}),
+        getattr(settings, "IMAGE_RENDITION_QUALITY", 80),
+        FORMATS,
+    ]
+    return md5(json.dumps(options, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def content_hash(data:bytes) -> str:
+    return sha256(data).hexdigest()
+
+
+def build_renditions(image, storage=None) -> dict:
+    """ Renders the image at every IMAGE_RENDITIONS width it's larger than, in JPEG and WebP
+
+    Returns the manifest stored on the model: {'source': image name, 'hash':
+    its content hash, 'config': config(), 'sizes': [{'name', 'width',
+    'height', 'jpg', 'webp'}], 'preview': data URI, 'preview_size': px},
+    sizes smallest first. Images are never scaled up. They go in the image's
+    storage unless `storage` is given, where a rendition that's already stored
+    is only counted again (see storage.py).
+    """
+
+    storage = storage or image.storage
+
+    quality = getattr(settings, "IMAGE_RENDITION_QUALITY", 80)
+    widths = getattr(settings, "IMAGE_RENDITIONS", {'thumb': 200, 'card': 640, 'full': 1600})
+
+    with image.open("rb") as file:
+        data = file.read()
+
+    with Image.open(BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original) # Phone photos are often stored sideways
+        if original.mode not in ("RGB", "L"):
+            original = original.convert("RGB")
+
+        sizes = []
+        for name, width in sorted(widths.items(), key=lambda item: item[1]):
+            width = min(width, original.width)
+            if sizes and sizes[-1]['width'] == width: # The image is smaller than this size already
+                continue
+            height = max(1, round(original.height * width / original.width))
+            size = {'name': name, 'width': width, 'height': height}
+
+            resized = original.resize((width, height), Image.Resampling.LANCZOS)
+            for extension, (encoder, options) in FORMATS.items():
+                buffer = BytesIO()
+                resized.save(buffer, encoder, quality=quality, **options)
+                target = rendition_name(image.name, name, extension)
+                size[extension] = storage.save(target, ContentFile(buffer.getvalue())) # A blob name in the content-addressed storage
+            sizes.append(size)
+
+        return {'source': image.name, 'hash': content_hash(data), 'config': config(), 'sizes': sizes, **preview(original)}
+
+
+def preview(picture) -> dict:
+    """ A tiny blurry WebP of the Pillow image, inlined as a data URI so pages paint something before the image loads """
+
+    size = getattr(settings, "IMAGE_PREVIEW_SIZE", 16)
+    tiny = picture.copy()
+    tiny.thumbnail((size, size), Image.Resampling.BOX)
+    buffer = BytesIO()
+    tiny.save(buffer, "WEBP", quality=40)
+    return {'preview': f"data:{MIME_TYPES['webp']};base64,{b64encode(buffer.getvalue()).decode()}", 'preview_size': size}
+
+
+def add_preview(image, manifest:dict) -> dict:
+    """ The manifest with a preview() made from its smallest rendition, for images rendered before previews were """
+    with image.storage.open(manifest['sizes'][0]['jpg'], "rb") as file, Image.open(file) as smallest:
+        return {**manifest, **preview(smallest)}
+
+
+def preview_current(manifest:dict) -> bool:
+    return manifest.get('preview_size') == getattr(settings, "IMAGE_PREVIEW_SIZE", 16)
+
+
+def up_to_date(image, manifest:dict) -> bool:
+    """ Whether the manifest was rendered from the image's current content, with the current settings, and its files are all there """
+
+    storage = image.storage
+    if not current(image, manifest) or manifest.get('config') != config() or not manifest.get('hash'):
+        return False
+    with image.open("rb") as file:
+        if content_hash(file.read()) != manifest['hash']:
+            return False
+    return all(storage.exists(size[extension]) for size in manifest['sizes'] for extension in FORMATS)
+
+
+def delete_renditions(manifest:dict, storage=None):
+    """ Removes the files of a manifest, unless they're the renditions of a field default shared by many rows
+
+    Content-addressed files only lose a reference, see storage.py.
+    """
+    storage = storage or image_storage()
+    if not manifest or manifest.get('source') in getattr(settings, "IMAGE_RENDITION_SHARED", ["default.png"]):
+        return
+    for size in manifest.get('sizes', []):
+        for extension in FORMATS:
+            if size.get(extension):
+                storage.delete(size[extension])
+
+
+def share(manifest:dict, storage=None) -> bool:
+    """ Counts another reference to every file of the manifest, for a row that reuses it. False if one is gone """
+    storage = storage or image_storage()
+    if not hasattr(storage, "reference"): # Not content-addressed, nothing is counted
+        return True
+    found = [
+        storage.reference(size[extension])
+        for size in manifest.get('sizes', []) for extension in FORMATS if size.get(extension)
+    ]
+    return all(found)
+
+
+def current(image, manifest:dict) -> list:
+    """ The sizes of the manifest, if it was rendered from the image the field holds now """
+    if image and manifest and manifest.get('source') == image.name:
+        return manifest.get('sizes', [])
+    return []
+
+
+def pending(image, manifest:dict) -> bool:
+    """ Whether the image is an upload the image workers haven't resized yet (see imagejobs.py) """
+    return bool(image and manifest and manifest.get('source') == image.name and manifest.get('pending'))
+
+
+
+def picture(image, manifest:dict, sizes:str="100vw", **attrs) -> str:
+    """ A <picture> of the image with a WebP and a JPEG srcset, lazily loaded
+
+    `sizes` is the width the image is shown at, for the browser to pick a
+    rendition with. The other keyword arguments become attributes of the
+    <img>, with underscores turned into dashes (data_bs_toggle="modal").
+    Uploads that are still being processed show a placeholder, and images
+    without renditions a plain lazily loaded <img> of the original. The
+    preview of the manifest is the background of the <img> until it loads.
+    """
+
+    attrs = {name.replace("_", "-"): value for name, value in attrs.items()}
+    attrs.setdefault('loading', "lazy")
+    attrs.setdefault('decoding', "async")
+    if manifest and manifest.get('preview') and current(image, manifest):
+        attrs['style'] = "; ".join(filter(None, [
+            attrs.get('style', "").rstrip("; "),
+            f"background: center / cover no-repeat url({manifest['preview']})",
+        ]))
+    attributes = format_html_join(" ", '{}="{}"', attrs.items())
+
+    if pending(image, manifest):
+        return format_html('<img src="{}" data-pending="true" {}>', static(PLACEHOLDER), attributes)
+
+    renditions = current(image, manifest)
+    if not renditions:
+        return format_html('<img src="{}" {}>', image.url if image else "", attributes)
+
+    def srcset(extension):
+        return ", ".join(f"{image.storage.url(size[extension])} {size['width']}w" for size in renditions)
+
+    # Browsers without srcset get the smallest rendition at least as wide as the <img>
+    shown = int(attrs.get('width') or 0)
+    fallback = next((size for size in renditions if size['width'] >= shown), renditions[-1])
+
+    return format_html(
+        '<picture><source type="{}" srcset="{}" sizes="{}"><img src="{}" srcset="{}" sizes="{}" {}></picture>',
+        MIME_TYPES['webp'], srcset('webp'), sizes,
+        image.storage.url(fallback['jpg']), srcset('jpg'), sizes,
+        attributes,
+    )
@@ -0,0 +1,136 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+import re
+from uuid import UUID
+
+from . import models
+
+
+FTS_TABLE = "app_room_fts"
+
+# Marks the matched terms in the snippets before they're HTML escaped
+_MATCH_START, _MATCH_END = "\x02", "\x03"
+
+
+
+def fts_enabled() -> bool:
+    """ Whether the room full-text index exists (SQLite with FTS5) """
+    # Only a positive answer is remembered, the table appears once migrated
+    if not getattr(connection, "room_fts_enabled", False):
+        connection.room_fts_enabled = (
+            connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names()
+        )
+    return connection.room_fts_enabled
+
+
+def _rowid(pk) -> int:
+    """ The index row of a room, derived from its UUID so it can be found without a scan """
+    return pk.int >> 65 # Fits in SQLite's signed 64-bit rowid
+
+
+def _document(room) -> list:
+    """ The indexed columns of a room """
+    return [
+        _rowid(room.pk),
+        room.pk.hex,
+        room.name,
+        room.description,
+        room.get_type_display(),
+        " ".join(amenity.name for amenity in room.amenities.all()),
+    ]
+
+
+def index_rooms(rooms):
+    """ (Re)indexes the given rooms """
+    if not fts_enabled():
+        return
+
+    rooms = list(rooms.prefetch_related('amenities'))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [[_rowid(room.pk)] for room in rooms])
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, uuid, name, description, type, amenities) VALUES (%s, %s, %s, %s, %s, %s)",
+            [_document(room) for room in rooms],
+        )
+
+
+def unindex_room(pk):
+    if not fts_enabled():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [_rowid(pk)])
+
+
+def rebuild() -> int:
+    """ Reindexes every room, returns how many """
+    if not fts_enabled():
+        return 0
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+        pks = list(models.Room.objects.values_list('pk', flat=True))
+        for i in range(0, len(pks), 2000):
+            index_rooms(models.Room.objects.filter(pk__in=pks[i:i + 2000]))
+    return len(pks)
+
+
+def _match_query(q:str) -> str:
+    """ Turns what the user typed into an FTS5 query where every word is a prefix,
+        e.g. 'deluxe ba' -> '"deluxe"* "ba"*'
+    """
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", q))
+
+
+def _highlight(snippet:str) -> str:
+    return mark_safe(escape(snippet).replace(_MATCH_START, "<mark>").replace(_MATCH_END, "</mark>"))
+
+
+def search_rooms(q:str):
+    """ The rooms matching `q` in their name, description, type or amenities
+
+    Returns a queryset annotated with `search_rank` (0 is the best match)
+    and a {room pk: highlighted snippet} dict. With FTS5 only the best
+    SEARCH_RESULTS_LIMIT matches are kept; otherwise it falls back to
+    unranked LIKE lookups.
+    """
+
+    if not fts_enabled():
+        rooms = models.Room.objects.filter(
+            Q(name__icontains=q)
+            | Q(description__icontains=q)
+            | Q(type__in=[value for value, label in models.Room.RoomTypes.choices if q.lower() in label.lower()])
+            | Q(amenities__name__icontains=q)
+        ).distinct()
+        return rooms.annotate(search_rank=Value(0, output_field=IntegerField())), {}
+
+    match = _match_query(q)
+    if not match:
+        return models.Room.objects.none().annotate(search_rank=Value(0, output_field=IntegerField())), {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT uuid, snippet({FTS_TABLE}, -1, %s, %s, '…', 12) FROM {FTS_TABLE}"
+            f" WHERE {FTS_TABLE} MATCH %s"
+            # Matches on the name count the most, then type and amenities, then the description
+            f" ORDER BY bm25({FTS_TABLE}, 0, 10.0, 1.0, 5.0, 3.0)"
+            f" LIMIT %s",
+            [_MATCH_START, _MATCH_END, match, getattr(settings, "SEARCH_RESULTS_LIMIT", 200)],
+        )
+        rows = cursor.fetchall()
+
+    pks = [UUID(uuid) for uuid, _ in rows]
+    snippets = {pk: _highlight(snippet) for pk, (_, snippet) in zip(pks, rows)}
+
+    rank = Case(
+        *[When(pk=pk, then=Value(i)) for i, pk in enumerate(pks)],
+        output_field=IntegerField(),
+    ) if pks else Value(0, output_field=IntegerField())
+
+    return models.Room.objects.filter(pk__in=pks).annotate(search_rank=rank), snippets
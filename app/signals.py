@@ -1,9 +1,13 @@
 
-from django.db.models.signals import post_save # Signal when something is saved
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed # Signal when something is saved or deleted
 from django.contrib.auth.models import User # Default user model
 from django.dispatch import receiver # Connects signals to functions
 
-from .models import Profile # Your Profile model
+from .models import Profile, Amenity, Room, Reservation # Your Profile model
+from .availability import sync_room_nights
+from .occupancy import occupancy_matrix
+from . import fragments, imagejobs, inventory, renditions, search
 
 # Rule 1: When a User is saved, run this
 @receiver(post_save, sender=User)
@@ -14,4 +18,106 @@ def create_profile(sender, instance, created, **kwargs):
 # Rule 2: When a User is saved AGAIN, save their profile too
 @receiver(post_save, sender=User)
 def save_profile(sender, instance, **kwargs):
-    instance.profile.save() # Update profile if user changes
\ No newline at end of file
+    instance.profile.save() # Update profile if user changes
+
+
+# Rule 3: Recompute the stored room prices and reindex the rooms whenever their amenities change
+@receiver(m2m_changed, sender=Room.amenities.through)
+def update_rooms_on_amenities_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # The amenity's rooms are gone after the clear, so remember them now
+        instance._cleared_room_pks = list(instance.rooms.values_list('pk', flat=True))
+    elif action in ("post_add", "post_remove", "post_clear"):
+        if not reverse:
+            rooms = Room.objects.filter(pk=instance.pk)
+        elif action == "post_clear":
+            rooms = Room.objects.filter(pk__in=getattr(instance, '_cleared_room_pks', []))
+        else:
+            rooms = Room.objects.filter(pk__in=pk_set)
+        rooms.update_prices()
+        search.index_rooms(rooms)
+        fragments.forget_rooms(rooms.values_list('pk', flat=True))
+        if not reverse:
+            instance.refresh_from_db(fields=['total_amenity_fee', 'price'])
+
+@receiver(post_save, sender=Amenity)
+def update_rooms_on_amenity_change(sender, instance, created, **kwargs):
+    if not created: # A new amenity isn't in any room yet
+        rooms = Room.objects.filter(amenities=instance)
+        rooms.update_prices()
+        search.index_rooms(rooms)
+        fragments.forget_rooms(rooms.values_list('pk', flat=True))
+
+@receiver(pre_delete, sender=Amenity)
+def remember_amenity_rooms(sender, instance, **kwargs):
+    # The amenity's rooms are gone after the delete, so remember them now
+    instance._deleted_room_pks = list(instance.rooms.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Amenity)
+def update_rooms_on_amenity_delete(sender, instance, **kwargs):
+    rooms = Room.objects.filter(pk__in=getattr(instance, '_deleted_room_pks', []))
+    rooms.update_prices()
+    search.index_rooms(rooms)
+    fragments.forget_rooms(getattr(instance, '_deleted_room_pks', []))
+
+# Rule 4: Keep the room search index in sync with the rooms
+@receiver(post_save, sender=Room)
+def index_room(sender, instance, **kwargs):
+    search.index_rooms(Room.objects.filter(pk=instance.pk))
+
+@receiver(post_delete, sender=Room)
+def unindex_room(sender, instance, **kwargs):
+    search.unindex_room(instance.pk)
+
+# Rule 5: Build the cached room fragments and calendars again once the room's reservations change.
+# Room saves change date_update, which is part of the key, and the amenity changes are handled in Rule 3
+@receiver(post_save, sender=Reservation)
+@receiver(post_delete, sender=Reservation)
+def forget_reservation_room(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fragments.forget_rooms([instance.room_id]))
+
+# Rule 6: Keep the room nights in step with the reservation, in the same transaction.
+# Deleted reservations take their nights with them (on_delete=CASCADE)
+@receiver(post_save, sender=Reservation)
+def update_room_nights(sender, instance, **kwargs):
+    sync_room_nights(instance)
+
+# Rule 7: Rewrite the room's row of the shared occupancy matrix once its nights are committed
+@receiver(post_save, sender=Reservation)
+@receiver(post_delete, sender=Reservation)
+def update_occupancy_matrix(sender, instance, **kwargs):
+    if occupancy_matrix.enabled:
+        transaction.on_commit(lambda: occupancy_matrix.refresh_rooms([instance.room_id]))
+
+# Rule 8: Store uploaded room and profile images as they are, the image workers resize and render them (see imagejobs.py)
+@receiver(pre_save, sender=Room)
+@receiver(pre_save, sender=Profile)
+def store_uploaded_image(sender, instance, **kwargs):
+    imagejobs.store_upload(instance)
+
+@receiver(post_save, sender=Room)
+@receiver(post_save, sender=Profile)
+def queue_image_job(sender, instance, **kwargs):
+    imagejobs.enqueue(instance)
+
+@receiver(post_delete, sender=Room)
+@receiver(post_delete, sender=Profile)
+def delete_image_renditions(sender, instance, **kwargs):
+    renditions.delete_renditions(instance.image_renditions)
+
+# Rule 9: Count the changes the availability API answers differently after, for its ETags (see inventory.py).
+# Saved reservations are counted by sync_room_nights(), the nights of deleted active ones go with them.
+# Counted once per transaction, however many rows it deletes
+@receiver(post_delete, sender=Reservation)
+def count_reservation_delete(sender, instance, **kwargs):
+    if instance.date_checkout is None:
+        inventory.bump()
+
+@receiver(post_delete, sender=Room)
+def count_room_delete(sender, instance, **kwargs):
+    inventory.bump()
+
+@receiver(post_save, sender=Room)
+def count_new_room(sender, instance, created, **kwargs):
+    if created:
+        inventory.bump()
@@ -0,0 +1,49 @@
+// Fills the booking form from the room calendar: the first click picks the
+// check-in date, the second the check-out date. Taken nights can't be part of
+// the stay, but one can still be the check-out date.
+document.addEventListener('DOMContentLoaded', function () {
+    const from = document.getElementById('id_date_bookfrom');
+    const until = document.getElementById('id_date_bookuntil');
+    const days = Array.from(document.querySelectorAll('[data-calendar-date]'));
+    if (!from || !until) {
+        return;
+    }
+
+    function highlight() {
+        days.forEach(day => {
+            const date = day.dataset.calendarDate;
+            const picked = date === from.value || date === until.value;
+            const inside = from.value && until.value && date > from.value && date < until.value;
+            day.classList.toggle('btn-success', picked);
+            day.classList.toggle('btn-outline-success', Boolean(inside));
+        });
+    }
+
+    let pickingUntil = false;
+    days.forEach(day => {
+        day.addEventListener('click', () => {
+            const date = day.dataset.calendarDate;
+
+            if (pickingUntil && date > from.value) {
+                const taken = days.some(other => other.dataset.busy && other.dataset.calendarDate >= from.value && other.dataset.calendarDate < date);
+                if (!taken) {
+                    until.value = date;
+                    pickingUntil = false;
+                    highlight();
+                    return;
+                }
+            }
+
+            if (!day.dataset.busy) {
+                from.value = date;
+                until.value = '';
+                pickingUntil = true;
+                highlight();
+            }
+        });
+    });
+
+    from.addEventListener('change', highlight);
+    until.addEventListener('change', highlight);
+    highlight();
+});
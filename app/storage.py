@@ -0,0 +1,131 @@
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from hashlib import sha256
+from pathlib import Path, PurePosixPath
+from time import time
+from uuid import uuid4
+import os
+
+
+BLOBS = "blobs" # Directory of the storage the content-addressed files go in
+
+
+
+def image_storage():
+    """ The storage of the room and profile images and their renditions, STORAGES['images'] """
+    return storages["images"]
+
+
+def _blobs():
+    return apps.get_model("app", "Blob") # The models import this module
+
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """ Stores every file under the SHA-256 of its content, once however many times it's saved
+
+    Saving returns blobs/<ab>/<cd>/<hash>.<extension>, whatever name was asked
+    for, and counts a reference to the blob. Deleting takes one away, and the
+    file only goes once the last reference has, after the transaction commits.
+    Files written by a transaction that rolled back have no Blob row and are
+    left to collect_orphans(). Names from before (e.g. default.png) are read
+    and deleted as they were.
+    """
+
+    def blob_name(self, name:str, content) -> str:
+        """ The name the content is stored under """
+        digest = sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        extension = PurePosixPath(name).suffix.lower()
+        return f"{BLOBS}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+    def is_blob(self, name:str) -> bool:
+        return name.startswith(f"{BLOBS}/")
+
+    def get_available_name(self, name, max_length=None):
+        return name # Replaced by the blob name in _save()
+
+    def _save(self, name, content):
+        name = self.blob_name(name, content)
+        with transaction.atomic():
+            self._add_reference(name, content.size)
+            if not self.exists(name):
+                path = Path(self.path(name))
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temporary = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+                with open(temporary, "wb") as file:
+                    for chunk in content.chunks():
+                        file.write(chunk)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temporary, self.file_permissions_mode)
+                os.replace(temporary, path) # A concurrent save of the same content writes the same bytes
+        return name
+
+    def _add_reference(self, name:str, size:int):
+        Blob = _blobs()
+        if Blob.objects.filter(name=name).update(references=F('references') + 1):
+            return
+        try:
+            with transaction.atomic():
+                Blob.objects.create(name=name, references=1, size=size)
+        except IntegrityError: # Created in between
+            Blob.objects.filter(name=name).update(references=F('references') + 1)
+
+    def reference(self, name:str) -> bool:
+        """ Counts another reference to a stored blob, for a row that shares it. False if it's gone """
+        if not self.is_blob(name):
+            return True
+        with transaction.atomic():
+            if not self.exists(name):
+                return False
+            self._add_reference(name, self.size(name))
+        return True
+
+    def delete(self, name):
+        if not self.is_blob(name):
+            return super().delete(name)
+        _blobs().objects.filter(name=name, references__gt=0).update(references=F('references') - 1)
+        transaction.on_commit(lambda: self._collect(name))
+
+    def _collect(self, name:str):
+        """ Removes the blob if nothing references it anymore """
+        with transaction.atomic():
+            if _blobs().objects.filter(name=name, references=0).delete()[0]:
+                super().delete(name)
+
+    def collect_orphans(self, older_than:float=3600) -> int:
+        """ Removes the blob files nothing references: those whose Blob row was rolled back with the
+            transaction that wrote them, the unreferenced ones whose collection never ran, and the
+            temporary files of interrupted writes. Returns how many files went
+
+        Files younger than `older_than` seconds are kept, the transaction that
+        wrote them may still be open.
+        """
+
+        root = Path(self.path(BLOBS))
+        if not root.is_dir():
+            return 0
+        cutoff = time() - older_than
+        Blob = _blobs()
+
+        n_removed = 0
+        for path in root.glob("*/*/*"):
+            if path.stat().st_mtime > cutoff:
+                continue
+            if path.name.startswith("."): # The temporary file of an interrupted write, it never has a row
+                path.unlink(missing_ok=True)
+                n_removed += 1
+                continue
+            name = path.relative_to(self.location).as_posix()
+            with transaction.atomic(): # Keeps a save of the same content from counting it meanwhile
+                if Blob.objects.filter(name=name, references__gt=0).exists():
+                    continue
+                Blob.objects.filter(name=name).delete()
+                path.unlink(missing_ok=True)
+            n_removed += 1
+        return n_removed
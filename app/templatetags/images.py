@@ -0,0 +1,19 @@
+from django import template
+
+from app import renditions
+
+
+register = template.Library()
+
+
+
+@register.simple_tag
+def picture(image, manifest, sizes="100vw", **attrs):
+    """ {% picture room.image room.image_renditions sizes="100px" class="rounded" alt="" %}, see renditions.picture """
+    return renditions.picture(image, manifest, sizes, **attrs)
+
+
+@register.filter
+def modal_target(pk) -> str:
+    """ The data-bs-target of the image modals, whose ids are "modal-<pk>" """
+    return f"#modal-{pk}"
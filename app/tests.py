@@ -1,3 +1,1063 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.template import Context, Template, base
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.formats import date_format
 
-# Create your tests here.
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import date, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Barrier
+from unittest import mock
+import json
+import os
+import re
+
+from PIL import Image
+
+from . import availability, fragments, imagejobs, inventory, metrics, models, renditions, search
+from .management.commands import build_image_renditions
+from .occupancy import occupancy_matrix
+from .pagination import encode_cursor
+from .storage import image_storage
+
+
+# The tables that must never be read with a full scan
+WATCHED_TABLES = ["app_reservation", "app_roomnight"]
+
+
+
+def make_rooms(n:int, user, first:int=0) -> list:
+    """ Rooms with two amenities and two active reservations each """
+    amenities = [models.Amenity.objects.get_or_create(name=name, defaults={'fee': 5})[0] for name in ("Wifi", "Breakfast")]
+    today = date.today()
+    rooms = []
+    for i in range(first, first + n):
+        room = models.Room.objects.create(name=f"Room {i}", type=models.Room.RoomTypes.STANDARD, base_price=100, capacity=2)
+        room.amenities.add(*amenities)
+        for nights in (1, 3):
+            models.Reservation.objects.create(
+                user=user, room=room, paid_price=100,
+                date_bookfrom=today + timedelta(days=10 * nights), date_bookuntil=today + timedelta(days=10 * nights + 2),
+            )
+        rooms.append(room)
+    return rooms
+
+
+
+def make_image(color:str="red", size:tuple=(800, 600)) -> bytes:
+    """ The bytes of a plain JPEG """
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def temporary_media(test) -> Path:
+    """ Points MEDIA_ROOT at a directory removed after the test, and leaves the image jobs to the test to run """
+    directory = TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    settings = override_settings(MEDIA_ROOT=directory.name, IMAGE_JOB_THREADS=0)
+    settings.enable()
+    test.addCleanup(settings.disable)
+    return Path(directory.name)
+
+
+
+class ListingQueryCountTests(TestCase):
+    """ index and room_index render in the same number of queries whatever the number of rooms """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("listing")
+        make_rooms(3, cls.user)
+
+    def setUp(self):
+        fragments.get_cache().clear() # Every room is rendered, none comes from the fragment cache
+        self.client.force_login(self.user)
+
+    def assertPageQueries(self, url:str, n:int):
+        with self.assertNumQueries(n):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        make_rooms(6, self.user, first=3)
+        fragments.get_cache().clear()
+        with self.assertNumQueries(n):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_index(self):
+        self.assertPageQueries(reverse("app-index"), 7)
+
+    def test_room_index(self):
+        self.assertPageQueries(reverse("room:index"), 7)
+
+
+
+class QueryPlanTests(TestCase):
+    """ EXPLAIN QUERY PLAN of the queries of the main views: none of them full-scans a reservation table """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("query_plan_check")
+        cls.amenity = models.Amenity.objects.create(name="Query plan check", fee=1)
+        cls.room = models.Room.objects.create(name="Query plan check", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1)
+        cls.room.amenities.add(cls.amenity)
+        today = date.today()
+        models.Reservation.objects.create(
+            user=cls.user, room=cls.room, paid_price=1,
+            date_bookfrom=today + timedelta(days=1), date_bookuntil=today + timedelta(days=2),
+        )
+
+    def setUp(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("EXPLAIN QUERY PLAN is only checked on SQLite.")
+        self.client.force_login(self.user)
+
+    def assertNoFullScans(self, queries):
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith("SELECT"):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                plan = [row[-1] for row in cursor.fetchall()]
+            for line in plan:
+                for table in WATCHED_TABLES:
+                    self.assertIsNone(
+                        re.search(rf"\bSCAN {table}\b(?! USING (COVERING )?INDEX)", line),
+                        f"Full scan of {table} in {sql}\n" + "\n".join(plan),
+                    )
+
+    def assertViewPlans(self, method:str, url:str, data:dict=None):
+        with CaptureQueriesContext(connection) as queries:
+            getattr(self.client, method)(url, data or {})
+        self.assertNoFullScans(queries)
+
+    def stay(self) -> dict:
+        today = date.today()
+        return {'date_bookfrom': today + timedelta(days=3), 'date_bookuntil': today + timedelta(days=5)}
+
+    def test_index(self):
+        self.assertViewPlans("get", reverse("app-index"))
+
+    def test_room_index(self):
+        self.assertViewPlans("get", reverse("room:index"))
+        self.assertViewPlans("get", reverse("room:index"), {'q': "check"})
+
+    def test_room_search(self):
+        self.assertViewPlans("get", reverse("room:search"), {**self.stay(), 'amenities': [self.amenity.pk], 'capacity': 1})
+
+    def test_room_view(self):
+        self.assertViewPlans("get", reverse("room:view", args=[self.room.pk]))
+        self.assertViewPlans("post", reverse("room:view", args=[self.room.pk]), self.stay())
+
+    def test_reservation_index(self):
+        self.assertViewPlans("get", reverse("room:reservation:index"))
+
+    def test_amenity_index(self):
+        self.assertViewPlans("get", reverse("amenity:index"))
+
+    def test_reservation_index_uses_its_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(models.Reservation.objects.filter(user=self.user).order_by('date_bookfrom', 'uuid'))
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {queries.captured_queries[0]['sql']}")
+            plan = " ".join(row[-1] for row in cursor.fetchall())
+        self.assertIn("reservation_listing_idx", plan)
+
+    def test_occupancy_lookups(self):
+        month = (date.today(), date.today() + timedelta(days=31))
+        for lookup in (
+            lambda: availability.occupied_nights(*month),
+            lambda: availability.occupied_nights(*month, rooms=[self.room.pk]),
+            lambda: availability.room_is_free(self.room.pk, *month),
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                lookup()
+            self.assertNoFullScans(queries)
+
+
+
+class RoomPriceTests(TestCase):
+    """ The stored amenity fee and price of a room follow its amenities and base price, whatever side changes them """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.wifi = models.Amenity.objects.create(name="Wifi", fee=5)
+        cls.breakfast = models.Amenity.objects.create(name="Breakfast", fee=15)
+
+    def setUp(self):
+        self.room = models.Room.objects.create(name="Priced", type=models.Room.RoomTypes.STANDARD, base_price=50, capacity=2)
+
+    def assertPrice(self, fee, price):
+        stored = models.Room.objects.values_list('total_amenity_fee', 'price').get(pk=self.room.pk)
+        self.assertEqual(stored, (Decimal(fee), Decimal(price)))
+
+    def test_room_side(self):
+        self.assertPrice(0, 50)
+        self.room.amenities.add(self.wifi, self.breakfast)
+        self.assertPrice(20, 70)
+        self.assertEqual(self.room.price, 70) # Refreshed on the instance too
+        self.room.amenities.remove(self.wifi)
+        self.assertPrice(15, 65)
+        self.room.amenities.clear()
+        self.assertPrice(0, 50)
+
+    def test_amenity_side(self):
+        self.wifi.rooms.add(self.room)
+        self.breakfast.rooms.add(self.room)
+        self.assertPrice(20, 70)
+        self.breakfast.rooms.remove(self.room)
+        self.assertPrice(5, 55)
+        self.wifi.rooms.clear()
+        self.assertPrice(0, 50)
+
+    def test_amenity_fee_and_delete(self):
+        self.room.amenities.add(self.wifi, self.breakfast)
+        self.wifi.fee = 10
+        self.wifi.save()
+        self.assertPrice(25, 75)
+        self.breakfast.delete()
+        self.assertPrice(10, 60)
+
+    def test_base_price(self):
+        self.room.amenities.add(self.wifi)
+        self.room.base_price = 80
+        self.room.save()
+        self.assertPrice(5, 85)
+        self.assertEqual(self.room.price, 85)
+
+    def test_stale_instance(self):
+        self.room.amenities.add(self.wifi, self.breakfast)
+        stale = models.Room.objects.get(pk=self.room.pk) # e.g. bound to an edit form
+        self.wifi.rooms.clear()
+        self.breakfast.rooms.clear()
+        stale.name = "Renamed"
+        stale.save()
+        self.assertPrice(0, 50)
+        self.assertEqual(stale.price, 50)
+
+
+
+class RoomSearchTests(TestCase):
+    """ room:search leaves out the rooms an active reservation overlaps, and keeps the ones with every amenity asked for """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("searcher")
+        cls.wifi = models.Amenity.objects.create(name="Wifi", fee=5)
+        cls.pool = models.Amenity.objects.create(name="Pool", fee=5)
+        today = date.today()
+
+        def room(name, *stays, amenities=()):
+            room = models.Room.objects.create(name=name, type=models.Room.RoomTypes.STANDARD, base_price=100, capacity=2)
+            room.amenities.add(*amenities)
+            for start, end, checked_out in stays:
+                models.Reservation.objects.create(
+                    user=cls.user, room=room, paid_price=1,
+                    date_bookfrom=today + timedelta(days=start), date_bookuntil=today + timedelta(days=end),
+                    date_checkout=today if checked_out else None,
+                )
+            return room
+
+        # The search is for days 10 to 12
+        cls.overlapping = room("Overlapping", (11, 13, False), amenities=[cls.wifi, cls.pool])
+        cls.before = room("Before", (5, 10, False), amenities=[cls.wifi, cls.pool]) # Checks out the day the stay starts
+        cls.after = room("After", (12, 14, False), amenities=[cls.wifi]) # Checks in the day the stay ends
+        cls.checked_out = room("Checked out", (9, 13, True))
+        cls.free = room("Free", amenities=[cls.pool])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def search(self, **query) -> set:
+        today = date.today()
+        query = {'date_bookfrom': today + timedelta(days=10), 'date_bookuntil': today + timedelta(days=12), **query}
+        response = self.client.get(reverse("room:search"), query)
+        self.assertEqual(response.status_code, 200)
+        return {room.name for room in response.context['page']}
+
+    def test_overlaps(self):
+        self.assertEqual(self.search(), {"Before", "After", "Checked out", "Free"})
+
+    def test_amenities(self):
+        self.assertEqual(self.search(amenities=[self.wifi.pk]), {"Before", "After"})
+        self.assertEqual(self.search(amenities=[self.wifi.pk, self.pool.pk]), {"Before"})
+
+    def test_same_as_the_overlap_check(self):
+        start, end = date.today() + timedelta(days=10), date.today() + timedelta(days=12)
+        free = set(availability.available_rooms(start, end).values_list('pk', flat=True))
+        for room in models.Room.objects.all():
+            self.assertEqual(room.pk in free, not availability.active_overlaps(start, end).filter(room=room).exists())
+
+
+
+class RoomTextSearchTests(TestCase):
+    """ The full-text index follows the rooms and their amenities, and the LIKE lookups stand in without it """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.jacuzzi = models.Amenity.objects.create(name="Jacuzzi", fee=5)
+        cls.room = models.Room.objects.create(
+            name="Seaside suite", description="Wakes up to the waves", type=models.Room.RoomTypes.SUITE, base_price=100, capacity=2,
+        )
+        cls.room.amenities.add(cls.jacuzzi)
+
+    def requireFts(self):
+        if not search.fts_enabled():
+            self.skipTest("Needs SQLite with FTS5.")
+
+    def found(self, q:str) -> set:
+        rooms, _ = search.search_rooms(q)
+        return {room.pk for room in rooms}
+
+    def test_create(self):
+        self.requireFts()
+        self.assertEqual(self.found("seasi"), {self.room.pk}) # Words are prefixes
+        self.assertEqual(self.found("waves"), {self.room.pk})
+        self.assertEqual(self.found("jacuzzi"), {self.room.pk})
+        self.assertEqual(self.found("mountain"), set())
+
+    def test_update(self):
+        self.requireFts()
+        self.room.name = "Mountain lodge"
+        self.room.save()
+        self.assertEqual(self.found("mountain"), {self.room.pk})
+        self.assertEqual(self.found("seaside"), set())
+
+        self.jacuzzi.name = "Sauna"
+        self.jacuzzi.save()
+        self.assertEqual(self.found("sauna"), {self.room.pk})
+        self.room.amenities.remove(self.jacuzzi)
+        self.assertEqual(self.found("sauna"), set())
+
+    def test_delete(self):
+        self.requireFts()
+        pk = self.room.pk
+        self.room.delete()
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {search.FTS_TABLE} WHERE uuid = %s", [pk.hex])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_snippet(self):
+        self.requireFts()
+        _, snippets = search.search_rooms("waves")
+        self.assertIn("<mark>waves</mark>", snippets[self.room.pk])
+
+    def test_like_fallback(self):
+        with mock.patch.object(search, "fts_enabled", return_value=False):
+            self.assertEqual(self.found("SIDE SU"), {self.room.pk}) # Anywhere in the name, any case
+            self.assertEqual(self.found("suite"), {self.room.pk}) # The type's label
+            self.assertEqual(self.found("jacuz"), {self.room.pk})
+            self.assertEqual(self.found("mountain"), set())
+
+
+
+class RoomNightTests(TestCase):
+    """ The RoomNight table holds one row per night of every active reservation """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("sleeper")
+        cls.rooms = make_rooms(2, cls.user)
+
+    def assertNightsMatch(self):
+        expected = {
+            (reservation.room_id, reservation.pk, night)
+            for reservation in models.Reservation.objects.filter(date_checkout__isnull=True)
+            for night in availability.stay_nights(reservation.date_bookfrom, reservation.date_bookuntil)
+        }
+        self.assertEqual(set(models.RoomNight.objects.values_list('room_id', 'reservation_id', 'date')), expected)
+
+    def test_booking(self):
+        self.assertEqual(models.RoomNight.objects.count(), 8) # Two rooms with two stays of two nights
+        self.assertNightsMatch()
+
+        reservation = models.Reservation.objects.filter(room=self.rooms[0]).first()
+        reservation.room = self.rooms[1]
+        reservation.date_bookuntil += timedelta(days=3)
+        reservation.save()
+        self.assertEqual(models.RoomNight.objects.filter(reservation=reservation, room=self.rooms[1]).count(), 5)
+        self.assertNightsMatch()
+
+    def test_checkin_and_checkout(self):
+        reservation = models.Reservation.objects.filter(room=self.rooms[0]).first()
+        reservation.date_checkin = timezone.now()
+        with self.assertNumQueries(2): # The save and reading its nights back
+            reservation.save()
+        self.assertEqual(models.RoomNight.objects.filter(reservation=reservation).count(), 2)
+
+        reservation.date_checkout = timezone.now()
+        reservation.save()
+        self.assertFalse(models.RoomNight.objects.filter(reservation=reservation).exists())
+        self.assertNightsMatch()
+
+    def test_delete(self):
+        models.Reservation.objects.filter(room=self.rooms[0]).delete()
+        self.assertFalse(models.RoomNight.objects.filter(room=self.rooms[0]).exists())
+        self.rooms[1].delete()
+        self.assertFalse(models.RoomNight.objects.exists())
+
+    def test_rebuild(self):
+        # Writes that skip the signals leave the table out of step
+        models.RoomNight.objects.filter(room=self.rooms[0]).delete()
+        models.Reservation.objects.filter(room=self.rooms[1]).update(date_checkout=timezone.now())
+        stdout = StringIO()
+        call_command("rebuild_room_nights", batch_size=3, stdout=stdout)
+        self.assertIn("4 room nights rebuilt", stdout.getvalue())
+        self.assertNightsMatch()
+
+
+
+class OccupancyMatrixTests(TestCase):
+    """ The shared occupancy matrix agrees with the active reservations after every write """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("mapper")
+        cls.rooms = make_rooms(2, cls.user)
+
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(OCCUPANCY_MATRIX=Path(directory.name) / "occupancy", OCCUPANCY_MATRIX_ROOMS=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(occupancy_matrix._close) # Before the directory goes
+        self.today = date.today()
+
+    def days(self, first:int, last:int) -> tuple:
+        return self.today + timedelta(days=first), self.today + timedelta(days=last)
+
+    def assertMatches(self):
+        self.assertEqual(occupancy_matrix.check(), {})
+        stdout = StringIO()
+        call_command("check_occupancy_matrix", stdout=stdout)
+        self.assertIn("matches", stdout.getvalue())
+
+    def test_rebuild(self):
+        call_command("rebuild_occupancy_matrix", stdout=StringIO())
+        self.assertMatches()
+        self.assertEqual(occupancy_matrix.taken_rooms(*self.days(10, 12)), {room.pk for room in self.rooms})
+        self.assertEqual(occupancy_matrix.taken_rooms(*self.days(12, 30)), set())
+        self.assertIsNone(occupancy_matrix.taken_rooms(*self.days(-5, 1))) # Before the window, left to the database
+
+    def test_writes(self):
+        occupancy_matrix.rebuild()
+        start, end = self.days(50, 53)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = models.Reservation(user=self.user, room=self.rooms[0], paid_price=1, date_bookfrom=start, date_bookuntil=end)
+            availability.book(reservation)
+        self.assertEqual(occupancy_matrix.taken_rooms(start, end), {self.rooms[0].pk})
+        self.assertMatches()
+
+        reservation.date_checkout = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.save()
+        self.assertEqual(occupancy_matrix.taken_rooms(start, end), set())
+        self.assertMatches()
+
+        # A room the matrix has no row for yet, past its capacity of two
+        room = models.Room.objects.create(name="Third", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Reservation.objects.create(user=self.user, room=room, paid_price=1, date_bookfrom=start, date_bookuntil=end)
+        self.assertEqual(occupancy_matrix.taken_rooms(start, end), {room.pk})
+        self.assertMatches()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Reservation.objects.filter(room=self.rooms[1]).delete()
+        self.assertEqual(occupancy_matrix.taken_rooms(*self.days(10, 12)), {self.rooms[0].pk})
+        self.assertMatches()
+
+    def test_repair(self):
+        occupancy_matrix.rebuild()
+        # A checkout that skips the signals leaves the matrix behind
+        models.Reservation.objects.filter(room=self.rooms[0]).update(date_checkout=timezone.now())
+        models.RoomNight.objects.filter(room=self.rooms[0]).delete()
+
+        self.assertEqual(len(occupancy_matrix.check()[self.rooms[0].pk]), 4)
+        with self.assertRaises(CommandError):
+            call_command("check_occupancy_matrix", stdout=StringIO())
+        call_command("check_occupancy_matrix", repair=True, stdout=StringIO())
+        self.assertMatches()
+
+
+
+class FragmentTests(TestCase):
+    """ A cached room card is rendered again once the room, its amenities or its reservations change """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("viewer")
+        cls.room = make_rooms(1, cls.user)[0]
+
+    def setUp(self):
+        fragments.get_cache().clear()
+
+    def card(self) -> str:
+        room = models.Room.objects.get(pk=self.room.pk)
+        return fragments.room_fragments([room], "app/room/card.html", {'user': self.user})[0]
+
+    def test_cached(self):
+        first = self.card()
+        room = models.Room.objects.get(pk=self.room.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(fragments.room_fragments([room], "app/room/card.html", {'user': self.user}), [first])
+
+    def test_room_change(self):
+        self.card()
+        self.room.name = "Renamed"
+        self.room.save()
+        self.assertIn("Renamed", self.card())
+
+    def test_amenity_change(self):
+        self.card()
+        wifi = models.Amenity.objects.get(name="Wifi")
+        wifi.name = "Fast wifi"
+        wifi.save()
+        self.assertIn("Fast wifi", self.card())
+
+        pool = models.Amenity.objects.create(name="Pool", fee=1)
+        self.room.amenities.add(pool)
+        self.assertIn("Pool", self.card())
+        pool.rooms.remove(self.room)
+        self.assertNotIn("Pool", self.card())
+
+        wifi.delete()
+        self.assertNotIn("Fast wifi", self.card())
+
+    def test_reservation_change(self):
+        self.card()
+        start = date.today() + timedelta(days=50)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = models.Reservation.objects.create(
+                user=self.user, room=self.room, paid_price=1, date_bookfrom=start, date_bookuntil=start + timedelta(days=1),
+            )
+        self.assertIn(date_format(start), self.card())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.delete()
+        self.assertNotIn(date_format(start), self.card())
+
+
+
+class BookingTests(TestCase):
+    """ book() checks the room's and the user's overlaps in a single query before saving """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("booker")
+        cls.other = User.objects.create_user("other_booker")
+        cls.room = make_rooms(1, cls.user)[0]
+
+    def reservation(self, user, room, days:int, nights:int=2):
+        """ A reservation starting `days` from today """
+        start = date.today() + timedelta(days=days)
+        return models.Reservation(user=user, room=room, paid_price=1, date_bookfrom=start, date_bookuntil=start + timedelta(days=nights))
+
+    def test_one_overlap_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            availability.book(self.reservation(self.other, self.room, 100))
+        reads = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT') and '"app_reservation"' in query['sql']]
+        self.assertEqual(len(reads), 1)
+
+    def test_overlaps(self):
+        # make_rooms() booked both rooms for the user on days 10 to 12
+        with self.assertRaises(availability.RoomOverlap):
+            availability.book(self.reservation(self.other, self.room, 11))
+        spare = models.Room.objects.create(name="Spare", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1)
+        with self.assertRaises(availability.UserOverlap):
+            availability.book(self.reservation(self.user, spare, 11))
+        availability.book(self.reservation(self.other, self.room, 12)) # Checks in the day the other one checks out
+        self.assertEqual(models.Reservation.objects.filter(user=self.other).count(), 1)
+
+
+
+class IdempotencyTests(TestCase):
+    """ A booking POSTed again with the same key is answered with the first response """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("retrier")
+        cls.room = models.Room.objects.create(name="Keyed", type=models.Room.RoomTypes.STANDARD, base_price=100, capacity=2)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse("room:view", args=[self.room.pk])
+        start = date.today() + timedelta(days=5)
+        self.data = {'date_bookfrom': start, 'date_bookuntil': start + timedelta(days=2), 'idempotency_key': "key-1"}
+
+    def keep(self, **fields):
+        """ A stored key as another request would have left it """
+        defaults = {'key': "key-1", 'path': self.url, 'date_expire': timezone.now() + timedelta(hours=1)}
+        return models.IdempotencyKey.objects.create(user=self.user, **(defaults | fields))
+
+    def test_replay(self):
+        first = self.client.post(self.url, self.data)
+        second = self.client.post(self.url, self.data)
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual((second.status_code, second["Location"]), (302, first["Location"]))
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertFalse(first.has_header("Idempotent-Replayed"))
+        self.assertEqual(models.Reservation.objects.count(), 1)
+
+    def test_other_path(self):
+        self.keep(path="/somewhere/else/", status_code=302)
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(models.Reservation.objects.exists())
+
+    def test_in_flight(self):
+        self.keep()
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(models.Reservation.objects.exists())
+
+    def test_expired_key_is_new(self):
+        self.keep(status_code=302, location="/old/", date_expire=timezone.now() - timedelta(seconds=1))
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+        self.assertEqual(models.Reservation.objects.count(), 1)
+        self.assertEqual(models.IdempotencyKey.objects.get().location, response["Location"])
+
+    def test_busy_booking_is_not_kept(self):
+        with mock.patch.object(availability, "book", side_effect=availability.BookingBusy):
+            response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(models.IdempotencyKey.objects.exists())
+        self.assertEqual(self.client.post(self.url, self.data).status_code, 302)
+
+    @override_settings(IDEMPOTENCY_PURGE_EVERY=0)
+    def test_purge(self):
+        self.keep(key="old", status_code=302, date_expire=timezone.now() - timedelta(seconds=1))
+        self.client.post(self.url, self.data)
+        self.assertEqual(models.IdempotencyKey.objects.count(), 2) # Only purged by the command
+        call_command("purge_idempotency_keys", stdout=StringIO())
+        self.assertEqual(list(models.IdempotencyKey.objects.values_list('key', flat=True)), ["key-1"])
+
+
+
+@override_settings(BOOKING_RETRIES=10)
+class ConcurrentBookingTests(TransactionTestCase):
+    """ Many simultaneous bookings of the same room and dates: exactly one wins """
+
+    THREADS = 16
+    ATTEMPTS = 200
+
+    def test_one_booking_wins(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("Needs a database file the threads can share, see DATABASES['default']['TEST'].")
+
+        room = models.Room.objects.create(name="Contested", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1)
+        users = [User.objects.create_user(f"guest_{i}") for i in range(self.ATTEMPTS)]
+        date_bookfrom = date.today() + timedelta(days=30)
+        barrier = Barrier(self.THREADS)
+
+        def attempt(i):
+            if i < self.THREADS:
+                barrier.wait() # Line the first wave up
+            try:
+                availability.book(models.Reservation(
+                    user=users[i], room=room, paid_price=1,
+                    date_bookfrom=date_bookfrom, date_bookuntil=date_bookfrom + timedelta(days=2),
+                ))
+                return "booked"
+            except availability.RoomOverlap:
+                return "overlap"
+            except availability.BookingBusy:
+                return "busy"
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.THREADS) as pool:
+            results = list(pool.map(attempt, range(self.ATTEMPTS)))
+
+        self.assertEqual(results.count("booked"), 1)
+        self.assertEqual(models.Reservation.objects.filter(room=room).count(), 1)
+        self.assertEqual(models.RoomNight.objects.filter(room=room).count(), 2)
+
+
+
+class CursorTests(TestCase):
+    """ A cursor that doesn't decode to values of the ordering's fields shows the first page """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("cursor")
+        make_rooms(2, cls.user)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_tampered_cursor(self):
+        cursor = encode_cursor(["abc", "abc"], "next")
+        for query in ({'cursor': cursor}, {'q': "room", 'cursor': cursor}, {'cursor': "not base64!"}):
+            response = self.client.get(reverse("room:index"), query)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.context['page'].has_previous)
+
+
+
+class RoomCalendarTests(TestCase):
+    """ The calendar clamps ?month= to the months a date can hold and drops the links past them """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("calendar")
+        cls.room = make_rooms(1, cls.user)[0]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_edges(self):
+        url = reverse("room:view", args=[self.room.pk])
+        for month, edge, other in (("0001-01", 'previous', 'next'), ("9999-12", 'next', 'previous')):
+            response = self.client.get(url, {'month': month})
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.context['calendar'][edge])
+            self.assertIsNotNone(response.context['calendar'][other])
+
+
+
+class AvailabilityApiTests(TransactionTestCase):
+    """ The availability API's ETag follows the room nights, and a call can't span more than AVAILABILITY_API_MAX_SPAN nights
+
+    The version behind the ETag is counted as transactions commit, so these commit for real.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user("channel")
+        self.room = make_rooms(1, self.user)[0]
+
+    def get(self, query:dict=None, etag:str=None):
+        headers = {'if_none_match': etag} if etag else {}
+        return self.client.get(reverse("room:availability"), query or {}, headers=headers)
+
+    def test_etag_follows_the_nights(self):
+        etag = self.get()["ETag"]
+        self.assertEqual(self.get(etag=etag).status_code, 304)
+
+        reservation = self.room.reservations.first()
+        reservation.date_checkout = date.today()
+        reservation.save()
+        self.assertEqual(self.get(etag=etag).status_code, 200)
+
+        etag = self.get()["ETag"]
+        self.room.reservations.exclude(pk=reservation.pk).get().delete()
+        self.assertEqual(self.get(etag=etag).status_code, 200)
+
+    def test_unchanged_nights_keep_the_version(self):
+        reservation = self.room.reservations.first()
+        stamp = inventory.inventory_stamp()
+        reservation.date_checkin = date.today()
+        reservation.save()
+        self.assertEqual(inventory.inventory_stamp(), stamp)
+
+    def test_one_bump_per_transaction(self):
+        make_rooms(10, self.user, first=1)
+        stamp = int(inventory.inventory_stamp())
+        with self.assertNumQueries(6): # Reading the reservations, deleting them and their nights, and a single bump once committed
+            models.Reservation.objects.all().delete()
+        self.assertEqual(int(inventory.inventory_stamp()), stamp + 1)
+
+    @override_settings(AVAILABILITY_API_MAX_SPAN=100)
+    def test_span(self):
+        today = date.today()
+        near = f"{self.room.pk},{today},{today + timedelta(days=2)}"
+        far = f"{self.room.pk},{today + timedelta(days=200)},{today + timedelta(days=202)}"
+        self.assertEqual(self.get({'q': [near]}).status_code, 200)
+        self.assertEqual(self.get({'q': [near, far]}).status_code, 400)
+
+
+
+class RequestProfilerTests(TestCase):
+    """ ?_profile=1 answers staff users with a report, and leaves the template rendering as it was """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("profiler", is_staff=True)
+        make_rooms(1, cls.user)
+
+    def test_profile(self):
+        self.client.force_login(self.user)
+        render = base.Template.render
+        response = self.client.get(reverse("room:index"), {'_profile': "1"})
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+        self.assertIn("app/room/index.html", response.content.decode())
+        self.assertIs(base.Template.render, render)
+
+
+
+class MetricsTests(TestCase):
+    """ /metrics is closed without a token, and the files of exited processes are merged into a live one's """
+
+    def test_closed_without_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        with self.settings(METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+            self.assertEqual(self.client.get(reverse("metrics"), headers={'authorization': "Bearer secret"}).status_code, 200)
+
+    def test_dead_process_files(self):
+        saved = deepcopy(metrics._values)
+        self.addCleanup(lambda: (metrics._values.clear(), metrics._values.update(saved)))
+
+        with TemporaryDirectory() as directory, self.settings(METRICS_DIR=directory):
+            before = metrics.collect().get(("hotel_checkins_total", ()), 0)
+            dead = Path(directory) / "999999999-deadbeef.json" # Past any pid_max
+            dead.write_text(json.dumps({'time': 0, 'values': [
+                ["hotel_checkins_total", [], 3],
+                ["hotel_http_requests_in_flight", [], 5],
+            ]}))
+
+            total = metrics.collect()
+            self.assertEqual(total[("hotel_checkins_total", ())], before + 3)
+            self.assertFalse(dead.exists())
+            self.assertEqual([path.name for path in Path(directory).iterdir()], [f"{metrics._PROCESS}.json"])
+            self.assertEqual(metrics.collect()[("hotel_checkins_total", ())], before + 3)
+
+
+
+class BuildImageRenditionsTests(TestCase):
+    """ build_image_renditions reports the images it can't render as failed and carries on """
+
+    def test_failures(self):
+        errors = [
+            OSError("cannot identify image file"),
+            Image.DecompressionBombError("Image size exceeds limit"),
+            SyntaxError("broken PNG file"),
+            ValueError("tile cannot extend outside image"),
+        ]
+        for error in errors:
+            with self.subTest(error=type(error).__name__), mock.patch.object(renditions, "build_renditions", side_effect=error):
+                name, manifest, outcome, message = build_image_renditions._render((models.Room, "rooms/a.jpg", {'old': True}, True))
+                self.assertEqual((name, manifest, outcome), ("rooms/a.jpg", {'old': True}, "failed"))
+                self.assertIn(type(error).__name__, message)
+
+
+
+class ContentAddressedStorageTests(TestCase):
+    """ Identical files are stored once and go with their last reference, files of rolled back transactions are collected """
+
+    def setUp(self):
+        self.media = temporary_media(self)
+        self.storage = image_storage()
+
+    def blob_files(self) -> list:
+        return sorted(path for path in (self.media / "blobs").rglob("*") if path.is_file())
+
+    def test_identical_uploads(self):
+        data = make_image()
+        with self.captureOnCommitCallbacks(execute=True):
+            rooms = [
+                models.Room.objects.create(name=f"Twin {i}", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1, image=SimpleUploadedFile("twin.jpg", data))
+                for i in range(2)
+            ]
+        self.assertEqual(rooms[0].image.name, rooms[1].image.name)
+        self.assertEqual(len(self.blob_files()), 1)
+        self.assertEqual(models.Blob.objects.get(name=rooms[0].image.name).references, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for job in models.ImageJob.objects.all():
+                self.assertEqual(imagejobs.run_job(job.pk), "done")
+        room = models.Room.objects.get(pk=rooms[0].pk)
+        files = len(self.blob_files())
+        self.assertEqual(files, 1 + 2 * len(room.image_renditions['sizes'])) # The resized copy and its renditions, once
+        self.assertEqual(set(models.Blob.objects.values_list('references', flat=True)), {2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Room.objects.get(pk=rooms[0].pk).delete()
+        self.assertEqual(len(self.blob_files()), files)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Room.objects.get(pk=rooms[1].pk).delete()
+        self.assertEqual(self.blob_files(), [])
+        self.assertFalse(models.Blob.objects.exists())
+
+    def test_rolled_back_files(self):
+        kept = self.storage.save("images/rooms/kept.jpg", ContentFile(make_image("blue")))
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            orphan = self.storage.save("images/rooms/orphan.jpg", ContentFile(make_image("green")))
+            raise RuntimeError
+        self.assertTrue(self.storage.exists(orphan))
+        self.assertFalse(models.Blob.objects.filter(name=orphan).exists())
+
+        self.assertEqual(self.storage.collect_orphans(), 0) # Its transaction may still be open
+        for path in self.blob_files():
+            os.utime(path, (0, 0))
+        stdout = StringIO()
+        call_command("collect_blobs", stdout=stdout)
+        self.assertIn("1 orphaned blobs removed", stdout.getvalue())
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertTrue(self.storage.exists(kept))
+
+    def test_renditions_are_counted_again(self):
+        name = self.storage.save("images/rooms/a.jpg", ContentFile(make_image()))
+        image = models.Room._meta.get_field("image").attr_class(None, models.Room._meta.get_field("image"), name)
+        first = renditions.build_renditions(image)
+        second = renditions.build_renditions(image)
+        self.assertEqual(first['sizes'], second['sizes'])
+        for size in first['sizes']:
+            self.assertEqual(models.Blob.objects.get(name=size['webp']).references, 2)
+
+
+
+class RenditionTests(TestCase):
+    """ Images are rendered at every IMAGE_RENDITIONS width they're larger than, and shown as a <picture> of them """
+
+    def setUp(self):
+        temporary_media(self)
+        self.field = models.Room._meta.get_field("image")
+
+    def stored(self, data:bytes):
+        name = image_storage().save("images/rooms/photo.jpg", ContentFile(data))
+        return self.field.attr_class(None, self.field, name)
+
+    def test_manifest(self):
+        image = self.stored(make_image(size=(800, 600)))
+        manifest = renditions.build_renditions(image)
+
+        self.assertEqual((manifest['source'], manifest['config']), (image.name, renditions.config()))
+        self.assertEqual(manifest['hash'], renditions.content_hash(image.storage.open(image.name).read()))
+        self.assertEqual(
+            [(size['name'], size['width'], size['height']) for size in manifest['sizes']],
+            [("thumb", 200, 150), ("card", 640, 480), ("full", 800, 600)], # Never scaled up
+        )
+        for size in manifest['sizes']:
+            for extension in renditions.FORMATS:
+                with image.storage.open(size[extension]) as file, Image.open(file) as rendered:
+                    self.assertEqual((rendered.format, rendered.size), (renditions.FORMATS[extension][0], (size['width'], size['height'])))
+        self.assertTrue(renditions.up_to_date(image, manifest))
+
+        small = renditions.build_renditions(self.stored(make_image("blue", size=(300, 100))))
+        self.assertEqual([(size['name'], size['width']) for size in small['sizes']], [("thumb", 200), ("card", 300)])
+
+    def test_picture(self):
+        image = self.stored(make_image())
+        manifest = renditions.build_renditions(image)
+        html = renditions.picture(image, manifest, sizes="50vw", width=300, data_bs_toggle="modal", alt="")
+
+        url = image.storage.url
+        webp = ", ".join(f"{url(size['webp'])} {size['width']}w" for size in manifest['sizes'])
+        self.assertIn(f'<source type="image/webp" srcset="{webp}" sizes="50vw">', html)
+        self.assertIn(f'<img src="{url(manifest["sizes"][1]["jpg"])}"', html) # The smallest at least 300px wide
+        for attribute in ('data-bs-toggle="modal"', 'loading="lazy"', 'decoding="async"', 'width="300"'):
+            self.assertIn(attribute, html)
+
+        self.assertIn('data-pending="true"', renditions.picture(image, {'source': image.name, 'pending': True}))
+        self.assertNotIn("<picture>", renditions.picture(image, {**manifest, 'source': "images/rooms/replaced.jpg"}))
+        self.assertIn(f'<img src="{image.url}"', renditions.picture(image, {}))
+
+    def test_template_tag(self):
+        room = models.Room(image=self.stored(make_image()).name)
+        room.image_renditions = renditions.build_renditions(room.image)
+        html = Template('{% load images %}{% picture room.image room.image_renditions sizes="25vw" class="card-img-top" %}').render(Context({'room': room}))
+        self.assertEqual(html, renditions.picture(room.image, room.image_renditions, "25vw", **{'class': "card-img-top"}))
+
+
+
+class ImageJobTests(TestCase):
+    """ Uploads are stored as they are and resized and rendered by a job, retried with a backoff and then given up on """
+
+    def setUp(self):
+        temporary_media(self)
+
+    def upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            room = models.Room.objects.create(
+                name="Uploaded", type=models.Room.RoomTypes.STANDARD, base_price=1, capacity=1,
+                image=SimpleUploadedFile("upload.jpg", make_image(size=(2400, 1800))),
+            )
+        return room, models.ImageJob.objects.get(object_id=room.pk)
+
+    def test_done(self):
+        room, job = self.upload()
+        self.assertEqual(job.status, models.ImageJob.Statuses.PENDING)
+        self.assertEqual(room.image_renditions, {'source': room.image.name, 'pending': True})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(imagejobs.run_job(job.pk), "done")
+            self.assertEqual(imagejobs.run_job(job.pk), "skipped") # Not due anymore
+
+        room.refresh_from_db()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (models.ImageJob.Statuses.DONE, 1))
+        self.assertNotEqual(room.image.name, job.source)
+        self.assertFalse(room.image.storage.exists(job.source)) # The upload as it was sent
+        with Image.open(room.image) as resized:
+            self.assertLess(max(resized.size), 2400) # Resized as the field is set up
+        self.assertTrue(renditions.up_to_date(room.image, room.image_renditions))
+
+    @override_settings(IMAGE_JOB_ATTEMPTS=2, IMAGE_JOB_RETRY_BACKOFF=30)
+    def test_retry_and_give_up(self):
+        room, job = self.upload()
+        blobs = set(models.Blob.objects.values_list('name', flat=True))
+
+        with mock.patch.object(renditions, "build_renditions", side_effect=OSError("disk full")):
+            with self.captureOnCommitCallbacks(execute=True), self.assertLogs("app.imagejobs", "ERROR"):
+                self.assertEqual(imagejobs.run_job(job.pk), "retry")
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (models.ImageJob.Statuses.PENDING, 1))
+            self.assertIn("disk full", job.error)
+            self.assertAlmostEqual((job.run_after - timezone.now()).total_seconds(), imagejobs.backoff(1), delta=5)
+            self.assertEqual(imagejobs.run_job(job.pk), "skipped") # Not due before the backoff
+
+            models.ImageJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            with self.captureOnCommitCallbacks(execute=True), self.assertLogs("app.imagejobs", "ERROR"):
+                self.assertEqual(imagejobs.run_job(job.pk), "failed")
+
+        job.refresh_from_db()
+        room.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (models.ImageJob.Statuses.FAILED, 2))
+        self.assertEqual(room.image.name, job.source)
+        self.assertEqual(room.image_renditions, {}) # Shown as it was uploaded
+        self.assertEqual(set(models.Blob.objects.values_list('name', flat=True)), blobs) # The resized copies went
+        self.assertIn(f'<img src="{room.image.url}"', renditions.picture(room.image, room.image_renditions))
+
+
+
+class ImagePreviewTests(TestCase):
+    """ Every manifest carries a tiny inlined WebP, which the <img> shows as its background until it loads """
+
+    def setUp(self):
+        temporary_media(self)
+        self.field = models.Room._meta.get_field("image")
+        name = image_storage().save("images/rooms/wide.jpg", ContentFile(make_image(size=(900, 300))))
+        self.image = self.field.attr_class(None, self.field, name)
+
+    def decode(self, manifest:dict):
+        header, data = manifest['preview'].split(",", 1)
+        self.assertEqual(header, "data:image/webp;base64")
+        return Image.open(BytesIO(b64decode(data)))
+
+    def test_preview(self):
+        manifest = renditions.build_renditions(self.image)
+        with self.decode(manifest) as preview:
+            self.assertEqual((preview.format, preview.size), ("WEBP", (16, 5)))
+        self.assertTrue(renditions.preview_current(manifest))
+
+        html = renditions.picture(self.image, manifest, style="opacity: 1;")
+        self.assertIn(f'style="opacity: 1; background: center / cover no-repeat url({manifest["preview"]})"', html)
+        self.assertNotIn("background", renditions.picture(self.image, {**manifest, 'source': "images/rooms/replaced.jpg"}))
+
+    @override_settings(IMAGE_PREVIEW_SIZE=32)
+    def test_backfill(self):
+        with self.settings(IMAGE_PREVIEW_SIZE=16):
+            manifest = renditions.build_renditions(self.image)
+        self.assertFalse(renditions.preview_current(manifest))
+
+        name, backfilled, outcome, error = build_image_renditions._render((models.Room, self.image.name, manifest, False))
+        self.assertEqual((name, outcome, error), (self.image.name, "previewed", None))
+        self.assertEqual(backfilled['sizes'], manifest['sizes']) # The renditions stay as they are
+        self.assertEqual(backfilled['preview_size'], 32)
+        with self.decode(backfilled) as preview:
+            self.assertEqual(max(preview.size), 32)
+        self.assertEqual(build_image_renditions._render((models.Room, self.image.name, backfilled, False))[2], "up to date")
@@ -76,6 +76,8 @@ reservation_patterns = [
 
 room_patterns = [
 	path("all/", views.room_index, name="index"),
+	path("search/", views.room_search, name="search"),
+	path("availability/", views.room_availability, name="availability"),
 	path("add/", views.room_add, name="add"),
 	path("update/<uuid:pk>/", views.room_update, name="update"),
 	path("delete/<uuid:pk>/", views.room_delete, name="delete"),
@@ -87,6 +89,7 @@ room_patterns = [
 
 urlpatterns = [
 	path("", views.index, name="app-index"),
+	path("metrics", views.metrics_view, name="metrics"),
 
 	path("auth/", include((auth_patterns, 'auth'))),
 	path("auth/password_change/", include((password_change_patterns))),
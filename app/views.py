@@ -1,5 +1,6 @@
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, HttpRequest
+from django.http import HttpResponse, HttpRequest, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
@@ -8,13 +9,18 @@ from urllib.parse import unquote # For decoding encoded urls (e.g. https%3A%2F%2
 # from django.contrib.auth.tokens import default_token_generator
 # from django.utils.http import urlsafe_base64_decode
 from django.utils import timezone
+from django.views.decorators.http import condition, require_GET
+from django.views.static import serve
+from django.core.paginator import Paginator
 
 # from pathlib import Path
 # from uuid import uuid4
 
 import logging
 
-from . import forms, models
+from . import availability, calendars, forms, fragments, inventory, metrics, models, pagination, search
+from .idempotency import idempotent
+from .storage import BLOBS, image_storage
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -25,16 +31,43 @@ logger = logging.getLogger(__name__)
 def index(request):
     """ Shows the index/home/dashboard page """
 
-    rooms = models.Room.objects.all().order_by('-date_update')[:12]
-    rooms = [[room, room.reservations.filter(date_checkout__isnull=True).order_by('date_bookfrom')] for room in rooms]
+    rooms = list(models.Room.objects.order_by('-date_update')[:12])
+    cards = fragments.room_fragments(
+        rooms, "app/room/card.html", {'user': request.user},
+        variant=f"superuser={request.user.is_superuser}",
+    )
 
     context = {
-        "rooms": rooms,
+        "cards": cards,
     }
 
     return render(request, "app/index.html", context)
 
 
+def metrics_view(request):
+    """ The metrics of every worker process, in the Prometheus text format """
+
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if not token and not settings.DEBUG: # Closed until a token is set
+        return HttpResponse("Forbidden, set METRICS_TOKEN to read the metrics", status=403)
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse("Unauthorized", status=401)
+
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def media_blob(request, path):
+    """ A file of the content-addressed image storage. Its name changes with its content, so it's cached for good
+
+    Only routed with DEBUG on, like the rest of media/ (see main/urls.py).
+    """
+
+    storage = image_storage()
+    response = serve(request, f"{BLOBS}/{path}", document_root=storage.location)
+    response["Cache-Control"] = f"public, max-age={getattr(settings, 'BLOB_CACHE_MAX_AGE', 365 * 24 * 60 * 60)}, immutable"
+    return response
+
+
 def signin(request):
     """ User Login View """
 
@@ -169,10 +202,25 @@ def profile_delete(request, pk):
 def amenity_index(request):
     """ A dummy view """
 
-    amenities = models.Amenity.objects.all()
+    page = pagination.paginate(request, models.Amenity.objects.all(), ['-date_update', '-uuid'])
+
+    if request.GET.get("format") == "json":
+        return JsonResponse({
+            'results': [
+                {
+                    'uuid': amenity.pk,
+                    'name': amenity.name,
+                    'fee': amenity.fee,
+                }
+                for amenity in page
+            ],
+            'next': page.next_cursor,
+            'previous': page.previous_cursor,
+        })
 
     context = {
-        'amenities': amenities,
+        'amenities': page,
+        'page': page,
         "current_url": request.build_absolute_uri(),
     }
 
@@ -302,21 +350,119 @@ def room_index(request):
     # else:
     #     # If the user is not a superuser, show only available rooms
     #     rooms = models.Room.objects.filter(is_available=True)
-    q = request.GET.get("q", "")
-    print(f"{q = }")
+    q = request.GET.get("q", "").strip()
+    as_json = request.GET.get("format") == "json"
+    snippets = {}
     if q:
-        rooms = models.Room.objects.filter(name__icontains=q)
+        # Full-text matches, best first
+        rooms, snippets = search.search_rooms(q)
+        page = pagination.paginate(request, rooms.with_listing(), ['search_rank', 'uuid'])
     else:
-        rooms = models.Room.objects.filter()
+        # The HTML rows come from the fragment cache, which loads the rooms it misses itself
+        rooms = models.Room.objects.with_listing() if as_json else models.Room.objects.all()
+        page = pagination.paginate(request, rooms, ['-date_update', '-uuid'])
+
+    for room in page:
+        room.search_snippet = snippets.get(room.pk)
+
+    if as_json:
+        return JsonResponse({
+            'results': [
+                {
+                    'uuid': room.pk,
+                    'name': room.name,
+                    'type': room.type,
+                    'capacity': room.capacity,
+                    'price': room.price,
+                    'amenities': [amenity.name for amenity in room.amenities.all()],
+                    'snippet': room.search_snippet,
+                    'unavailable_dates': [
+                        [reservation.date_bookfrom, reservation.date_bookuntil]
+                        for reservation in room.active_reservations
+                    ],
+                }
+                for room in page
+            ],
+            'next': page.next_cursor,
+            'previous': page.previous_cursor,
+        })
+
+    current_url = request.build_absolute_uri()
+    rows = fragments.room_fragments(
+        list(page), "app/room/row.html", {'user': request.user, 'current_url': current_url},
+        # The superusers' links lead back to the current page
+        variant=f"superuser={current_url}" if request.user.is_superuser else "",
+        cached=not q, # The snippets differ for every search
+    )
+
+    context = {
+        'rows': rows,
+        'page': page,
+        'q': q,
+        'current_url': current_url,
+    }
 
-    rooms = [[room, room.reservations.filter(date_checkout__isnull=True).order_by('date_bookfrom')] for room in rooms]
+    return render(request, "app/room/index.html", context)
+
+
+
+def room_search(request):
+    """ View for finding the rooms that are free for a date range """
+
+    form = forms.RoomSearchForm(request.GET or None)
+    page = None
+
+    if form.is_valid():
+        rooms = availability.available_rooms(
+            form.cleaned_data['date_bookfrom'],
+            form.cleaned_data['date_bookuntil'],
+            type = form.cleaned_data['type'],
+            capacity = form.cleaned_data['capacity'],
+            amenities = form.cleaned_data['amenities'],
+        )
+        sort = form.cleaned_data['sort'] or "price"
+        rooms = rooms.order_by(sort, 'pk')
+        page = Paginator(rooms.prefetch_related('amenities'), 20).get_page(request.GET.get("page"))
+
+    # The current query without the page number, for the page links
+    query = request.GET.copy()
+    query.pop("page", None)
 
     context = {
-        'rooms': rooms,
+        'form': form,
+        'page': page,
+        'query': query.urlencode(),
+        'title': "Find a room",
         'current_url': request.build_absolute_uri(),
     }
 
-    return render(request, "app/room/index.html", context)
+    return render(request, "app/room/search.html", context)
+
+
+
+def room_availability_etag(request):
+    try:
+        return inventory.etag(inventory.parse_queries(request.GET))
+    except inventory.QueryError:
+        return None
+
+
+@require_GET
+@condition(etag_func=room_availability_etag)
+def room_availability(request):
+    """ The taken nights of many rooms and date ranges in one call, for channel managers (see inventory.py)
+
+    Answers If-None-Match with a 304 as long as no room or reservation changed.
+    """
+
+    try:
+        queries = inventory.parse_queries(request.GET)
+    except inventory.QueryError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    response = StreamingHttpResponse(inventory.stream(inventory.answer(queries)), content_type="application/json")
+    response["Cache-Control"] = "no-cache" # Always revalidated, which is cheap
+    return response
 
 
 
@@ -426,10 +572,11 @@ def room_delete_all(request):
 
 
 
+@idempotent
 def room_view(request, pk):
     form = forms.ReservationForm()
+    status = 200
     room = get_object_or_404(models.Room, pk=pk)
-    reservations = room.reservations.filter(date_checkout__isnull=True).order_by('date_bookfrom')
 
     if request.method == "POST":
         form = forms.ReservationForm(request.POST)
@@ -438,59 +585,65 @@ def room_view(request, pk):
             instance = form.save(commit=False)
             instance.room = room
             instance.user = request.user
+            date_bookfrom, date_bookuntil = form.cleaned_data['date_bookfrom'], form.cleaned_data['date_bookuntil']
 
-            overlap = models.Reservation.objects.filter(  
-                date_bookfrom__lt=form.cleaned_data['date_bookuntil'],  # Existing booking ends AFTER new check-in
-                date_bookuntil__gt=form.cleaned_data['date_bookfrom'],   # Existing booking starts BEFORE new check-out
-                date_checkout__isnull=True,
-            ).exclude(pk=instance.pk if instance else None)
-
-            room_overlap = overlap.filter(room=room)
-            user_overlap = overlap.filter(user=request.user)
-
-            if overlap.exists():
-                if room_overlap.exists():
-                    msg = f"Room {room.name} is already booked for the selected dates."
-                elif user_overlap.exists():
-                    msg = f"You’re already booked elsewhere for one of the selected dates."
-
+            okay = True
+            if date_bookfrom == date_bookuntil:
+                msg = f"Book from and Book until should not be in the same day."
                 logger.error(msg)
                 form.add_error(None, msg)
-            else:
-                date_bookfrom, date_bookuntil = form.cleaned_data['date_bookfrom'], form.cleaned_data['date_bookuntil']
-                okay = True
-                if date_bookfrom == date_bookuntil:
-                    msg = f"Book from and Book until should not be in the same day."
-                    logger.error(msg)
-                    form.add_error(None, msg)
-                    okay = False
-                if date_bookfrom > date_bookuntil:
-                    msg = f"Book until has to be in the future, not in the past."
-                    logger.error(msg)
-                    form.add_error('date_bookuntil', msg)
-                    okay = False
-
-                if okay:
-                    days = (date_bookuntil - date_bookfrom).days
-                    paid_price = room.price * days
-
-                    instance.paid_price = paid_price
-                    instance.save()
+                okay = False
+            if date_bookfrom > date_bookuntil:
+                msg = f"Book until has to be in the future, not in the past."
+                logger.error(msg)
+                form.add_error('date_bookuntil', msg)
+                okay = False
+
+            if okay:
+                days = (date_bookuntil - date_bookfrom).days
+                paid_price = room.price * days
+
+                instance.paid_price = paid_price
+                # An existing booking overlaps if it starts BEFORE the new check-out
+                # and ends AFTER the new check-in. book() checks the room's and the
+                # user's in one indexed query, in the transaction that saves it.
+                try:
+                    availability.book(instance)
+                except availability.RoomOverlap:
+                    msg = f"Room {room.name} is already booked for the selected dates."
+                    metrics.booking_rejections.inc(reason="room_overlap")
+                except availability.UserOverlap:
+                    msg = f"You’re already booked elsewhere for one of the selected dates."
+                    metrics.booking_rejections.inc(reason="user_overlap")
+                except availability.BookingBusy:
+                    msg = f"Too many bookings are being made right now, please try again."
+                    metrics.booking_rejections.inc(reason="busy")
+                    status = 503 # Not kept by @idempotent, so a retry with the same key books again
+                else:
+                    metrics.bookings.inc()
                     msg = f"room:Reservation for room {instance.room.name} succesfully added."
                     logger.debug(msg)
                     messages.success(request, msg)
                     return redirect("room:reservation:view", instance.pk)
 
+                logger.error(msg)
+                form.add_error(None, msg)
+            else:
+                metrics.booking_rejections.inc(reason="dates")
+
     context = {
         'form': form,
         'title': room.name,
         'button_message': "Confirm",
         'room': room,
-        'reservations': reservations,
+        'calendar': calendars.room_calendar(request, room),
         'current_url': request.build_absolute_uri(),
     }
 
-    return render(request, "app/room/room.html", context)
+    response = render(request, "app/room/room.html", context, status=status)
+    if status == 503:
+        response["Retry-After"] = "1"
+    return response
 
 
 
@@ -501,9 +654,33 @@ def room_view(request, pk):
 def reservation_index(request):
     """ View for showing all available rooms"""
 
+    reservations = models.Reservation.objects.filter(user=request.user).select_related('room')
+    page = pagination.paginate(request, reservations, ['date_bookfrom', 'uuid'])
+
+    if request.GET.get("format") == "json":
+        return JsonResponse({
+            'results': [
+                {
+                    'uuid': reservation.pk,
+                    'room': reservation.room_id,
+                    'room_name': reservation.room.name,
+                    'date_bookfrom': reservation.date_bookfrom,
+                    'date_bookuntil': reservation.date_bookuntil,
+                    'date_checkin': reservation.date_checkin,
+                    'date_checkout': reservation.date_checkout,
+                    'paid_price': reservation.paid_price,
+                }
+                for reservation in page
+            ],
+            'next': page.next_cursor,
+            'previous': page.previous_cursor,
+        })
+
     context = {
         'title': "Resevations",
-        'reservations': models.Reservation.objects.filter(user=request.user),
+        'reservations': page,
+        'page': page,
+        'current_url': request.build_absolute_uri(),
     }
 
     return render(request, "app/reservation/index.html", context)
@@ -538,6 +715,7 @@ def reservation_delete(request, pk):
 
 
 @login_required
+@idempotent
 def reservation_checkin(request, pk):
     """ View for adding rooms"""
 
@@ -549,6 +727,7 @@ def reservation_checkin(request, pk):
         reservation.room.is_available = False
         reservation.room.save()
         reservation.save()
+        metrics.checkins.inc()
         msg = f"{reservation.room.name} succesfully checked in."
         logger.debug(msg)
         messages.success(request, msg)
@@ -565,6 +744,7 @@ def reservation_checkin(request, pk):
 
 
 @login_required
+@idempotent
 def reservation_checkout(request, pk):
     """ View for adding rooms"""
 
@@ -576,6 +756,7 @@ def reservation_checkout(request, pk):
         reservation.room.is_available = True
         reservation.room.save()
         reservation.save()
+        metrics.checkouts.inc()
         msg = f"{reservation.room.name} succesfully checked out."
         logger.debug(msg)
         messages.success(request, msg)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+from tempfile import gettempdir
 import os
 
 from dotenv import load_dotenv # for loading project env vars
@@ -50,11 +51,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.RequestTimingMiddleware', # Off unless REQUEST_TIMING is set, first so it times the others
+    'app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'app.middleware.RequestProfilerMiddleware', # ?_profile=1 for staff users, needs request.user
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
@@ -73,6 +77,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'app.idempotency.idempotency_key',
             ],
         },
     },
@@ -88,6 +93,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE', # Take the write lock when a transaction begins, so bookings are serialized
+            'timeout': 5, # Seconds to wait for the write lock before "database is locked"
+        },
+        'TEST': {
+            'NAME': Path(gettempdir()) / 'hotel_reservation_test_db.sqlite3', # A file rather than memory, so the concurrent booking tests' threads share it. Outside of the repo
+        },
     }
 }
 
@@ -137,6 +149,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = "/media/"
 
+STORAGES = {
+    'default': {'BACKEND': "django.core.files.storage.FileSystemStorage"},
+    'staticfiles': {'BACKEND': "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    'images': {'BACKEND': "app.storage.ContentAddressedStorage"}, # Room and profile images and their renditions, stored once per content (app/storage.py)
+}
+
 
 # Unauthorized Accesses Redirect Path
 LOGIN_REDIRECT_URL  = 'auth:signin'
@@ -152,7 +170,7 @@ EMAIL_HOST_USER     = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 
 
-# django-resized config
+# django-resized config, applied by the image workers rather than during the upload (app/imagejobs.py)
 DJANGORESIZED_DEFAULT_SIZE = [1920, 1080] # The default uploaded image size
 DJANGORESIZED_DEFAULT_SCALE = 0.5   # Scale down image dimensions by 50% before applying size.
 DJANGORESIZED_DEFAULT_QUALITY = 90 # Sets JPEG/WebP compression quality (1-100).
@@ -160,3 +178,88 @@ DJANGORESIZED_DEFAULT_KEEP_META = True # Preserves metadata (GPS, camera model,
 DJANGORESIZED_DEFAULT_FORCE_FORMAT = 'JPEG' # Converts all uploads to JPEG (or 'WEBP', 'PNG').
 DJANGORESIZED_DEFAULT_FORMAT_EXTENSIONS = {'JPEG': ".jpg"}
 DJANGORESIZED_DEFAULT_NORMALIZE_ROTATION = True # Fix orientation
+
+
+# Keyset pagination of the listings (app/pagination.py)
+LISTING_PAGE_SIZE = 25 # Rows per page of the room, amenity and reservation listings
+
+# Room full-text search (app/search.py)
+SEARCH_RESULTS_LIMIT = 200 # Number of best matches a room search keeps
+
+# Booking transactions (app/availability.py)
+BOOKING_RETRIES = 5 # Times a booking is retried when the database stays locked
+BOOKING_RETRY_BACKOFF = 0.05 # Seconds, doubled on every retry
+
+# Idempotency keys of the booking and check-in/out POSTs (app/idempotency.py)
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60 # Seconds a response is kept for replaying retries
+IDEMPOTENCY_PURGE_EVERY = 100 # Expired keys are purged after about 1 in this many keyed POSTs. 0 leaves it to manage.py purge_idempotency_keys
+
+# Per-request SQL and timing instrumentation (app/middleware.py)
+REQUEST_TIMING = os.getenv("REQUEST_TIMING") == "1" # Adds Server-Timing headers and logs the queries, DB, template and view time of every request
+
+# Staff request profiler (app/middleware.py)
+PROFILE_DIR = None # Where ?_profile=1 also saves the .prof files, e.g. BASE_DIR / 'profiles'. Not saved when None
+
+# Prometheus metrics at /metrics (app/metrics.py)
+METRICS_ENABLED = True
+METRICS_DIR = None # Directory shared by the worker processes of this host to add up their metrics, e.g. BASE_DIR / 'metrics'. Only this process's are shown when None. The files of exited processes are merged into a live one's
+METRICS_FLUSH_INTERVAL = 1 # Seconds between the writes of a process's metrics to METRICS_DIR
+METRICS_GAUGE_TTL = 60 # Seconds after which the gauges of a process that stopped writing are left out
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # /metrics wants it as a Bearer token. Without it /metrics is only open with DEBUG on
+
+# Cached room cards and rows (app/fragments.py)
+FRAGMENT_CACHE = 'fragments' # The CACHES alias the fragments and room versions are kept in
+FRAGMENT_CACHE_TIMEOUT = 300 # Seconds a fragment is kept. Also bounds how stale a locmem cache can get with several processes
+FRAGMENT_CACHE_BACKEND = os.getenv("FRAGMENT_CACHE_BACKEND", "locmem") # locmem (one process only), file or redis (any Redis compatible server, needs the redis package)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'locmem': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'fragments',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        'file': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': BASE_DIR / 'cache' / 'fragments',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        'redis': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("FRAGMENT_CACHE_LOCATION", "redis://127.0.0.1:6379"),
+        },
+    }[FRAGMENT_CACHE_BACKEND],
+}
+
+# Room availability calendar (app/calendars.py)
+ROOM_CALENDAR_MONTHS = 3 # Months room_view shows by default, ?months= asks for 1 to 12
+
+# Shared occupancy matrix (app/occupancy.py)
+OCCUPANCY_MATRIX = os.getenv("OCCUPANCY_MATRIX") # File the workers map to check availability without the DB, e.g. /dev/shm/hotel-occupancy. Off when empty, Unix only
+OCCUPANCY_MATRIX_NIGHTS = 730 # Nights it covers from the day it's built, lookups past them go to the DB
+OCCUPANCY_MATRIX_ROOMS = 256 # Rows it's built with at least, it's rebuilt twice the number of rooms large when they run out
+
+# Availability API for channel managers (app/inventory.py)
+AVAILABILITY_API_MAX_QUERIES = 2000 # (room, date range) queries one call may ask
+AVAILABILITY_API_MAX_NIGHTS = 731 # Longest date range of a query
+AVAILABILITY_API_MAX_SPAN = 1096 # Nights from the earliest start to the latest end of the queries of one call
+
+# Image renditions (app/renditions.py)
+IMAGE_RENDITIONS = {'thumb': 200, 'card': 640, 'full': 1600} # Widths of the smaller copies, in JPEG and WebP, of every room and profile image
+IMAGE_RENDITION_QUALITY = 80 # JPEG/WebP quality of the copies
+IMAGE_RENDITION_SHARED = ["default.png"] # Images shared by many rows, whose copies are never deleted
+IMAGE_PREVIEW_SIZE = 16 # Largest side in pixels of the blurry preview inlined in the pages until an image loads, `manage.py build_image_renditions` backfills it
+
+# Background processing of uploaded images (app/imagejobs.py)
+IMAGE_JOB_THREADS = 2 # Threads of every web process that process uploads as soon as they're saved. 0 leaves them to `manage.py process_images`
+IMAGE_JOB_ATTEMPTS = 5 # Times a job is tried before the image is shown as it was uploaded
+IMAGE_JOB_RETRY_BACKOFF = 30 # Seconds before the first retry, doubled on every retry
+IMAGE_JOB_TIMEOUT = 600 # Seconds after which a running job is taken to have died with its worker, and run again
+
+# Content-addressed image storage (app/storage.py)
+BLOB_CACHE_MAX_AGE = 365 * 24 * 60 * 60 # Seconds browsers keep a media/blobs/ file, which never changes under its name. Only used by the DEBUG server,
+# the web server in front should serve media/blobs/ itself with the same header, e.g. for nginx:
+#   location /media/blobs/ { alias /path/to/media/blobs/; add_header Cache-Control "public, max-age=31536000, immutable"; }
@@ -19,9 +19,18 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from app.storage import BLOBS
+from app.views import media_blob
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include("app.urls")),
 
     path("__reload__/", include("django_browser_reload.urls")), # for auto reloading
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) # for auto deletion of unused media
+]
+
+# Like static() below, only with DEBUG on: in production the web server serves media/, see BLOB_CACHE_MAX_AGE
+if settings.DEBUG:
+    urlpatterns.append(path(f"{settings.MEDIA_URL.lstrip('/')}{BLOBS}/<path:path>", media_blob, name="media-blob")) # Content-addressed images, with immutable cache headers
+
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) # for auto deletion of unused media